@@ -12,6 +12,10 @@ import json
 import datetime
 import base64
 import uuid
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 warnings.filterwarnings("ignore")
 os.environ["TRANSFORMERS_VERBOSITY"] = "error"  # 只显示严重错误
@@ -23,146 +27,443 @@ from typing import Annotated, Literal, TypedDict
 
 # --- LlamaIndex 依赖 (用于 RAG) ---
 from llama_index.core import VectorStoreIndex, Settings
+from llama_index.core.schema import MetadataMode, NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 from llama_index.vector_stores.elasticsearch import ElasticsearchStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.postprocessor.flag_embedding_reranker import FlagEmbeddingReranker
+from elasticsearch.helpers.vectorstore import AsyncDenseVectorStrategy
 from llama_index.llms.openai_like import OpenAILike
 
 # --- LangGraph & LangChain 依赖 (用于 Agent) ---
 from langgraph.graph import StateGraph
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage, AIMessage
 from langgraph.checkpoint.memory import MemorySaver
 from typing import TypedDict, Annotated, Sequence
 from langgraph.graph import add_messages
-from langgraph.prebuilt import ToolNode
+
+from app.core.es_client import INDEX_NAME, es_msearch
+from app.core.index_schema import tune_knn_query, NUM_CANDIDATES
+from app.core.context_packer import pack_context
+from app.core.model_server import MODEL_SERVER_SOCKET, RemoteEmbedding, RemoteReranker, load_embed_model, load_reranker
+from app.core.verified_answers import VerifiedAnswerIndex, format_answer
+from app.core import partitions, mmap_store, file_catalog
+from app.core.scheduler import scheduler, Overloaded
 
 # 加载环境变量
 from dotenv import load_dotenv
 load_dotenv(override=True)
 # 定义待解答问题的文件路径
 UNANSWERED_FILE = "unanswered_questions.json"
+# 定义文档存储路径 (人工解答的 .txt 也保存在这里)
+UPLOAD_DIR = "./factory_docs"
 # 定义本地图片存储路径
 IMAGES_DIR = "./factory_images"
 
 es_url = os.getenv("ELASTICSEARCH_URL", "http://elasticsearch:9200") 
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
+# 检索参数 (默认值沿用原来的经验值，可用 app/core/retrieval_eval.py 评测后通过环境变量调整)
+SIMILARITY_TOP_K = int(os.getenv("RAG_SIMILARITY_TOP_K", "10"))  # 粗排召回数量
+RERANK_TOP_N = int(os.getenv("RAG_RERANK_TOP_N", "5"))           # 精排保留数量
+HYBRID_SEARCH = os.getenv("RAG_HYBRID_SEARCH", "false").lower() == "true"  # 向量 + BM25 混合检索
+# 推测检索：对话开始时就用用户原话检索，与第一次大模型调用并行
+SPECULATIVE_RETRIEVAL = os.getenv("RAG_SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+SPECULATIVE_WORKERS = int(os.getenv("RAG_SPECULATIVE_WORKERS", "4"))
+SPECULATIVE_MIN_CHARS = int(os.getenv("RAG_SPECULATIVE_MIN_CHARS", "5"))  # 更短的消息 (问候、确认) 多半不会检索
+THREAD_PARTITIONS_MAX = int(os.getenv("RAG_THREAD_PARTITIONS_MAX", "10000"))  # 记住分区的会话数上限，超出时淘汰最久未活跃的
 
 # ==============================================================================
 # 1. 准备 RAG 引擎
 # ==============================================================================
 
+# 配置了 MODEL_SERVER_SOCKET 时，Embedding / Reranker 由共享模型服务提供 (见 app/core/model_server.py)，
+# 多个 uvicorn worker 不再各自加载一份权重
+if MODEL_SERVER_SOCKET:
+    print(f"🔌 使用共享模型服务: {MODEL_SERVER_SOCKET}")
+
 # 配置 Embedding
-GLOBAL_EMBED_MODEL = HuggingFaceEmbedding(model_name="models/hub/models--BAAI--bge-m3")
+GLOBAL_EMBED_MODEL = RemoteEmbedding() if MODEL_SERVER_SOCKET else load_embed_model()
 
 Settings.embed_model = GLOBAL_EMBED_MODEL
 
 Settings.llm = None
 
 # 配置 Reranker (核心竞争力: 重排序)
-reranker = FlagEmbeddingReranker(
-    model="models/hub/models--BAAI--bge-reranker-v2-m3", 
-    top_n=5,
-    use_fp16=True  # 必须开启半精度，进一步省显存
-)
+reranker = RemoteReranker(top_n=RERANK_TOP_N) if MODEL_SERVER_SOCKET else load_reranker(RERANK_TOP_N)
+
+# 工程师已解答问题的快速通道 (见 app/core/verified_answers.py)；来源文件被删除后答案随之撤回
+verified_index = VerifiedAnswerIndex(GLOBAL_EMBED_MODEL, UNANSWERED_FILE, UPLOAD_DIR, source_exists=file_catalog.has_file)
+
+def rerank_nodes(query: str, nodes: list, top_n: int = None) -> list:
+    """
+    用 bge-reranker 对粗排结果精排。
+    top_n 与全局 reranker 不同时复制一个浅拷贝 (共享底层模型，不会重复加载权重)。
+    """
+    if not nodes:
+        return []
+    top_n = top_n or RERANK_TOP_N
+    active_reranker = reranker if top_n == reranker.top_n else reranker.model_copy(update={"top_n": top_n})
+    return active_reranker.postprocess_nodes(nodes, query_str=query)
+
+def _rerank_timed(query: str, nodes: list, t0: float, use_rerank: bool, rerank_top_n: int, timings: dict) -> list:
+    """粗排结果精排 (或直接截断)，并记录两个阶段的耗时"""
+    t1 = time.perf_counter()
+    if use_rerank:
+        nodes = rerank_nodes(query, nodes, rerank_top_n)
+    else:
+        nodes = nodes[:rerank_top_n or RERANK_TOP_N]
+    t2 = time.perf_counter()
+
+    if timings is not None:
+        timings["retrieve"] = t1 - t0
+        timings["rerank"] = t2 - t1
+    return nodes
+
+def retrieve_nodes(
+    query: str,
+    similarity_top_k: int = None,
+    rerank_top_n: int = None,
+    use_rerank: bool = True,
+    hybrid: bool = None,
+    index_name: str = INDEX_NAME,
+    timings: dict = None,
+) -> list:
+    """
+    知识库检索管线：ES 粗排 (纯向量或混合检索) -> bge-reranker 精排。
+    search_factory_knowledge 与检索评测工具共用这一条路径，保证评测结果与线上一致。
+    VECTOR_BACKEND=mmap 时粗排改用进程内向量库 (见 app/core/mmap_store.py，只支持纯向量检索)。
+    :param timings: 可选，传入字典时写入各阶段耗时 (秒)：retrieve / rerank。
+    :return: NodeWithScore 列表，已按相关度从高到低排序。
+    """
+    similarity_top_k = similarity_top_k or SIMILARITY_TOP_K
+    hybrid = HYBRID_SEARCH if hybrid is None else hybrid
+
+    if mmap_store.enabled():
+        t0 = time.perf_counter()
+        nodes = mmap_store.search_nodes(index_name, embed_queries([query]), similarity_top_k)[0]
+        return _rerank_timed(query, nodes, t0, use_rerank, rerank_top_n, timings)
+
+    vector_store = ElasticsearchStore(
+        es_url=es_url,
+        index_name=index_name,
+        retrieval_strategy=AsyncDenseVectorStrategy(hybrid=hybrid),
+    )
+    try:
+        index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+        retriever = index.as_retriever(
+            similarity_top_k=similarity_top_k,
+            vector_store_query_mode="hybrid" if hybrid else "default",
+            # num_candidates 使用 ES_NUM_CANDIDATES (LlamaIndex 默认固定为 top_k * 10)
+            vector_store_kwargs={"custom_query": tune_knn_query},
+        )
+
+        t0 = time.perf_counter()
+        nodes = retriever.retrieve(query)
+        return _rerank_timed(query, nodes, t0, use_rerank, rerank_top_n, timings)
+    finally:
+        # 显式关闭 Elasticsearch 客户端连接
+        try:
+            if hasattr(vector_store, 'client'):
+                asyncio.get_event_loop().run_until_complete(
+                    vector_store.client.close()
+                )
+        except Exception:
+            pass  # 忽略关闭时的错误
+
+# ------------------------------------------------------------------------------
+# 推测检索 (Speculative retrieval)
+# 系统提示要求模型先用用户的完整问题调用 search_factory_knowledge，
+# 所以在第一次大模型调用的同时就可以开始检索；工具收到的 query 与用户原话一致时直接复用结果，
+# 不一致 (模型改写了问题) 或本轮没有调用检索时结果被丢弃。
+# 推测阶段只做向量计算 + 粗排，精排 (CPU 开销最大) 在取用时才做：结果被丢弃时不浪费精排，
+# 精排也落在工具调用占用的 chat 槽位内，计入准入控制 (见 scheduler.py)。
+# ------------------------------------------------------------------------------
+_speculative_executor = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative")
+_speculative_retrievals = {}  # (检索的索引, 归一化后的问题) -> Future
+_speculative_lock = threading.Lock()
+_speculative_stats = {"started": 0, "reused": 0, "discarded": 0}
+
+def _normalize_query(query: str) -> str:
+    """去掉空白和句末标点后比较，模型照抄用户问题时常会补一个问号"""
+    return re.sub(r"[\s?？。.!！]+$", "", re.sub(r"\s+", " ", query.strip())).lower()
+
+def start_speculative_retrieval(query: str, index_name: str = INDEX_NAME):
+    """提交一次后台粗排，返回 Future (未开启或消息太短时返回 None)"""
+    normalized = _normalize_query(query)
+    if not SPECULATIVE_RETRIEVAL or len(normalized) < SPECULATIVE_MIN_CHARS:
+        return None
+    # 同一个问题在不同分区下的检索结果不同，索引也是键的一部分
+    key = (index_name, normalized)
+    with _speculative_lock:
+        if key in _speculative_retrievals:
+            return None
+        # 粗排召回的候选全部保留，取用时再精排
+        future = _speculative_executor.submit(
+            retrieve_nodes, query, use_rerank=False, rerank_top_n=SIMILARITY_TOP_K, index_name=index_name,
+        )
+        _speculative_retrievals[key] = future
+        _speculative_stats["started"] += 1
+    return future
+
+def take_speculative_retrieval(query: str, index_name: str = INDEX_NAME):
+    """工具调用时取出与 query 匹配的推测粗排结果并精排；没有或检索失败返回 None"""
+    with _speculative_lock:
+        future = _speculative_retrievals.pop((index_name, _normalize_query(query)), None)
+    if future is None:
+        return None
+    try:
+        nodes = future.result()
+    except Exception as e:
+        print(f"⚠️ [推测检索] 后台检索失败，重新检索: {e}")
+        return None
+    _speculative_stats["reused"] += 1
+    return rerank_nodes(query, nodes)
+
+def discard_speculative_retrieval(query: str, future, index_name: str = INDEX_NAME):
+    """本轮结束时仍未被取走的推测结果直接丢弃 (只移除自己提交的那一个)"""
+    with _speculative_lock:
+        key = (index_name, _normalize_query(query))
+        if _speculative_retrievals.get(key) is future:
+            del _speculative_retrievals[key]
+            future.cancel()
+            _speculative_stats["discarded"] += 1
+
+def get_speculative_stats() -> dict:
+    return dict(_speculative_stats)
+
+# ------------------------------------------------------------------------------
+# 批量检索：模型在同一轮发出多个 search_factory_knowledge 调用时 (多部分问题)，
+# 一次前向计算全部查询向量 -> 一次 _msearch -> 一次批量精排 -> 跨查询去重
+# ------------------------------------------------------------------------------
+def embed_queries(queries: list) -> list:
+    if hasattr(GLOBAL_EMBED_MODEL, "get_query_embeddings"):
+        return GLOBAL_EMBED_MODEL.get_query_embeddings(queries)
+    if not getattr(GLOBAL_EMBED_MODEL, "query_instruction", None):
+        # bge-m3 查询不加指令，查询向量与文本向量一致，可以直接批量计算
+        return GLOBAL_EMBED_MODEL.get_text_embedding_batch(queries)
+    return [GLOBAL_EMBED_MODEL.get_query_embedding(q) for q in queries]
+
+def _search_body(query: str, vector: list, top_k: int, hybrid: bool) -> dict:
+    """与 ElasticsearchStore (AsyncDenseVectorStrategy) 生成的查询保持一致"""
+    body = {
+        "size": top_k,
+        "_source": {"excludes": ["embedding"]},
+        "knn": {"field": "embedding", "query_vector": vector, "k": top_k, "num_candidates": max(NUM_CANDIDATES, top_k)},
+    }
+    if hybrid:
+        body["query"] = {"match": {"content": query}}
+        body["rank"] = {"rrf": {}}
+    return body
+
+def _hit_to_node(hit: dict) -> NodeWithScore:
+    source = hit["_source"]
+    metadata = source.get("metadata", {})
+    try:
+        node = metadata_dict_to_node(metadata)
+        node.set_content(source.get("content", ""))
+    except Exception:
+        # 非 LlamaIndex 写入的数据没有 _node_content
+        node = TextNode(text=source.get("content", ""), metadata=metadata, id_=hit["_id"])
+    return NodeWithScore(node=node, score=hit.get("_score"))
+
+def score_pairs(pairs: list) -> list:
+    """一次性给所有 (问题, 片段) 对打分"""
+    if isinstance(reranker, RemoteReranker):
+        return reranker.compute_scores(pairs)
+    # FlagEmbeddingReranker 没有公开的批量打分接口，直接使用它内部的 FlagReranker
+    scores = reranker._model.compute_score(pairs)
+    return scores if isinstance(scores, list) else [scores]
+
+def batch_retrieve_nodes(
+    queries: list,
+    similarity_top_k: int = None,
+    rerank_top_n: int = None,
+    hybrid: bool = None,
+    index_name: str = INDEX_NAME,
+) -> list:
+    """
+    多个查询共用一次向量计算、一次 ES 请求和一次精排。
+    :return: 与 queries 一一对应的 NodeWithScore 列表，各自按精排分数降序
+    """
+    similarity_top_k = similarity_top_k or SIMILARITY_TOP_K
+    rerank_top_n = rerank_top_n or RERANK_TOP_N
+    hybrid = HYBRID_SEARCH if hybrid is None else hybrid
+
+    t0 = time.perf_counter()
+    vectors = embed_queries(queries)
+    t1 = time.perf_counter()
+    if mmap_store.enabled():
+        # 一次矩阵乘法算完全部查询
+        candidates = mmap_store.search_nodes(index_name, vectors, similarity_top_k)
+    else:
+        responses = es_msearch(index_name, [_search_body(q, v, similarity_top_k, hybrid) for q, v in zip(queries, vectors)])
+        candidates = [[_hit_to_node(hit) for hit in response["hits"]["hits"]] for response in responses]
+    t2 = time.perf_counter()
+
+    pairs = [
+        [query, node.node.get_content(metadata_mode=MetadataMode.EMBED)]
+        for query, nodes in zip(queries, candidates)
+        for node in nodes
+    ]
+    scores = iter(score_pairs(pairs) if pairs else [])
+    results = []
+    for nodes in candidates:
+        for node in nodes:
+            node.score = float(next(scores))
+        results.append(sorted(nodes, key=lambda n: -n.score)[:rerank_top_n])
+    t3 = time.perf_counter()
+
+    print(
+        f"📚 [批量检索] {len(queries)} 个查询: 向量 {t1 - t0:.2f}s, {mmap_store.VECTOR_BACKEND} {t2 - t1:.2f}s, "
+        f"精排 {len(pairs)} 对 {t3 - t2:.2f}s"
+    )
+    return results
+
+def dedupe_across_queries(results: list) -> tuple:
+    """
+    同一片段被多个查询召回时，只保留在精排分数最高的那个查询里。
+    :return: (去重后的结果, 每个查询被移走的片段所在的查询序号)
+    """
+    best = {}
+    for qi, nodes in enumerate(results):
+        for node in nodes:
+            node_id = node.node.node_id
+            if node_id not in best or node.score > best[node_id][0]:
+                best[node_id] = (node.score, qi)
+
+    deduped, moved_to = [], []
+    for qi, nodes in enumerate(results):
+        deduped.append([n for n in nodes if best[n.node.node_id][1] == qi])
+        moved_to.append(sorted({best[n.node.node_id][1] for n in nodes if best[n.node.node_id][1] != qi}))
+    return deduped, moved_to
+
+def batch_search_factory_knowledge(queries: list, index_name: str = INDEX_NAME) -> list:
+    """批量版 search_factory_knowledge，返回与 queries 一一对应的工具结果文本"""
+    print(f"\n🔍 [Agent 动作] 正在批量查询知识库: {queries}")
+
+    # 相同的查询只检索一次；与用户原话一致的查询复用推测检索结果
+    unique = []
+    for query in queries:
+        if _normalize_query(query) not in [_normalize_query(q) for q in unique]:
+            unique.append(query)
+    results = [take_speculative_retrieval(query, index_name) for query in unique]
+    pending = [i for i, nodes in enumerate(results) if nodes is None]
+    if pending:
+        for i, nodes in zip(pending, batch_retrieve_nodes([unique[i] for i in pending], index_name=index_name)):
+            results[i] = nodes
+
+    deduped, moved_to = dedupe_across_queries(results)
+    rendered = {}
+    for query, nodes, moved in zip(unique, deduped, moved_to):
+        text = format_search_results(nodes) if nodes else ""
+        if moved:
+            others = "、".join(f"「{unique[j]}」" for j in moved)
+            note = f"(与查询{others}重复的片段已在该查询结果中给出，此处省略)"
+            text = f"{text}\n\n{note}" if text else note
+        rendered[_normalize_query(query)] = text or "未在知识库中找到相关内容。"
+
+    contents, answered = [], set()
+    for query in queries:
+        key = _normalize_query(query)
+        if key in answered:
+            contents.append(f"(与前面相同的查询「{query}」，结果见上文)")
+            continue
+        answered.add(key)
+        contents.append(rendered[key])
+    return contents
 
 # ==============================================================================
 # 2. 定义 Agent 的工具 (Tool)
 # ==============================================================================
 
+def _safe_page(page_str) -> int:
+    try:
+        return int(page_str)
+    except (TypeError, ValueError):
+        return 0
+
+def format_search_results(source_nodes: list) -> str:
+    """把精排后的片段打包并拼接成工具返回给大模型的上下文"""
+    # ---------------------------------------------------------
+    # 1. 打包：合并相邻片段、去重、按精排分数装入 token/图片预算
+    # ---------------------------------------------------------
+    node_data = []
+    for node in source_nodes:
+        node_data.append({
+            "text": node.text,
+            "file_name": node.metadata.get('file_name', '未知文件'),
+            "page_label": _safe_page(node.metadata.get('page_label', '0')),
+            "page_end": _safe_page(node.metadata.get('page_end', node.metadata.get('page_label', '0'))),
+            "chunk_index": node.metadata.get('chunk_index', 0),
+            "heading_path": node.metadata.get('heading_path', ''),
+            "score": node.score or 0.0
+        })
+
+    packed = pack_context(node_data)
+    stats = packed["stats"]
+    print(
+        f"📦 [上下文打包] {stats['nodes_in']} 个片段 -> {stats['groups_out']} 段, "
+        f"tokens {stats['tokens_in']} -> {stats['tokens_out']} (节省 {stats['tokens_saved']}), "
+        f"图片 {stats['images_in']} -> {stats['images_out']}"
+    )
+
+    # ---------------------------------------------------------
+    # 2. 拼接：构建连续的上下文流 (打包结果已按文件名、页码排序)
+    # ---------------------------------------------------------
+    final_context_list = []
+    current_file = None
+    
+    for item in packed["groups"]:
+        # 如果换文件了，加一个明显的大标题
+        if item['file_name'] != current_file:
+            final_context_list.append(f"\n\n====== 文件: {item['file_name']} (开始) ======\n")
+            current_file = item['file_name']
+        
+        # 使用更紧凑的分页标记，并在标记中提示 LLM 注意跨页连接
+        # 我们故意在分页符前后少加换行，让 LLM 感觉这是一篇连续的文章
+        context_str = f"\n{item['text']}"
+        # 版面切片带有标题路径，帮助模型确认这一段属于哪台设备/哪个章节
+        if item['heading_paths']:
+            context_str = f"\n【{' / '.join(item['heading_paths'])}】\n{item['text']}"
+        final_context_list.append(context_str)
+
+    final_response = "".join(final_context_list) # 使用空字符串连接，更紧凑
+    
+    if not final_response.strip():
+        return "未在知识库中找到相关内容。"
+
+    # Debug
+    print("✅ [Debug] 已按页码重排并打包检索结果")
+    print("内容预览：", final_response) # 调试时可开启
+    
+    return final_response
+
 @tool
-def search_factory_knowledge(query: str) -> str:
+def search_factory_knowledge(query: str, config: RunnableConfig) -> str:
     """
     当用户询问工厂设备故障、错误码、维修步骤或操作规程时，必须调用此工具进行查询。
     重要提示:query 参数必须是完整的中文问题句子，不要随意对用户的问题进行概括、不要提取关键词。
     :param query: 必要参数，字符串类型，用于输入用户的具体问题。
     :return: 返回查询的结果和来源文件，包含图文混排内容。
     """
+    # config 由框架注入，不出现在工具参数里；index_name 是本轮对话的分区检索范围 (见 chat_stream)
+    index_name = config.get("configurable", {}).get("index_name", INDEX_NAME)
     print(f"\n🔍 [Agent 动作] 正在调用知识库查询: {query}")
-    vector_store = None
     try:
-        # 连接 ES 数据库
-        vector_store = ElasticsearchStore(
-            es_url=es_url,
-            index_name="factory_knowledge",
-        )
-        index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-
-        # RAG Engine
-        rag_engine = index.as_query_engine(
-            similarity_top_k=10,  # 粗排
-            node_postprocessors=[reranker], # 精排
-            verbose=True,
-            response_mode="no_text"
-        )
-        # 调用 LlamaIndex 的 RAG 引擎
-        response = rag_engine.query(query)
-
-        # ---------------------------------------------------------
-        # 1. 排序：先按文件名，再按页码
-        # ---------------------------------------------------------
-        node_data = []
-        if hasattr(response, 'source_nodes'):
-            for node in response.source_nodes:
-                page_str = node.metadata.get('page_label', '0')
-                try:
-                    page_num = int(page_str)
-                except ValueError:
-                    page_num = 0
-                
-                node_data.append({
-                    "text": node.text,
-                    "file_name": node.metadata.get('file_name', '未知文件'),
-                    "page_label": page_num
-                })
-
-        sorted_nodes = sorted(node_data, key=lambda x: (x['file_name'], x['page_label']))
-
-        # ---------------------------------------------------------
-        # 2. 拼接：构建连续的上下文流
-        # ---------------------------------------------------------
-        final_context_list = []
-        current_file = None
-        
-        for item in sorted_nodes:
-            # 如果换文件了，加一个明显的大标题
-            if item['file_name'] != current_file:
-                final_context_list.append(f"\n\n====== 文件: {item['file_name']} (开始) ======\n")
-                current_file = item['file_name']
-            
-            # 使用更紧凑的分页标记，并在标记中提示 LLM 注意跨页连接
-            # 我们故意在分页符前后少加换行，让 LLM 感觉这是一篇连续的文章
-            context_str = f"\n{item['text']}"
-            final_context_list.append(context_str)
-
-        final_response = "".join(final_context_list) # 使用空字符串连接，更紧凑
-        
-        if not final_response.strip():
-            return "未在知识库中找到相关内容。"
-
-        # Debug
-        print("✅ [Debug] 已按页码重排检索结果")
-        print("内容预览：", final_response) # 调试时可开启
-        
-        return final_response
+        # 粗排 (ES) + 精排 (reranker)；优先复用本轮开始时已发起的推测粗排
+        source_nodes = take_speculative_retrieval(query, index_name)
+        if source_nodes is not None:
+            print("⚡ [推测检索] 命中，复用并行检索结果")
+        else:
+            source_nodes = retrieve_nodes(query, index_name=index_name)
+
+        return format_search_results(source_nodes)
     except Exception as e:
         print(f"❌ 详细错误: {type(e).__name__}: {e}")
         import traceback
         traceback.print_exc()
         return f"查询出错: {e}"
-    
-    finally:
-        # 显式关闭 Elasticsearch 客户端连接
-        if vector_store is not None:
-            try:
-                # 关闭 ES 客户端
-                if hasattr(vector_store, 'client'):
-                    asyncio.get_event_loop().run_until_complete(
-                        vector_store.client.close()
-                    )
-            except Exception as e:
-                pass  # 忽略关闭时的错误
 
 @tool
 def record_missing_knowledge(user_query: str, reason: str = "未检索到相关文档") -> str:
@@ -229,9 +530,13 @@ def convert_to_multimodal_messages(messages):
     如果有 Markdown 图片链接，就把它变成 Base64 发给大模型。
     """
     processed_messages = list(messages)
-    last_msg = processed_messages[-1]
 
-    if isinstance(last_msg, ToolMessage) and "![示意图]" in str(last_msg.content):
+    # 批量检索时一轮会有多条 ToolMessage，全部处理
+    for last_msg in reversed(processed_messages):
+        if not isinstance(last_msg, ToolMessage):
+            break
+        if "![示意图]" not in str(last_msg.content):
+            continue
         text_content = last_msg.content
         new_content_blocks = []
         
@@ -248,7 +553,7 @@ def convert_to_multimodal_messages(messages):
                     new_content_blocks.append({"type": "text", "text": text_part})
             
             img_url = match.group(1)
-            filename = match.group(2)
+            filename = match.group(2).split("?")[0]  # 去掉内容版本号 ?v=...
             local_path = os.path.join(IMAGES_DIR, filename)
             
             if os.path.exists(local_path):
@@ -485,11 +790,68 @@ def should_continue(state: AgentState):
         return "tools"
     return "__end__"
 
+# 定义节点：执行工具 (替代 ToolNode)
+# 同一轮的多个检索调用合并为一次批量检索，其余工具照常并发执行
+tools_by_name = {t.name: t for t in tools}
+
+async def _invoke_tool(tool_call, config: RunnableConfig) -> str:
+    tool_impl = tools_by_name.get(tool_call["name"])
+    if tool_impl is None:
+        return f"Error: 未知工具 {tool_call['name']}"
+    try:
+        return str(await tool_impl.ainvoke(tool_call["args"], config))
+    except Exception as e:
+        return f"Error: {type(e).__name__}: {e}"
+
+async def _run_tool_calls(tool_calls: list, config: RunnableConfig) -> list:
+    index_name = config.get("configurable", {}).get("index_name", INDEX_NAME)
+    search_calls = [tc for tc in tool_calls if tc["name"] == "search_factory_knowledge"]
+
+    batched = {}
+    if len(search_calls) > 1:
+        queries = [tc["args"].get("query", "") for tc in search_calls]
+        try:
+            contents = await asyncio.to_thread(batch_search_factory_knowledge, queries, index_name)
+        except Exception as e:
+            print(f"❌ 批量检索失败: {type(e).__name__}: {e}")
+            contents = [f"查询出错: {e}"] * len(queries)
+        batched = {tc["id"]: content for tc, content in zip(search_calls, contents)}
+
+    async def run(tc):
+        return batched[tc["id"]] if tc["id"] in batched else await _invoke_tool(tc, config)
+
+    return await asyncio.gather(*(run(tc) for tc in tool_calls))
+
+async def run_tools(state: AgentState, config: RunnableConfig):
+    """
+    对话只在检索 (embedding + 精排) 期间占用 CPU 槽位，大模型生成是远程调用，不占槽位：
+    接口层拿到的槽位 (slot_lease) 覆盖第一轮检索，检索完成后立即释放；之后的检索轮次重新申请。
+    """
+    tool_calls = state["messages"][-1].tool_calls
+    lease = config.get("configurable", {}).get("slot_lease")
+    if lease is None or not any(tc["name"] == "search_factory_knowledge" for tc in tool_calls):
+        contents = await _run_tool_calls(tool_calls, config)
+    elif not lease.released:
+        try:
+            contents = await _run_tool_calls(tool_calls, config)
+        finally:
+            lease.release()
+    else:
+        try:
+            async with scheduler.slot("chat"):
+                contents = await _run_tool_calls(tool_calls, config)
+        except Overloaded as e:
+            contents = [f"查询出错: 系统繁忙 ({e.reason})，请稍后重试"] * len(tool_calls)
+    return {"messages": [
+        ToolMessage(content=content, name=tc["name"], tool_call_id=tc["id"])
+        for tc, content in zip(tool_calls, contents)
+    ]}
+
 # --- 构建图 ---
 workflow = StateGraph(AgentState)
 
 workflow.add_node("agent", call_model)
-workflow.add_node("tools", ToolNode(tools))
+workflow.add_node("tools", run_tools)
 
 workflow.set_entry_point("agent")
 
@@ -509,11 +871,66 @@ graph = workflow.compile(checkpointer=memory)
 
 print("🤖 工厂智能Agent已启动！")
 
+# 每个会话最近一次的检索分区：追问 (如「那怎么拆下来？」) 通常不再提产线，沿用上一轮的分区
+# 按最近活跃排序，超过 THREAD_PARTITIONS_MAX 个会话时淘汰最久未活跃的，长期运行不会无限增长
+_thread_partitions = OrderedDict()
+_thread_partitions_lock = threading.Lock()
+
+def resolve_partition(message: str, thread_id: str, scope: str = None):
+    """
+    本轮检索的分区：请求指定的 scope > 从问题中识别 > 会话上一轮的分区；None 表示全库。
+    scope 非法时抛出 ValueError。
+    """
+    partition = partitions.resolve_scope(scope, message)
+    with _thread_partitions_lock:
+        if partition is None and not scope:
+            partition = _thread_partitions.get(thread_id)
+        _thread_partitions[thread_id] = partition
+        _thread_partitions.move_to_end(thread_id)
+        while len(_thread_partitions) > THREAD_PARTITIONS_MAX:
+            _thread_partitions.popitem(last=False)
+    return partition
+
 # 封装一个异步生成器函数，用于流式输出
-async def chat_stream(message: str, thread_id: str):
-    config = {"configurable": {"thread_id": thread_id}}
-    has_yielded = False # 标记是否已经向前端发送过内容
+async def chat_stream(message: str, thread_id: str, scope: str = None, slot_lease=None):
+    """:param slot_lease: 接口层准入时拿到的 chat 槽位 (scheduler.SlotLease)，检索完成后由 run_tools 释放"""
+    partition = await asyncio.to_thread(resolve_partition, message, thread_id, scope)
+    index_name = await asyncio.to_thread(partitions.search_target, partition)
+    search_keys = await asyncio.to_thread(partitions.search_keys, partition)
+    if partition:
+        print(f"🗂️ [分区检索] {partition} -> {index_name}")
+    config = {"configurable": {"thread_id": thread_id, "index_name": index_name, "slot_lease": slot_lease}}
+
+    # 命中工程师已验证的答案时直接返回，不调用大模型
+    try:
+        hit = await asyncio.to_thread(verified_index.lookup, message, search_keys)
+    except Exception as e:
+        print(f"⚠️ [已验证答案] 匹配失败，走正常流程: {e}")
+        hit = None
+    if hit:
+        print(f"⚡ [已验证答案] 命中 (相似度 {hit['score']:.3f}): {hit['query']}")
+        answer = format_answer(hit)
+        # 写入对话记忆，后续追问仍能看到这一轮问答
+        await graph.aupdate_state(
+            config,
+            {"messages": [HumanMessage(content=message), AIMessage(content=answer)]},
+            as_node="agent",
+        )
+        yield answer
+        return
     
+    # 与第一次大模型调用并行，先用用户原话开始检索
+    speculative = start_speculative_retrieval(message, index_name)
+    try:
+        async for chunk in _stream_graph(message, config):
+            yield chunk
+    finally:
+        if speculative is not None:
+            discard_speculative_retrieval(message, speculative, index_name)
+
+async def _stream_graph(message: str, config: dict):
+    has_yielded = False # 标记是否已经向前端发送过内容
+
     async for event in graph.astream_events(
         {"messages": [HumanMessage(content=message)]}, 
         config=config,
@@ -0,0 +1,356 @@
+# app/core/bulk_ingest.py
+"""
+整库批量入库 (命令行)
+
+把一个目录下的全部文档 (PDF / DOCX / TXT / MD) 导入知识库，用于一次性导入工厂的历史资料：
+- 解析 (PyMuPDF 版面解析、SimpleDirectoryReader) 在进程池中并行执行；子进程以 spawn 方式启动，
+  只导入 doc_parser，不继承主进程已加载的模型和线程 (torch 加载后再 fork 可能死锁)
+- 主进程把各文件的片段攒成批，批量向量化后用 ES bulk 写入，不再逐个文件建索引
+- 每个文件写完后记录到断点清单 (manifest)，中断后重新执行会跳过已完成的文件；
+  写了一半的、已修改的、之前已入库过的文件都会先清掉已有片段再入库，不会产生重复数据
+- 实时输出吞吐量 (文件/片段/MB 每秒) 和预计剩余时间
+
+用法：
+    python -m app.core.bulk_ingest /data/plant_archive --workers 4
+    python -m app.core.bulk_ingest /data/plant_archive --retry-failed   # 重试上次失败的文件
+    python -m app.core.bulk_ingest /data/line3 --scope line3_conveyor   # 全部导入指定分区 (默认按文件名识别)
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict
+
+from llama_index.core.schema import MetadataMode
+from llama_index.vector_stores.elasticsearch import ElasticsearchStore
+
+from app.core.es_client import es_request, index_exists, ESError, ES_URL, INDEX_NAME
+from app.core import file_catalog, partitions, mmap_store
+from app.core.index_schema import ensure_knowledge_index
+# 本模块会在每个 spawn 子进程里重新导入，模块级只能导入不加载模型的模块 (向量模型在 BulkWriter 里按需导入)
+from app.core.doc_parser import parse_file, CHUNK_SIZE
+from app.core.storage_gc import UPLOAD_DIR
+
+DEFAULT_EXTENSIONS = (".pdf", ".docx", ".txt", ".md")
+DEFAULT_MANIFEST = "bulk_ingest_manifest.json"
+DEFAULT_BATCH_SIZE = 256  # 每批向量化 + bulk 写入的片段数
+PURGE_BATCH_SIZE = 1000  # 每次清理已有片段的文件数
+
+# -----------------------------------------------------------
+# 1. 断点清单
+# -----------------------------------------------------------
+class Manifest:
+    """
+    {绝对路径: {"status": "done"|"partial"|"failed", "name", "size", "mtime", "chunks", "pages", "error"}}
+    文件大小或修改时间变化后视为新文件重新入库。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def is_done(self, file_path: str, retry_failed: bool) -> bool:
+        entry = self.entries.get(file_path)
+        if not entry:
+            return False
+        stat = os.stat(file_path)
+        if entry.get("size") != stat.st_size or entry.get("mtime") != int(stat.st_mtime):
+            return False
+        return entry["status"] == "done" or (entry["status"] == "failed" and not retry_failed)
+
+    def mark(self, file_path: str, status: str, **fields):
+        stat = os.stat(file_path)
+        entry = self.entries.setdefault(file_path, {})
+        entry.update(status=status, size=stat.st_size, mtime=int(stat.st_mtime), **fields)
+
+    def partial_names(self) -> List[str]:
+        return [e["name"] for e in self.entries.values() if e.get("status") == "partial"]
+
+    def save(self):
+        # 先写临时文件再替换，避免中断时清单本身损坏
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+# -----------------------------------------------------------
+# 2. 待解析文件 (解析本身见 doc_parser.parse_file，在子进程中执行)
+# -----------------------------------------------------------
+def collect_files(root: str, extensions) -> List[str]:
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(extensions) and not filename.startswith("."):
+                files.append(os.path.abspath(os.path.join(dirpath, filename)))
+    return sorted(files)
+
+# -----------------------------------------------------------
+# 3. 批量写入 (主进程)
+# -----------------------------------------------------------
+class BulkWriter:
+    """
+    攒批向量化并写入 ES；一个文件的所有片段都写入后才回调 on_file_done。
+    不同分区的片段可以在同一批里向量化，写入时按分区分别写到各自的索引。
+    """
+
+    def __init__(self, index_name: str, batch_size: int, on_file_done):
+        from app.core.agent import GLOBAL_EMBED_MODEL
+        self.embed_model = GLOBAL_EMBED_MODEL
+        if not mmap_store.enabled():
+            ensure_knowledge_index(index_name)
+        self.index_name = index_name
+        self.vector_stores = {}  # 分区 -> ElasticsearchStore
+        self.batch_size = batch_size
+        self.on_file_done = on_file_done
+        self.buffer = []
+        self.pending_files = deque()  # [(file_path, 最后一个片段在全局序列中的位置, result)]
+        self.written = 0
+        self.queued = 0
+
+    def _store(self, partition: str):
+        if partition not in self.vector_stores:
+            if mmap_store.enabled():
+                # mmap 后端所有分区在同一个集合里，分区取自片段的 metadata
+                self.vector_stores[partition] = mmap_store.get_store(self.index_name)
+                return self.vector_stores[partition]
+            if partition == partitions.GENERAL:
+                index_name = self.index_name
+            else:
+                partitions.ensure_partition_index(partition)
+                index_name = partitions.write_target(partition)
+            self.vector_stores[partition] = ElasticsearchStore(es_url=ES_URL, index_name=index_name)
+        return self.vector_stores[partition]
+
+    def add(self, file_path: str, result: Dict):
+        self.buffer.extend((result["partition"], node) for node in result["nodes"])
+        self.queued += len(result["nodes"])
+        self.pending_files.append((file_path, self.queued, result))
+        while len(self.buffer) >= self.batch_size:
+            self._flush(self.batch_size)
+
+    def flush(self):
+        while self.buffer:
+            self._flush(self.batch_size)
+        self._complete_files()
+
+    def _flush(self, size: int):
+        batch, self.buffer = self.buffer[:size], self.buffer[size:]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for _, node in batch]
+        embeddings = self.embed_model.get_text_embedding_batch(texts)
+        by_partition = {}
+        for (partition, node), embedding in zip(batch, embeddings):
+            node.embedding = embedding
+            by_partition.setdefault(partition, []).append(node)
+        for partition, nodes in by_partition.items():
+            self._store(partition).add(nodes)
+        self.written += len(batch)
+        self._complete_files()
+
+    def _complete_files(self):
+        while self.pending_files and self.pending_files[0][1] <= self.written:
+            file_path, _, result = self.pending_files.popleft()
+            self.on_file_done(file_path, result)
+
+def purge_files(names: List[str], index_name: str):
+    """
+    删除即将重新入库的文件的已有片段：上次中断残留的、已入库后又被修改的、之前通过上传接口入库过的，
+    否则重新写入后同一文件的片段会重复
+    """
+    if not names:
+        return
+    if not mmap_store.enabled() and not index_exists(index_name):
+        return
+    print(f"🧹 清理 {len(names)} 个待入库文件的已有片段...")
+    # terms 查询的词条数 / SQLite 参数个数都有上限，分批删除
+    for start in range(0, len(names), PURGE_BATCH_SIZE):
+        batch = names[start:start + PURGE_BATCH_SIZE]
+        if mmap_store.enabled():
+            mmap_store.delete_files(batch, index_name)
+            continue
+        es_request(
+            "POST",
+            f"/{index_name}/_delete_by_query",
+            {"query": {"terms": {"metadata.file_name.keyword": batch}}},
+            params={"conflicts": "proceed", "refresh": "true"},
+            timeout=600,
+        )
+
+# -----------------------------------------------------------
+# 4. 进度
+# -----------------------------------------------------------
+class Progress:
+    def __init__(self, total_files: int, total_bytes: int):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    def update(self, size: int, chunks: int = 0, failed: bool = False):
+        self.files += 1
+        self.bytes += size
+        self.chunks += chunks
+        self.failed += int(failed)
+
+    def line(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        byte_rate = self.bytes / elapsed
+        eta = (self.total_bytes - self.bytes) / byte_rate if byte_rate else 0
+        return (
+            f"[{self.files}/{self.total_files}] "
+            f"{self.files / elapsed:.2f} 文件/s, {self.chunks / elapsed:.1f} 片段/s, {byte_rate / 1e6:.2f} MB/s, "
+            f"失败 {self.failed}, 预计剩余 {_format_seconds(eta)}"
+        )
+
+def _format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+# -----------------------------------------------------------
+# 5. 主流程
+# -----------------------------------------------------------
+def bulk_ingest(
+    root: str,
+    manifest_path: str = DEFAULT_MANIFEST,
+    workers: int = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    chunk_size: int = CHUNK_SIZE,
+    extensions=DEFAULT_EXTENSIONS,
+    retry_failed: bool = False,
+    index_name: str = INDEX_NAME,
+    scope: str = None,
+) -> Dict:
+    """:param scope: 全部文件导入的分区；不传时逐个按文件名识别 (见 partitions.py)"""
+    partitions.ingest_partition(scope, "")  # 提前校验分区键
+    manifest = Manifest(manifest_path)
+    file_catalog.ensure_catalog_index()
+
+    # 原件需要在 UPLOAD_DIR 下才能通过 /files 访问、被 GC 识别
+    copy_to_upload = os.path.abspath(root) != os.path.abspath(UPLOAD_DIR)
+
+    all_files = collect_files(root, extensions)
+    todo, seen_names = [], {}
+    for file_path in all_files:
+        if manifest.is_done(file_path, retry_failed):
+            continue
+        name = os.path.basename(file_path)
+        # 知识库以文件名区分文件，不同子目录下的同名文件只能导入一个
+        if name in seen_names:
+            print(f"⚠️ 跳过同名文件: {file_path} (与 {seen_names[name]} 重名)")
+            continue
+        seen_names[name] = file_path
+        todo.append(file_path)
+
+    print(f"📂 共 {len(all_files)} 个文件，已完成 {len(all_files) - len(todo)} 个，本次处理 {len(todo)} 个")
+    # 写了一半的文件即使已不在本次列表里也要清掉残留片段
+    purge_files(sorted(set(manifest.partial_names()) | set(seen_names)), index_name)
+    if not todo:
+        return {"files": 0, "chunks": 0, "failed": 0}
+
+    progress = Progress(len(todo), sum(os.path.getsize(p) for p in todo))
+
+    def on_file_done(file_path: str, result: Dict):
+        name = os.path.basename(file_path)
+        chunks = len(result["nodes"])
+        catalog_path = os.path.join(UPLOAD_DIR, name) if copy_to_upload else file_path
+        try:
+            file_catalog.upsert_file(
+                name, chunks=chunks, pages=result["pages"], file_path=catalog_path, refresh=False,
+                partition=result["partition"],
+            )
+        except ESError as e:
+            print(f"⚠️ 文件目录更新失败 (可稍后对账修复): {e}")
+        manifest.mark(file_path, "done", name=name, chunks=chunks, pages=result["pages"], partition=result["partition"], error=None)
+        manifest.save()
+        progress.update(os.path.getsize(file_path), chunks)
+        print(f"✅ {name}: {chunks} 个片段  {progress.line()}")
+
+    writer = BulkWriter(index_name, batch_size, on_file_done)
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    # spawn：主进程已加载 torch 和模型 (多线程)，fork 出的子进程可能卡在继承来的锁上
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        in_flight = deque()
+        queue = deque(todo)
+        while queue or in_flight:
+            # 限制同时在途的文件数，避免解析结果堆积占满内存
+            while queue and len(in_flight) < workers * 2:
+                file_path = queue.popleft()
+                name = os.path.basename(file_path)
+                partition = partitions.ingest_partition(scope, name)
+                in_flight.append((file_path, executor.submit(parse_file, file_path, name, chunk_size, partition)))
+
+            # 按提交顺序取结果，断点清单和写入顺序保持一致
+            file_path, future = in_flight.popleft()
+            name = os.path.basename(file_path)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"❌ {name} 解析失败: {type(e).__name__}: {e}")
+                manifest.mark(file_path, "failed", name=name, error=f"{type(e).__name__}: {e}")
+                manifest.save()
+                progress.update(os.path.getsize(file_path), failed=True)
+                continue
+
+            if copy_to_upload:
+                shutil.copy2(file_path, os.path.join(UPLOAD_DIR, name))
+            # 片段可能跨批写入，先标记为 partial，全部写完后由 on_file_done 标记为 done
+            manifest.mark(file_path, "partial", name=name)
+            manifest.save()
+            writer.add(file_path, result)
+
+        writer.flush()
+
+    elapsed = time.perf_counter() - progress.started
+    print(f"🎉 批量入库完成: {progress.files} 个文件, {progress.chunks} 个片段, 失败 {progress.failed}, 用时 {_format_seconds(elapsed)}")
+    return {"files": progress.files, "chunks": progress.chunks, "failed": progress.failed, "seconds": round(elapsed, 1)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量导入目录下的文档到知识库 (支持断点续传)")
+    parser.add_argument("directory", help="待导入的文档目录 (递归)")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="断点清单路径")
+    parser.add_argument("--workers", type=int, default=None, help="解析进程数，默认 CPU 核数 - 1")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="每批写入的片段数")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--extensions", default=",".join(DEFAULT_EXTENSIONS), help="逗号分隔的扩展名")
+    parser.add_argument("--retry-failed", action="store_true", help="重试上次解析失败的文件")
+    parser.add_argument("--scope", default=None, help="导入的分区 (见 partitions.json)，默认按文件名识别")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        print(f"目录不存在: {args.directory}")
+        sys.exit(1)
+
+    extensions = tuple(e.strip().lower() if e.strip().startswith(".") else "." + e.strip().lower()
+                       for e in args.extensions.split(",") if e.strip())
+    try:
+        bulk_ingest(
+            args.directory,
+            manifest_path=args.manifest,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            extensions=extensions,
+            retry_failed=args.retry_failed,
+            scope=args.scope,
+        )
+    except ValueError as e:
+        print(f"参数错误: {e}")
+        sys.exit(2)
+    except KeyboardInterrupt:
+        print("\n⏸️ 已中断，重新执行同一命令即可从断点继续")
+        sys.exit(130)
+
+if __name__ == "__main__":
+    main()
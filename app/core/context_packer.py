@@ -0,0 +1,207 @@
+# app/core/context_packer.py
+"""
+检索结果的上下文打包 (Context packing)
+
+search_factory_knowledge 拿到精排后的片段后，原来是原样拼接全部文本和图片发给大模型。
+相邻片段 (切片 overlap)、相邻页、重复的页眉/标题会让每次提示词都膨胀。这里在发送前做一次压缩：
+1. 同一文件中页码相邻/重叠的片段合并为一段，并去掉切片之间的重叠文字
+2. 跨片段去掉重复行 (页眉、重复标题、重复图片)，高分片段优先保留
+3. 按精排分数从高到低装入 token 预算和图片预算，超出部分截断/丢弃；分数最高的一段无论多长都会 (截断后) 保留
+4. 输出仍按“文件 -> 页码”排列，保持阅读顺序，并给出节省的 token 数
+"""
+
+import os
+import re
+from typing import List, Dict
+
+from app.core.layout_chunker import estimate_tokens
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_IMAGES = int(os.getenv("CONTEXT_MAX_IMAGES", "6"))
+
+MIN_OVERLAP_CHARS = 20    # 小于这个长度的首尾重合视为巧合，不当作切片重叠
+MIN_DEDUP_LINE_CHARS = 6  # 太短的行 (如“1.”、“注意：”) 不参与去重
+MIN_TRUNCATE_TOKENS = 80  # 剩余预算太小时不再截断塞入半段内容
+IMAGE_LINE_PATTERN = re.compile(r"!\[.*?\]\((.*?)\)")
+
+def _page_range(node: Dict) -> tuple:
+    start = int(node.get("page_label") or 0)
+    end = int(node.get("page_end") or start)
+    return start, max(start, end)
+
+def strip_overlap(prev: str, nxt: str, min_overlap: int = MIN_OVERLAP_CHARS) -> str:
+    """去掉 nxt 开头与 prev 结尾重合的部分 (切片器的 chunk_overlap)"""
+    probe = nxt[:min_overlap]
+    if len(probe) < min_overlap:
+        return nxt
+    pos = prev.find(probe)
+    while pos != -1:
+        tail = prev[pos:]
+        if nxt.startswith(tail):
+            return nxt[len(tail):]
+        pos = prev.find(probe, pos + 1)
+    # 后一段被前一段完整包含
+    if nxt in prev:
+        return ""
+    return nxt
+
+# -----------------------------------------------------------
+# 1. 合并相邻片段
+# -----------------------------------------------------------
+def merge_adjacent(nodes: List[Dict]) -> List[Dict]:
+    """
+    nodes: [{"text", "file_name", "page_label", "page_end", "chunk_index", "heading_path", "score"}]
+    同一文件内页码重叠或相邻的片段合并为一组，组分数取组内最高分。
+    """
+    by_file: Dict[str, List[Dict]] = {}
+    for node in nodes:
+        by_file.setdefault(node["file_name"], []).append(node)
+
+    groups = []
+    for file_name, file_nodes in by_file.items():
+        file_nodes.sort(key=lambda n: (_page_range(n)[0], n.get("chunk_index") or 0))
+        current = None
+        for node in file_nodes:
+            start, end = _page_range(node)
+            if current is not None and start <= current["page_end"] + 1:
+                current["text"] += "\n" + strip_overlap(current["text"], node["text"])
+                current["page_end"] = max(current["page_end"], end)
+                current["score"] = max(current["score"], node.get("score") or 0.0)
+                if node.get("heading_path") and node["heading_path"] not in current["heading_paths"]:
+                    current["heading_paths"].append(node["heading_path"])
+                current["merged"] += 1
+                continue
+            current = {
+                "file_name": file_name,
+                "page_start": start,
+                "page_end": end,
+                "text": node["text"],
+                "score": node.get("score") or 0.0,
+                "heading_paths": [node["heading_path"]] if node.get("heading_path") else [],
+                "merged": 1,
+            }
+            groups.append(current)
+    return groups
+
+# -----------------------------------------------------------
+# 2. 去重 + 预算
+# -----------------------------------------------------------
+def _normalize_line(line: str) -> str:
+    return re.sub(r"\s+", "", line)
+
+def _dedupe_lines(text: str, seen: set) -> tuple:
+    """去掉已出现过的行，返回 (新文本, 本段新增的行指纹)；段落最终被采用后再并入 seen"""
+    kept, added = [], set()
+    for line in text.splitlines():
+        key = _normalize_line(line)
+        if len(key) >= MIN_DEDUP_LINE_CHARS or IMAGE_LINE_PATTERN.search(line):
+            if key in seen or key in added:
+                continue
+            added.add(key)
+        kept.append(line)
+    # 合并多余空行
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(kept)).strip(), added
+
+def _apply_image_budget(text: str, remaining_images: int) -> tuple:
+    """
+    超出图片预算的图片链接直接去掉，返回 (新文本, 保留的图片数, 丢弃的图片数)。
+    按链接计数：一行里有多张图时只去掉超出预算的那几张，去掉后只剩空白的行整行删除。
+    """
+    kept, dropped = 0, 0
+
+    def keep_or_drop(match) -> str:
+        nonlocal kept, dropped
+        if kept < remaining_images:
+            kept += 1
+            return match.group(0)
+        dropped += 1
+        return ""
+
+    lines = []
+    for line in text.splitlines():
+        if IMAGE_LINE_PATTERN.search(line):
+            line = IMAGE_LINE_PATTERN.sub(keep_or_drop, line).rstrip()
+            if not line.strip():
+                continue
+        lines.append(line)
+    return "\n".join(lines), kept, dropped
+
+def _cut_line(line: str, budget: int) -> str:
+    """单行超出预算时按字符截取能装下的最长前缀 (二分查找)"""
+    low, high = 0, len(line)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(line[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return line[:low]
+
+def _truncate_to_tokens(text: str, budget: int) -> str:
+    lines, used = [], 0
+    for line in text.splitlines():
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            # 第一行就放不下 (没有换行的长段落) 时截断这一行，不返回空文本；图片链接截断后无法显示，不截
+            if not lines and not IMAGE_LINE_PATTERN.search(line):
+                lines.append(_cut_line(line, budget - 1))
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
+
+def pack_context(nodes: List[Dict], token_budget: int = None, max_images: int = None) -> Dict:
+    """
+    :param nodes: 按精排分数从高到低排列的片段
+    :return: {"groups": [按文件/页码排列的段落], "stats": {...}}
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    max_images = CONTEXT_MAX_IMAGES if max_images is None else max_images
+
+    raw_tokens = sum(estimate_tokens(n["text"]) for n in nodes)
+    raw_images = sum(len(IMAGE_LINE_PATTERN.findall(n["text"])) for n in nodes)
+
+    groups = sorted(merge_adjacent(nodes), key=lambda g: g["score"], reverse=True)
+
+    seen_lines, packed = set(), []
+    used_tokens, used_images, dropped_images, truncated = 0, 0, 0, 0
+    for group in groups:
+        text, added_lines = _dedupe_lines(group["text"], seen_lines)
+        if not text:
+            continue
+        text, kept, dropped = _apply_image_budget(text, max_images - used_images)
+
+        remaining = token_budget - used_tokens
+        if not packed:
+            # 分数最高的一段总要保留，否则预算很小或首段很长时大模型拿到的是空上下文
+            remaining = max(remaining, MIN_TRUNCATE_TOKENS)
+        cost = estimate_tokens(text)
+        if cost > remaining:
+            if remaining < MIN_TRUNCATE_TOKENS:
+                dropped_images += kept + dropped
+                continue
+            text = _truncate_to_tokens(text, remaining)
+            truncated += 1
+            cost = estimate_tokens(text)
+            dropped += kept - len(IMAGE_LINE_PATTERN.findall(text))
+            kept = len(IMAGE_LINE_PATTERN.findall(text))
+            _, added_lines = _dedupe_lines(text, seen_lines)
+        seen_lines |= added_lines
+        dropped_images += dropped
+        used_tokens += cost
+        used_images += kept
+        packed.append(dict(group, text=text, tokens=cost))
+
+    packed.sort(key=lambda g: (g["file_name"], g["page_start"]))
+    stats = {
+        "nodes_in": len(nodes),
+        "groups_out": len(packed),
+        "tokens_in": raw_tokens,
+        "tokens_out": used_tokens,
+        "tokens_saved": max(0, raw_tokens - used_tokens),
+        "images_in": raw_images,
+        "images_out": used_images,
+        "images_dropped": dropped_images,
+        "truncated_groups": truncated,
+    }
+    return {"groups": packed, "stats": stats}
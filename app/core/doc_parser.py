@@ -0,0 +1,210 @@
+# app/core/doc_parser.py
+"""
+文档解析与切片 (不依赖向量模型)
+
+从 kb_manager 拆出：批量入库 (bulk_ingest) 的解析子进程以 spawn 方式启动，只导入本模块，
+不会在每个子进程里重新加载 Embedding / 精排模型；在线入库仍通过 kb_manager 使用这些函数。
+"""
+
+import os
+import fitz  # PyMuPDF
+from typing import List, Dict, Optional
+from llama_index.core import Document, SimpleDirectoryReader
+from llama_index.core.node_parser import SentenceSplitter
+from app.core import media, partitions
+from app.core.layout_chunker import chunk_layout_items
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "512"))
+# 版面感知切片：按标题/步骤切分，图片跟随所属步骤 (关闭则回退为按页 + 定长切片)
+LAYOUT_CHUNKING = os.getenv("LAYOUT_CHUNKING", "true").lower() == "true"
+LAYOUT_EXCLUDED_EMBED_KEYS = ["page_end", "chunk_index", "has_images", "chunker"]
+IMAGES_DIR = "./factory_images"
+API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
+
+os.makedirs(IMAGES_DIR, exist_ok=True)
+
+# -----------------------------------------------------------
+# 1. 核心算法：按坐标提取图文，保持顺序
+# -----------------------------------------------------------
+def extract_page_items(doc, page, page_index: int, base_name: str) -> List[Dict]:
+    """
+    使用 PyMuPDF 获取单页上的文字块和图片块，并根据 Y 轴坐标进行混合排序。
+    图片会保存到 IMAGES_DIR，并以 Markdown 图片链接的形式放在对应位置。
+    """
+    # 1. 获取所有图片对象
+    image_list = page.get_images(full=True)
+    page_items = [] # 用于存放 (Y坐标, 内容字符串) 的临时列表
+
+    # --- A. 处理图片 ---
+    for img_index, img in enumerate(image_list):
+        xref = img[0]
+        # 获取图片在页面上的坐标 (Rect)
+        # 注意：如果一张图被复用多次，get_image_rects 会返回多个位置，这里简化取第一个
+        rects = page.get_image_rects(xref)
+        if not rects: 
+            continue
+        
+        # 这里的 y1 (底部坐标) 通常用于决定图片是在某段文字之后
+        # 我们用 y0 (顶部坐标) 也可以，视排版而定，通常 y0 更符合“读到这里看到了图”
+        y_pos = rects[0].y1 
+        
+        # 提取图片并保存到本地
+        base_image = doc.extract_image(xref)
+        image_bytes = base_image["image"]
+        image_ext = base_image["ext"]
+        
+        # 文件名：文件名_p页码_索引.png
+        image_filename = f"{base_name}_p{page_index+1}_{img_index}.{image_ext}"
+        image_path = os.path.join(IMAGES_DIR, image_filename)
+        
+        with open(image_path, "wb") as f:
+            f.write(image_bytes)
+        # 生成 WebP / 缩略图，分发时按浏览器 Accept 头选择
+        media.generate_variants(image_path, IMAGES_DIR)
+        
+        # 构造 Markdown 图片链接
+        # 这里直接生成 URL，稍后拼接到文本里；?v= 为内容版本号，浏览器可以长期缓存
+        img_url = f"{API_BASE_URL}/images/{image_filename}?v={media.content_version(image_bytes)}"
+        markdown_img = f"\n\n![示意图]({img_url})\n\n"
+        
+        # 存入列表: (坐标, 类型, 内容)
+        page_items.append({
+            "page": page_index + 1,
+            "y": y_pos,
+            "type": "image",
+            "content": markdown_img,
+            "image": image_filename
+        })
+
+    # --- B. 处理文字 ---
+    # get_text("dict") 比 "blocks" 多给出字号和粗体信息，版面切片靠它识别标题
+    for block in page.get_text("dict")["blocks"]:
+        # type == 0 代表这是文字块 (1是图片块，但PyMuPDF的图片块往往不准，所以我们上面单独处理了图片)
+        if block.get("type") != 0:
+            continue
+        lines, sizes, bold = [], [], True
+        for line in block["lines"]:
+            lines.append("".join(span["text"] for span in line["spans"]))
+            for span in line["spans"]:
+                if span["text"].strip():
+                    sizes.append(span["size"])
+                    bold = bold and bool(span["flags"] & 16)
+        text_content = "\n".join(lines).strip()
+        if text_content:
+            page_items.append({
+                "page": page_index + 1,
+                "y": block["bbox"][3], # 使用 y1 (底部) 作为排序依据
+                "type": "text",
+                "content": text_content,
+                "size": max(sizes) if sizes else 0,
+                "bold": bold and bool(sizes)
+            })
+
+    # --- C. 核心：按 Y 轴坐标排序 ---
+    # 这样就能保证：上面的文字 -> 中间的图 -> 下面的文字
+    page_items.sort(key=lambda x: x["y"])
+    return page_items
+
+def parse_pdf_with_layout(pdf_path: str, file_name: str, chunk_size: int = CHUNK_SIZE) -> List[Document]:
+    """
+    按坐标提取图文并保持顺序。
+    LAYOUT_CHUNKING 开启时 (默认) 按标题/步骤切成自包含片段，图片跟随所属步骤；
+    关闭时沿用旧逻辑，每页一个 Document，再交给通用切片器。
+    """
+    doc = fitz.open(pdf_path)
+    base_name = os.path.splitext(file_name)[0]
+
+    print(f"📄 开始进行图文混排解析: {file_name}")
+
+    all_items = []
+    for page_index, page in enumerate(doc):
+        all_items.extend(extract_page_items(doc, page, page_index, base_name))
+
+    if LAYOUT_CHUNKING:
+        llama_documents = []
+        for chunk_index, chunk in enumerate(chunk_layout_items(all_items, target_tokens=chunk_size)):
+            doc_obj = Document(text=chunk["text"])
+            doc_obj.metadata = {
+                "file_name": file_name,
+                "page_label": str(chunk["page_start"]),
+                "page_end": str(chunk["page_end"]),
+                "heading_path": " > ".join(chunk["heading_path"]),
+                "chunk_index": chunk_index,
+                "has_images": bool(chunk["images"]),
+                "chunker": "layout"
+            }
+            # 标题路径参与向量化 (帮助区分不同设备的同名步骤)，其余字段只做检索后的排序/展示
+            doc_obj.excluded_embed_metadata_keys = LAYOUT_EXCLUDED_EMBED_KEYS
+            doc_obj.excluded_llm_metadata_keys = LAYOUT_EXCLUDED_EMBED_KEYS
+            llama_documents.append(doc_obj)
+        print(f"✅ 解析完成，共 {len(doc)} 页，版面切片 {len(llama_documents)} 个")
+        return llama_documents
+
+    # --- 旧逻辑：按页拼接成最终文本 ---
+    llama_documents = []
+    for page_index in range(len(doc)):
+        page_items = [item for item in all_items if item["page"] == page_index + 1]
+        final_page_text = ""
+        for item in page_items:
+            final_page_text += item["content"] + "\n"
+
+        doc_obj = Document(text=final_page_text)
+        doc_obj.metadata = {
+            "file_name": file_name,
+            "page_label": str(page_index + 1),
+            # 这里虽然我们在text里已经嵌入了图片，但metadata里留个底也是好的
+            "has_images": any(item["type"] == "image" for item in page_items)
+        }
+        llama_documents.append(doc_obj)
+
+    print(f"✅ 解析完成，共 {len(llama_documents)} 页")
+    return llama_documents
+
+# -----------------------------------------------------------
+# 2. 切片
+# -----------------------------------------------------------
+def count_pages(documents: List[Document]) -> int:
+    """统计文档覆盖的页数 (版面切片的片段可能跨页：page_label ~ page_end)"""
+    pages = set()
+    for doc in documents:
+        start = int(doc.metadata.get("page_label", 1))
+        end = int(doc.metadata.get("page_end", start))
+        pages.update(range(start, end + 1))
+    return len(pages)
+
+def load_documents(file_path: str, original_filename: str, chunk_size: int = CHUNK_SIZE) -> List[Document]:
+    """解析本地文件为 Document 列表 (PDF 走图文混排解析，其余走 SimpleDirectoryReader)"""
+    if original_filename.lower().endswith(".pdf"):
+        return parse_pdf_with_layout(file_path, original_filename, chunk_size=chunk_size)
+
+    # 对于 txt, md, docx 等，使用 SimpleDirectoryReader
+    documents = SimpleDirectoryReader(input_files=[file_path]).load_data()
+    # 确保 metadata 里有文件名
+    for doc in documents:
+        doc.metadata["file_name"] = original_filename
+        doc.metadata["page_label"] = "1" # 非PDF默认为第1页
+    return documents
+
+def build_nodes(documents: List[Document], chunk_size: int = CHUNK_SIZE) -> list:
+    """版面切片产出的片段已经是自包含的，不再二次切分；其余文档走定长切片"""
+    nodes = [doc for doc in documents if doc.metadata.get("chunker") == "layout"]
+    to_split = [doc for doc in documents if doc.metadata.get("chunker") != "layout"]
+    nodes += SentenceSplitter(chunk_size=chunk_size).get_nodes_from_documents(to_split)
+    return nodes
+
+def tag_partition(documents: List[Document], partition: Optional[str]):
+    """给文档打上分区键 (只用于过滤/展示，不参与向量化，也不发给大模型)"""
+    for doc in documents:
+        doc.metadata["partition"] = partition
+        doc.excluded_embed_metadata_keys = list(set(doc.excluded_embed_metadata_keys) | {"partition"})
+        doc.excluded_llm_metadata_keys = list(set(doc.excluded_llm_metadata_keys) | {"partition"})
+
+def parse_file(file_path: str, name: str, chunk_size: int, partition: str) -> Dict:
+    """解析并切片，返回可序列化的片段列表 (bulk_ingest 的子进程入口，必须是模块级函数)"""
+    documents = load_documents(file_path, name, chunk_size=chunk_size)
+    if partition != partitions.GENERAL:
+        tag_partition(documents, partition)
+    return {"nodes": build_nodes(documents, chunk_size), "pages": count_pages(documents), "partition": partition}
@@ -0,0 +1,106 @@
+# app/core/es_client.py
+"""
+管理类 Elasticsearch 调用的共享 HTTP 客户端。
+
+文件列表、删除、目录维护等管理接口都通过这里访问 ES：
+- 复用同一个 requests.Session (连接池)，避免每次请求重新建 TCP 连接
+- 统一的连接/读取超时，避免 ES 卡住时把接口一起拖死
+- 非 2xx 响应统一抛出 ESError，调用方不再把错误静默吞成空列表
+"""
+
+import os
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+ES_URL = os.getenv("ELASTICSEARCH_URL", "http://elasticsearch:9200")
+INDEX_NAME = "factory_knowledge"
+ES_CONNECT_TIMEOUT = float(os.getenv("ES_CONNECT_TIMEOUT", "3"))
+ES_READ_TIMEOUT = float(os.getenv("ES_READ_TIMEOUT", "30"))
+ES_POOL_SIZE = int(os.getenv("ES_POOL_SIZE", "20"))
+
+class ESError(Exception):
+    """ES 请求失败 (网络错误或非 2xx 响应)"""
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """进程内共享的连接池会话 (懒加载，线程安全)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # 只对幂等的读请求做少量重试，写请求交给调用方决定
+                retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET", "HEAD"])
+                adapter = HTTPAdapter(pool_connections=ES_POOL_SIZE, pool_maxsize=ES_POOL_SIZE, max_retries=retry)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+def es_request(method: str, path: str, body: dict = None, params: dict = None, timeout: float = None, ignore: tuple = ()) -> dict:
+    """
+    发送一个 ES 请求并返回解析后的 JSON。
+    :param path: 以 / 开头的路径，例如 /factory_knowledge/_search
+    :param ignore: 视为正常返回的状态码 (例如 404)，此时返回 {"status": code}
+    """
+    url = f"{ES_URL}{path}"
+    try:
+        response = get_session().request(
+            method,
+            url,
+            json=body,
+            params=params,
+            timeout=(ES_CONNECT_TIMEOUT, timeout or ES_READ_TIMEOUT),
+        )
+    except requests.RequestException as e:
+        raise ESError(f"ES 请求失败 {method} {path}: {e}") from e
+
+    if response.status_code in ignore:
+        return {"status": response.status_code}
+    if not response.ok:
+        raise ESError(f"ES 返回 {response.status_code} {method} {path}: {response.text[:500]}", response.status_code)
+    if method.upper() == "HEAD" or not response.content:
+        return {"status": response.status_code}
+    return response.json()
+
+def index_exists(index_name: str) -> bool:
+    return es_request("HEAD", f"/{index_name}", ignore=(404,))["status"] == 200
+
+def es_msearch(index_name: str, bodies: list, timeout: float = None) -> list:
+    """
+    一次请求执行多个查询 (_msearch，NDJSON 格式)，按顺序返回每个查询的响应。
+    任一子查询失败都抛出 ESError，调用方不必逐条检查。
+    """
+    lines = []
+    for body in bodies:
+        lines.append(json.dumps({"index": index_name}))
+        lines.append(json.dumps(body, ensure_ascii=False))
+    try:
+        response = get_session().post(
+            f"{ES_URL}/_msearch",
+            data=("\n".join(lines) + "\n").encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"},
+            timeout=(ES_CONNECT_TIMEOUT, timeout or ES_READ_TIMEOUT),
+        )
+    except requests.RequestException as e:
+        raise ESError(f"ES 请求失败 POST /_msearch: {e}") from e
+    if not response.ok:
+        raise ESError(f"ES 返回 {response.status_code} POST /_msearch: {response.text[:500]}", response.status_code)
+
+    results = response.json()["responses"]
+    for result in results:
+        if "error" in result:
+            raise ESError(f"_msearch 子查询失败: {json.dumps(result['error'], ensure_ascii=False)[:500]}", result.get("status"))
+    return results
@@ -0,0 +1,272 @@
+# app/core/file_catalog.py
+"""
+知识库文件目录 (catalog)
+
+每个入库文件在独立的 ES 索引里保存一条目录记录：
+    name / chunks / pages / size / ingested_at / content_hash / partition
+入库、删除时同步维护；列表接口按文件名游标分页读取目录，不再每次对整个知识库做聚合。
+rebuild_catalog() 用 composite 聚合遍历知识库全部文件，用于与实际数据对账。
+VECTOR_BACKEND=mmap 时目录保存在 mmap 向量库的 SQLite 里 (见 mmap_store.py)，接口不变、不依赖 ES。
+"""
+
+import os
+import json
+import base64
+import hashlib
+import datetime
+from typing import List, Dict, Optional
+from urllib.parse import quote
+
+from app.core.es_client import es_request, index_exists, INDEX_NAME
+
+CATALOG_INDEX = os.getenv("CATALOG_INDEX", "factory_file_catalog")
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+CATALOG_MAPPING = {
+    "mappings": {
+        "properties": {
+            "name": {"type": "keyword"},
+            "chunks": {"type": "integer"},
+            "pages": {"type": "integer"},
+            "size": {"type": "long"},
+            "ingested_at": {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"},
+            "content_hash": {"type": "keyword"},
+            "partition": {"type": "keyword"},
+        }
+    }
+}
+
+def _doc_path(name: str) -> str:
+    # 文件名可能包含中文、空格、斜杠，作为文档 ID 时需要整体转义
+    return f"/{CATALOG_INDEX}/_doc/{quote(name, safe='')}"
+
+def _mmap_store(index_name: str = INDEX_NAME):
+    """mmap 后端时返回对应的向量库，否则 None"""
+    from app.core import mmap_store
+    if not mmap_store.enabled():
+        return None
+    return mmap_store.get_store(mmap_store.resolve_target(index_name)[0])
+
+def ensure_catalog_index():
+    if _mmap_store():
+        return
+    if not index_exists(CATALOG_INDEX):
+        es_request("PUT", f"/{CATALOG_INDEX}", CATALOG_MAPPING, ignore=(400,))  # 400: 并发创建时已存在
+
+def file_sha256(file_path: str) -> Optional[str]:
+    if not os.path.exists(file_path):
+        return None
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _now() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# -----------------------------------------------------------
+# 1. 入库 / 删除时维护
+# -----------------------------------------------------------
+def upsert_file(
+    name: str,
+    chunks: int,
+    pages: int,
+    file_path: str = None,
+    ingested_at: str = None,
+    refresh: bool = True,
+    partition: str = None,
+):
+    if refresh:
+        ensure_catalog_index()
+    record = {
+        "name": name,
+        "chunks": chunks,
+        "pages": pages,
+        "size": os.path.getsize(file_path) if file_path and os.path.exists(file_path) else None,
+        "ingested_at": ingested_at or _now(),
+        "content_hash": file_sha256(file_path) if file_path else None,
+        "partition": partition or "general",
+    }
+    store = _mmap_store()
+    if store:
+        store.upsert_file_record(record)
+        return record
+    es_request("PUT", _doc_path(name), record, params={"refresh": "wait_for"} if refresh else None)
+    return record
+
+def remove_file(name: str):
+    store = _mmap_store()
+    if store:
+        store.remove_file_record(name)
+        return
+    es_request("DELETE", _doc_path(name), params={"refresh": "wait_for"}, ignore=(404,))
+
+def get_file(name: str) -> Optional[Dict]:
+    store = _mmap_store()
+    if store:
+        return store.get_file_record(name)
+    result = es_request("GET", _doc_path(name), ignore=(404,))
+    return result.get("_source")
+
+def has_file(name: str) -> bool:
+    """文件是否仍在知识库中 (删除时目录记录同步移除，比片段数据更早反映删除)"""
+    store = _mmap_store()
+    if store:
+        # mmap 后端删除同步完成，直接看片段
+        return store.count_file(name) > 0
+    if not index_exists(CATALOG_INDEX):
+        # 旧数据还没有目录时按片段数据判断
+        body = {"query": {"term": {"metadata.file_name.keyword": name}}}
+        return es_request("POST", f"/{INDEX_NAME}/_count", body, ignore=(404,)).get("count", 0) > 0
+    return get_file(name) is not None
+
+# -----------------------------------------------------------
+# 2. 游标分页读取
+# -----------------------------------------------------------
+def _encode_cursor(sort_values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(sort_values, ensure_ascii=False).encode("utf-8")).decode("ascii")
+
+def _decode_cursor(cursor: str) -> list:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+def list_files(limit: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> Dict:
+    """
+    按文件名排序分页读取目录。
+    :return: {"files": [...], "next_cursor": str | None, "total": int}
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    store = _mmap_store()
+    if store:
+        after = _decode_cursor(cursor)[0] if cursor else None
+        files, total = store.list_file_records(limit, after)
+        if not total and store.exists():
+            # 从 ES 导入 (import-es) 后目录还是空的，从片段数据重建一次
+            rebuild_catalog()
+            files, total = store.list_file_records(limit, after)
+        next_cursor = _encode_cursor([files[-1]["name"]]) if len(files) == limit else None
+        return {"files": files, "next_cursor": next_cursor, "total": total}
+    if not index_exists(CATALOG_INDEX):
+        # 第一次使用 (旧数据还没有目录) 时从知识库重建一次
+        rebuild_catalog()
+
+    body = {
+        "size": limit,
+        "sort": [{"name": "asc"}],
+        "track_total_hits": True,
+    }
+    if cursor:
+        body["search_after"] = _decode_cursor(cursor)
+
+    result = es_request("POST", f"/{CATALOG_INDEX}/_search", body)
+    hits = result.get("hits", {}).get("hits", [])
+    files = [hit["_source"] for hit in hits]
+    next_cursor = _encode_cursor(hits[-1]["sort"]) if len(hits) == limit else None
+    return {
+        "files": files,
+        "next_cursor": next_cursor,
+        "total": result.get("hits", {}).get("total", {}).get("value", len(files)),
+    }
+
+# -----------------------------------------------------------
+# 3. 对账重建
+# -----------------------------------------------------------
+def iter_indexed_files(index_name: str = INDEX_NAME, batch_size: int = 500):
+    """用 composite 聚合遍历知识库中的全部文件 (不受 terms 聚合 size 上限影响)"""
+    store = _mmap_store(index_name)
+    if store:
+        yield from store.indexed_files()
+        return
+    after_key = None
+    while True:
+        composite = {
+            "size": batch_size,
+            "sources": [{"name": {"terms": {"field": "metadata.file_name.keyword"}}}],
+        }
+        if after_key:
+            composite["after"] = after_key
+        body = {
+            "size": 0,
+            "aggs": {
+                "files": {
+                    "composite": composite,
+                    "aggs": {
+                        "pages": {"cardinality": {"field": "metadata.page_label.keyword"}},
+                        # 分区作为子聚合而不是 composite 的第二个维度，否则同一文件按分区拆成多条；
+                        # general 分区的片段没有 partition 字段
+                        "partition": {"terms": {"field": "metadata.partition", "missing": "general", "size": 1}},
+                    },
+                }
+            },
+        }
+        result = es_request("POST", f"/{index_name}/_search", body, ignore=(404,))
+        agg = result.get("aggregations", {}).get("files", {})
+        for bucket in agg.get("buckets", []):
+            partition_buckets = bucket["partition"]["buckets"]
+            yield {
+                "name": bucket["key"]["name"],
+                "partition": partition_buckets[0]["key"] if partition_buckets else "general",
+                "chunks": bucket["doc_count"],
+                "pages": bucket["pages"]["value"],
+            }
+        after_key = agg.get("after_key")
+        if not after_key or not agg.get("buckets"):
+            break
+
+def _existing_records() -> Dict[str, Dict]:
+    """现有目录记录：name -> 记录"""
+    existing, after = {}, None
+    store = _mmap_store()
+    while True:
+        if store:
+            records, _ = store.list_file_records(1000, after)
+            after = records[-1]["name"] if records else None
+        else:
+            body = {"size": 1000, "sort": [{"name": "asc"}], "_source": ["name", "ingested_at"]}
+            if after:
+                body["search_after"] = after
+            hits = es_request("POST", f"/{CATALOG_INDEX}/_search", body).get("hits", {}).get("hits", [])
+            records = [hit["_source"] for hit in hits]
+            after = hits[-1]["sort"] if hits else None
+        existing.update((record["name"], record) for record in records)
+        if len(records) < 1000:
+            return existing
+
+def rebuild_catalog(upload_dir: str = "./factory_docs") -> Dict:
+    """
+    以知识库实际数据为准重建目录：补齐缺失记录、更新片段数、删除已不存在的文件。
+    已有记录的入库时间保留；大小与哈希从 upload_dir 中的原文件重新计算。
+    """
+    ensure_catalog_index()
+    print("🔄 [目录对账] 开始从知识库重建文件目录...")
+
+    existing = _existing_records()
+
+    seen = set()
+    for entry in iter_indexed_files():
+        name = entry["name"]
+        seen.add(name)
+        old = existing.get(name, {})
+        upsert_file(
+            name,
+            chunks=entry["chunks"],
+            pages=entry["pages"],
+            file_path=os.path.join(upload_dir, name),
+            ingested_at=old.get("ingested_at"),
+            refresh=False,
+            partition=entry["partition"],
+        )
+
+    stale = [name for name in existing if name not in seen]
+    for name in stale:
+        remove_file(name)
+    if not _mmap_store():
+        es_request("POST", f"/{CATALOG_INDEX}/_refresh")
+
+    summary = {"files": len(seen), "added": len(seen - set(existing)), "removed": len(stale)}
+    print(f"✅ [目录对账] 完成: {summary}")
+    return summary
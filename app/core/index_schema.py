@@ -0,0 +1,350 @@
+# app/core/index_schema.py
+"""
+知识库索引的显式 Mapping 与迁移
+
+原来 factory_knowledge 由 ElasticsearchStore 在第一次写入时按默认设置隐式创建：
+1024 维 float 向量 + 默认 HNSW，metadata 全部走动态映射 (连 _node_content 这种大 JSON 串都建了全文索引)。
+ES 容器只有 512MB 堆，知识库一大就吃不消。这里改为由服务自己创建和管理索引：
+- 向量使用 int8 量化 HNSW (int8_hnsw)，HNSW 需要常驻内存的向量数据约为 float 的 1/4
+- m / ef_construction 可通过环境变量调整；查询时的 num_candidates 也可配置
+- file_name / page_label 为 keyword (保留 .keyword 子字段，LlamaIndex 元数据过滤和现有查询都用它)
+- _node_content 等只存储不索引
+
+实际索引名带版本号 (factory_knowledge_v{时间戳})，对外通过同名别名 factory_knowledge 访问，
+迁移时后台 _reindex 到新索引，校验数量一致后原子切换别名。
+
+用法：
+    python -m app.core.index_schema status
+    python -m app.core.index_schema migrate [--keep-old] [--samples 50]
+    python -m app.core.index_schema benchmark factory_knowledge_v1 factory_knowledge_v2
+"""
+
+import os
+import sys
+import time
+import argparse
+import datetime
+from typing import Dict, List, Optional
+
+from app.core.es_client import es_request, index_exists, ESError, INDEX_NAME
+
+VECTOR_DIMS = int(os.getenv("ES_VECTOR_DIMS", "1024"))  # bge-m3
+VECTOR_INDEX_TYPE = os.getenv("ES_VECTOR_INDEX_TYPE", "int8_hnsw")
+# m: 每个节点的邻居数，越大召回越好、内存越多；ef_construction: 建图时的候选数，只影响入库速度和图质量
+HNSW_M = int(os.getenv("ES_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("ES_HNSW_EF_CONSTRUCTION", "128"))
+# 查询时每个分片考察的候选数 (LlamaIndex 默认固定为 top_k * 10)
+NUM_CANDIDATES = int(os.getenv("ES_NUM_CANDIDATES", "100"))
+MIGRATE_POLL_INTERVAL = 2
+
+SCHEMA_VERSION = 2  # 写入 _meta，用于判断索引是否由本模块创建
+
+def knowledge_index_body() -> Dict:
+    return {
+        "settings": {
+            "number_of_shards": 1,
+            "number_of_replicas": 0,  # 单节点部署，副本无法分配
+            "refresh_interval": "1s",
+        },
+        "mappings": {
+            "_meta": {"managed_by": "factory_agent", "schema_version": SCHEMA_VERSION},
+            "dynamic_templates": [
+                # 其余元数据 (如 DOCX 解析出的 file_path) 只做精确匹配，不建全文索引
+                {"strings_as_keyword": {
+                    "match_mapping_type": "string",
+                    "mapping": {"type": "keyword", "ignore_above": 256},
+                }},
+            ],
+            "properties": {
+                "content": {"type": "text"},
+                "embedding": {
+                    "type": "dense_vector",
+                    "dims": VECTOR_DIMS,
+                    "index": True,
+                    "similarity": "cosine",
+                    "index_options": {"type": VECTOR_INDEX_TYPE, "m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION},
+                },
+                "metadata": {
+                    "properties": {
+                        "file_name": {"type": "keyword", "fields": {"keyword": {"type": "keyword"}}},
+                        "page_label": {"type": "keyword", "fields": {"keyword": {"type": "keyword"}}},
+                        "page_end": {"type": "keyword"},
+                        "chunk_index": {"type": "integer"},
+                        "heading_path": {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 512}}},
+                        "has_images": {"type": "boolean"},
+                        "chunker": {"type": "keyword"},
+                        "partition": {"type": "keyword"},
+                        "document_id": {"type": "keyword"},
+                        "doc_id": {"type": "keyword"},
+                        "ref_doc_id": {"type": "keyword"},
+                        # LlamaIndex 用来还原节点的序列化 JSON，只需要存储
+                        "_node_content": {"type": "text", "index": False},
+                        "_node_type": {"type": "keyword", "index": False, "doc_values": False},
+                    }
+                },
+            },
+        },
+    }
+
+# -----------------------------------------------------------
+# 1. 索引 / 别名管理
+# -----------------------------------------------------------
+def versioned_name(alias: str) -> str:
+    return f"{alias}_v{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+def resolve_index(name: str) -> Optional[str]:
+    """别名 -> 实际索引名；name 本身就是索引时原样返回；不存在返回 None"""
+    result = es_request("GET", f"/_alias/{name}", ignore=(404,))
+    if result.get("status") == 404:
+        return name if index_exists(name) else None
+    # 别名覆盖多个索引时 (各分区索引也挂在 factory_knowledge 下，见 partitions.py) 取写入索引
+    for index, info in result.items():
+        if info.get("aliases", {}).get(name, {}).get("is_write_index"):
+            return index
+    return next(iter(result))
+
+def is_managed(index_name: str) -> bool:
+    mapping = es_request("GET", f"/{index_name}/_mapping")
+    meta = next(iter(mapping.values()))["mappings"].get("_meta", {})
+    return meta.get("managed_by") == "factory_agent"
+
+def create_index(physical_name: str, alias: str = None, read_aliases: tuple = ()):
+    """alias 为写入别名；read_aliases 只用于检索 (例如分区索引同时挂在 factory_knowledge 下)"""
+    body = knowledge_index_body()
+    aliases = {name: {"is_write_index": False} for name in read_aliases}
+    if alias:
+        aliases[alias] = {"is_write_index": True}
+    if aliases:
+        body["aliases"] = aliases
+    es_request("PUT", f"/{physical_name}", body)
+
+_ensured = set()
+
+def ensure_knowledge_index(alias: str = INDEX_NAME):
+    """
+    写入前调用：索引不存在时按显式 Mapping 创建 (实际索引 + 同名别名)。
+    已存在的旧索引不做改动，启动时提示执行迁移。
+    """
+    if alias in _ensured:
+        return
+    if not index_exists(alias):
+        physical = versioned_name(alias)
+        create_index(physical, alias)
+        print(f"🗂️ 已创建知识库索引 {physical} (别名 {alias}, {VECTOR_INDEX_TYPE}, m={HNSW_M}, ef_construction={HNSW_EF_CONSTRUCTION})")
+    elif not is_managed(resolve_index(alias)):
+        print(f"⚠️ 索引 {alias} 使用的是默认 Mapping (float 向量)，建议执行: python -m app.core.index_schema migrate")
+    _ensured.add(alias)
+
+def drop_index(alias: str):
+    """删除别名背后的实际索引 (评测索引重建时使用)"""
+    physical = resolve_index(alias)
+    if physical:
+        es_request("DELETE", f"/{physical}", ignore=(404,))
+    _ensured.discard(alias)
+
+def tune_knn_query(query_body: Dict, query: str = None) -> Dict:
+    """
+    作为 ElasticsearchStore 的 custom_query 使用：把 knn 的 num_candidates 改为配置值。
+    量化向量的近似误差靠更多候选弥补，ES_NUM_CANDIDATES 是召回与延迟之间的主要调节旋钮。
+    """
+    knn = query_body.get("knn")
+    for clause in knn if isinstance(knn, list) else [knn] if knn else []:
+        clause["num_candidates"] = max(NUM_CANDIDATES, clause.get("k", 0))
+    return query_body
+
+# -----------------------------------------------------------
+# 2. 内存估算 / 基准测试
+# -----------------------------------------------------------
+def index_stats(index_name: str) -> Dict:
+    physical = resolve_index(index_name)
+    stats = es_request("GET", f"/{physical}/_stats/docs,store")["_all"]["primaries"]
+    mapping = es_request("GET", f"/{physical}/_mapping")
+    props = next(iter(mapping.values()))["mappings"].get("properties", {})
+    vector = props.get("embedding", {})
+    vector_type = vector.get("index_options", {}).get("type", "hnsw")
+    dims = vector.get("dims", VECTOR_DIMS)
+    count = stats["docs"]["count"]
+    # ES 官方估算：float 向量 HNSW 需要 num * 4 * (dims + 12) 字节常驻页缓存，int8 为 num * (dims + 4)
+    if vector_type.startswith("int8"):
+        vector_ram = count * (dims + 4)
+    else:
+        vector_ram = count * 4 * (dims + 12)
+    return {
+        "index": physical,
+        "vector_type": vector_type,
+        "docs": count,
+        "store_mb": round(stats["store"]["size_in_bytes"] / 1e6, 1),
+        "vector_ram_mb": round(vector_ram / 1e6, 1),
+        "managed": is_managed(physical),
+    }
+
+def _sample_vectors(index_name: str, samples: int) -> List[List[float]]:
+    """用库内已有片段的向量作为查询向量，不需要加载 Embedding 模型"""
+    body = {
+        "size": samples,
+        "_source": ["embedding"],
+        "query": {"function_score": {"random_score": {"seed": 42, "field": "_seq_no"}}},
+    }
+    hits = es_request("POST", f"/{index_name}/_search", body)["hits"]["hits"]
+    return [hit["_source"]["embedding"] for hit in hits if hit["_source"].get("embedding")]
+
+def _knn_ids(index_name: str, vector: List[float], k: int, num_candidates: int) -> tuple:
+    body = {
+        "size": k,
+        "_source": False,
+        "knn": {"field": "embedding", "query_vector": vector, "k": k, "num_candidates": num_candidates},
+    }
+    started = time.perf_counter()
+    hits = es_request("POST", f"/{index_name}/_search", body)["hits"]["hits"]
+    return [hit["_id"] for hit in hits], time.perf_counter() - started
+
+def _exact_ids(index_name: str, vector: List[float], k: int) -> List[str]:
+    """暴力计算余弦相似度，作为召回率的基准"""
+    body = {
+        "size": k,
+        "_source": False,
+        "query": {"script_score": {
+            "query": {"match_all": {}},
+            "script": {"source": "cosineSimilarity(params.v, 'embedding') + 1.0", "params": {"v": vector}},
+        }},
+    }
+    return [hit["_id"] for hit in es_request("POST", f"/{index_name}/_search", body, timeout=120)["hits"]["hits"]]
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[int(pct * (len(values) - 1))] if values else 0.0
+
+def benchmark(index_names: List[str], samples: int = 50, k: int = 10, num_candidates: int = NUM_CANDIDATES) -> List[Dict]:
+    """
+    对若干索引跑同一组 knn 查询：延迟 p50/p95 + 相对暴力检索的 recall@k。
+    文档 _id 在 _reindex 后保持不变，所以可以用第一个索引的暴力结果作为共同基准。
+    """
+    vectors = _sample_vectors(index_names[0], samples)
+    if not vectors:
+        print("索引为空，无法测试")
+        return []
+    truth = [set(_exact_ids(index_names[0], v, k)) for v in vectors]
+
+    results = []
+    for name in index_names:
+        # 先预热一轮，避免首次加载向量文件的耗时计入
+        for v in vectors[:5]:
+            _knn_ids(name, v, k, num_candidates)
+        latencies, recalls = [], []
+        for v, expected in zip(vectors, truth):
+            ids, seconds = _knn_ids(name, v, k, num_candidates)
+            latencies.append(seconds)
+            recalls.append(len(expected & set(ids)) / max(1, len(expected)))
+        row = index_stats(name)
+        row.update({
+            "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+            f"recall@{k}": round(sum(recalls) / len(recalls), 3),
+        })
+        results.append(row)
+    return results
+
+def print_comparison(rows: List[Dict]):
+    if not rows:
+        return
+    keys = [key for key in rows[0] if key != "managed"]
+    print("\n" + " | ".join(f"{key:>14}" for key in keys))
+    for row in rows:
+        print(" | ".join(f"{str(row.get(key)):>14}" for key in keys))
+
+# -----------------------------------------------------------
+# 3. 迁移
+# -----------------------------------------------------------
+def _wait_for_task(task_id: str):
+    while True:
+        result = es_request("GET", f"/_tasks/{task_id}")
+        status = result.get("task", {}).get("status", {})
+        print(f"   ... 已迁移 {status.get('created', 0) + status.get('updated', 0)}/{status.get('total', '?')}")
+        if result.get("completed"):
+            if result.get("error") or result.get("response", {}).get("failures"):
+                raise ESError(f"重建索引失败: {result.get('error') or result['response']['failures'][:3]}")
+            # 任务结果已取回，清理 .tasks 中的记录；清理失败不影响迁移
+            try:
+                es_request("DELETE", f"/.tasks/_doc/{task_id}", ignore=(404,))
+            except ESError as e:
+                print(f"⚠️ 清理任务记录 {task_id} 失败 (可忽略): {e}")
+            return result.get("response", {})
+        time.sleep(MIGRATE_POLL_INTERVAL)
+
+def migrate(alias: str = INDEX_NAME, keep_old: bool = False, samples: int = 50) -> Dict:
+    """
+    把现有索引迁移到显式 Mapping：新建带版本号的索引 -> 后台 _reindex -> 校验数量 -> 原子切换别名。
+    迁移期间新写入的数据不会被带到新索引，请在没有入库任务时执行。
+    """
+    old = resolve_index(alias)
+    if old is None:
+        ensure_knowledge_index(alias)
+        return {"migrated": False, "reason": "索引不存在，已直接按新 Mapping 创建"}
+
+    new = versioned_name(alias)
+    print(f"🚚 迁移 {old} -> {new}")
+    create_index(new)
+    result = es_request(
+        "POST", "/_reindex",
+        {"source": {"index": old, "size": 500}, "dest": {"index": new}},
+        params={"wait_for_completion": "false", "refresh": "true"},
+    )
+    _wait_for_task(result["task"])
+
+    old_count = es_request("GET", f"/{old}/_count")["count"]
+    new_count = es_request("GET", f"/{new}/_count")["count"]
+    if old_count != new_count:
+        raise ESError(f"数量不一致 (旧 {old_count} / 新 {new_count})，未切换别名，新索引 {new} 保留待排查")
+
+    rows = benchmark([old, new], samples=samples) if samples else []
+    print_comparison(rows)
+
+    # 原子切换：旧的是普通索引时直接删掉并建同名别名；旧的是带版本号的索引时移动它身上的全部别名
+    # (包括分区检索用的 factory_knowledge_p_general)
+    other_aliases = es_request("GET", f"/{old}/_alias").get(old, {}).get("aliases", {})
+    if old == alias:
+        actions = [{"add": {"index": new, "alias": alias, "is_write_index": True}}, {"remove_index": {"index": old}}]
+    else:
+        actions = [{"remove": {"index": old, "alias": alias}}, {"add": {"index": new, "alias": alias, "is_write_index": True}}]
+    for other, info in other_aliases.items():
+        if other == alias:
+            continue
+        if old != alias:
+            actions.append({"remove": {"index": old, "alias": other}})
+        actions.append({"add": {"index": new, "alias": other, "is_write_index": info.get("is_write_index", False)}})
+    es_request("POST", "/_aliases", {"actions": actions})
+    if old != alias and not keep_old:
+        es_request("DELETE", f"/{old}", ignore=(404,))
+    print(f"✅ 别名 {alias} 已指向 {new} ({new_count} 个片段)")
+    return {"migrated": True, "old": old, "new": new, "docs": new_count, "comparison": rows}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="知识库索引 Mapping 管理与迁移")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="查看当前索引的 Mapping 类型与内存估算")
+    p_migrate = sub.add_parser("migrate", help="迁移到显式 Mapping (int8_hnsw)")
+    p_migrate.add_argument("--keep-old", action="store_true", help="切换后保留旧的带版本号索引")
+    p_migrate.add_argument("--samples", type=int, default=50, help="对比测试的查询数，0 表示跳过")
+    p_bench = sub.add_parser("benchmark", help="对比多个索引的内存估算、延迟和召回率")
+    p_bench.add_argument("indices", nargs="+")
+    p_bench.add_argument("--samples", type=int, default=50)
+    p_bench.add_argument("--k", type=int, default=10)
+    p_bench.add_argument("--num-candidates", type=int, default=NUM_CANDIDATES)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "status":
+            if not index_exists(INDEX_NAME):
+                print(f"索引 {INDEX_NAME} 不存在")
+                return
+            print_comparison([index_stats(INDEX_NAME)])
+        elif args.command == "migrate":
+            migrate(keep_old=args.keep_old, samples=args.samples)
+        else:
+            print_comparison(benchmark(args.indices, samples=args.samples, k=args.k, num_candidates=args.num_candidates))
+    except ESError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
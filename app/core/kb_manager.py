@@ -2,193 +2,146 @@
 
 import os
 import shutil
-import fitz  # PyMuPDF
+import asyncio
 import nest_asyncio
-import requests
 from typing import List, Dict,Optional
 from fastapi import UploadFile
-from llama_index.core import Document, VectorStoreIndex, StorageContext, Settings,SimpleDirectoryReader
+from llama_index.core import Document, VectorStoreIndex, StorageContext, Settings
+from llama_index.core.schema import MetadataMode
 from llama_index.vector_stores.elasticsearch import ElasticsearchStore
-from app.core.agent import GLOBAL_EMBED_MODEL 
+from app.core.agent import GLOBAL_EMBED_MODEL
+from app.core.es_client import ESError, ES_URL, INDEX_NAME
+from app.core import file_catalog, storage_gc, partitions, mmap_store
+# 解析与切片在 doc_parser (不依赖模型，批量入库的子进程只导入它)；这里重新导出，原有调用方不变
+from app.core.doc_parser import (
+    extract_page_items, parse_pdf_with_layout, count_pages, load_documents, build_nodes, tag_partition,
+    CHUNK_SIZE, LAYOUT_CHUNKING, IMAGES_DIR, API_BASE_URL,
+)
+from app.core.index_schema import ensure_knowledge_index
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 nest_asyncio.apply()
 
-ES_URL = os.getenv("ELASTICSEARCH_URL", "http://elasticsearch:9200")
-INDEX_NAME = "factory_knowledge"
 UPLOAD_DIR = "./factory_docs"
-IMAGES_DIR = "./factory_images"
-API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
 
 # 确保目录存在
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
 # -----------------------------------------------------------
-# 1. 核心算法：按坐标提取图文，保持顺序
+# 1. ES 操作函数
 # -----------------------------------------------------------
-def parse_pdf_with_layout(pdf_path: str, file_name: str) -> List[Document]:
+def list_files_in_es(limit: int = file_catalog.DEFAULT_PAGE_SIZE, cursor: Optional[str] = None) -> Dict:
     """
-    使用 PyMuPDF 获取页面上的文字块和图片块，并根据 Y 轴坐标进行混合排序。
-    返回包含精确图文顺序的 Document 列表。
+    分页读取知识库文件目录 (名称、片段数、页数、大小、入库时间、内容哈希)。
+    ES 异常会以 ESError 抛出，由接口层转换为错误响应，不再静默返回空列表。
     """
-    doc = fitz.open(pdf_path)
-    base_name = os.path.splitext(file_name)[0]
-    llama_documents = []
-
-    print(f"📄 开始进行图文混排解析: {file_name}")
-
-    for page_index, page in enumerate(doc):
-        # 1. 获取所有图片对象
-        image_list = page.get_images(full=True)
-        page_items = [] # 用于存放 (Y坐标, 内容字符串) 的临时列表
-
-        # --- A. 处理图片 ---
-        for img_index, img in enumerate(image_list):
-            xref = img[0]
-            # 获取图片在页面上的坐标 (Rect)
-            # 注意：如果一张图被复用多次，get_image_rects 会返回多个位置，这里简化取第一个
-            rects = page.get_image_rects(xref)
-            if not rects: 
-                continue
-            
-            # 这里的 y1 (底部坐标) 通常用于决定图片是在某段文字之后
-            # 我们用 y0 (顶部坐标) 也可以，视排版而定，通常 y0 更符合“读到这里看到了图”
-            y_pos = rects[0].y1 
-            
-            # 提取图片并保存到本地
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            image_ext = base_image["ext"]
-            
-            # 文件名：文件名_p页码_索引.png
-            image_filename = f"{base_name}_p{page_index+1}_{img_index}.{image_ext}"
-            image_path = os.path.join(IMAGES_DIR, image_filename)
-            
-            with open(image_path, "wb") as f:
-                f.write(image_bytes)
-            
-            # 构造 Markdown 图片链接
-            # 这里直接生成 URL，稍后拼接到文本里
-            img_url = f"{API_BASE_URL}/images/{image_filename}"
-            markdown_img = f"\n\n![示意图]({img_url})\n\n"
-            
-            # 存入列表: (坐标, 类型, 内容)
-            page_items.append({
-                "y": y_pos,
-                "type": "image",
-                "content": markdown_img
-            })
-
-        # --- B. 处理文字 ---
-        # get_text("blocks") 返回 (x0, y0, x1, y1, "text", block_no, block_type)
-        text_blocks = page.get_text("blocks")
-        for block in text_blocks:
-            # block[6] == 0 代表这是文字块 (1是图片块，但PyMuPDF的图片块往往不准，所以我们上面单独处理了图片)
-            if block[6] == 0:
-                text_content = block[4].strip()
-                if text_content:
-                    page_items.append({
-                        "y": block[3], # 使用 y1 (底部) 作为排序依据
-                        "type": "text",
-                        "content": text_content
-                    })
-
-        # --- C. 核心：按 Y 轴坐标排序 ---
-        # 这样就能保证：上面的文字 -> 中间的图 -> 下面的文字
-        page_items.sort(key=lambda x: x["y"])
-
-        # --- D. 拼接成最终文本 ---
-        final_page_text = ""
-        for item in page_items:
-            final_page_text += item["content"] + "\n"
-
-        # --- E. 创建 Document 对象 ---
-        doc_obj = Document(text=final_page_text)
-        doc_obj.metadata = {
-            "file_name": file_name,
-            "page_label": str(page_index + 1),
-            # 这里虽然我们在text里已经嵌入了图片，但metadata里留个底也是好的
-            "has_images": True if image_list else False 
-        }
-        llama_documents.append(doc_obj)
-
-    print(f"✅ 解析完成，共 {len(llama_documents)} 页")
-    return llama_documents
+    return file_catalog.list_files(limit=limit, cursor=cursor)
 
-# -----------------------------------------------------------
-# 2. ES 操作函数
-# -----------------------------------------------------------
-def list_files_in_es() -> List[Dict]:
-    search_url = f"{ES_URL}/{INDEX_NAME}/_search"
-    payload = {
-        "size": 0, "aggs": {"unique_files": {"terms": {"field": "metadata.file_name.keyword", "size": 1000}}}
-    }
-    try:
-        response = requests.get(search_url, json=payload)
-        if response.status_code == 200:
-            buckets = response.json().get('aggregations', {}).get('unique_files', {}).get('buckets', [])
-            return [{"name": b['key'], "chunks": b['doc_count']} for b in buckets]
-        return []
-    except Exception as e:
-        return []
-
-def delete_file_from_es(filename: str) -> bool:
-    url = f"{ES_URL}/{INDEX_NAME}/_delete_by_query"
-    payload = {"query": {"term": {"metadata.file_name.keyword": filename}}}
-    try:
-        response = requests.post(url, json=payload)
-        return response.status_code == 200
-    except:
-        return False
+def rebuild_file_catalog() -> Dict:
+    """以知识库实际数据为准重建文件目录 (对账用)"""
+    return file_catalog.rebuild_catalog(UPLOAD_DIR)
+
+def delete_file_from_es(filename: str) -> Dict:
+    """
+    提交后台删除任务并立即返回任务信息 (task_id 可用于轮询进度)。
+    任务完成后由 storage_gc 回收原件和不再被引用的图片。
+    """
+    return storage_gc.start_file_deletion(filename)
 
 # -----------------------------------------------------------
-# 3. 入库入口
+# 2. 入库入口
 # -----------------------------------------------------------
-# 新增：通用入库逻辑（接收本地文件路径）
-async def ingest_from_local_path(file_path: str, original_filename: str):
-    print(f"📂 开始处理本地文件: {original_filename}")
-
-    # 1. 解析文档
-    documents = []
-    if original_filename.lower().endswith(".pdf"):
-        documents = parse_pdf_with_layout(file_path, original_filename)
-    else:
-        # 对于 txt, md, docx 等，使用 SimpleDirectoryReader
-        documents = SimpleDirectoryReader(input_files=[file_path]).load_data()
-        # 确保 metadata 里有文件名
-        for doc in documents:
-            doc.metadata["file_name"] = original_filename
-            doc.metadata["page_label"] = "1" # 非PDF默认为第1页
-
-    # 2. 显存保护配置
+def embed_nodes(nodes: list, batch_size: int = 64):
+    """批量向量化 (mmap 后端不经过 VectorStoreIndex，需要自己算好向量再写入)"""
+    for start in range(0, len(nodes), batch_size):
+        batch = nodes[start:start + batch_size]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+        for node, embedding in zip(batch, GLOBAL_EMBED_MODEL.get_text_embedding_batch(texts)):
+            node.embedding = embedding
+
+def index_documents(
+    documents: List[Document],
+    index_name: str = INDEX_NAME,
+    chunk_size: int = CHUNK_SIZE,
+    partition: Optional[str] = None,
+) -> int:
+    """
+    切片、向量化并写入指定的 ES 索引，返回写入的片段数
+    :param partition: 指定时写入该分区的索引 (见 partitions.py)，忽略 index_name
+    """
+    # 显存保护配置
     Settings.embed_model = GLOBAL_EMBED_MODEL
-    Settings.chunk_size = 512
 
-    # 3. 存入 ES
-    print(f"⏳ 开始向量化入库 ({len(documents)} 个片段)...")
+    if mmap_store.enabled():
+        if partition:
+            index_name = partitions.write_target(partition)
+            if partition != partitions.GENERAL:
+                tag_partition(documents, partition)
+        nodes = build_nodes(documents, chunk_size)
+        embed_nodes(nodes)
+        return mmap_store.add_nodes(index_name, nodes)
+
+    # 索引由我们按显式 Mapping 创建 (int8_hnsw)，不再让 ElasticsearchStore 按默认设置隐式创建
+    if partition:
+        partitions.ensure_partition_index(partition)
+        index_name = partitions.write_target(partition)
+        if partition != partitions.GENERAL:
+            tag_partition(documents, partition)
+    else:
+        ensure_knowledge_index(index_name)
+    nodes = build_nodes(documents, chunk_size)
     vector_store = ElasticsearchStore(
         es_url=ES_URL,
-        index_name=INDEX_NAME,
+        index_name=index_name,
     )
     storage_context = StorageContext.from_defaults(vector_store=vector_store)
     
-    VectorStoreIndex.from_documents(
-        documents,
+    VectorStoreIndex(
+        nodes,
         storage_context=storage_context,
         show_progress=True
     )
+    return len(nodes)
+
+# 新增：通用入库逻辑（接收本地文件路径）
+def ingest_local_file(file_path: str, original_filename: str, partition: Optional[str] = None) -> int:
+    """
+    同步入库逻辑 (解析 + 向量化都是 CPU 密集操作，由调用方放到线程里执行)
+    :param partition: 目标分区；不传时按文件名识别，识别不出归入 general
+    """
+    partition = partitions.ingest_partition(partition, original_filename)
+    print(f"📂 开始处理本地文件: {original_filename} (分区 {partition})")
+
+    # 1. 解析文档
+    documents = load_documents(file_path, original_filename)
+
+    # 2. 存入 ES
+    print(f"⏳ 开始向量化入库 ({len(documents)} 个文档)...")
+    chunks = index_documents(documents, partition=partition)
+
+    # 3. 更新文件目录
+    pages = count_pages(documents)
+    try:
+        file_catalog.upsert_file(original_filename, chunks=chunks, pages=pages, file_path=file_path, partition=partition)
+    except ESError as e:
+        # 目录只是索引的摘要，写失败不影响入库本身，可通过对账接口补齐
+        print(f"⚠️ 文件目录更新失败 (可稍后对账修复): {e}")
     
     print(f"🎉 {original_filename} 入库完成！")
     return len(documents)
 
+async def ingest_from_local_path(file_path: str, original_filename: str, partition: Optional[str] = None):
+    # 放到线程池执行，避免解析/向量化期间阻塞事件循环 (对话流式输出会被卡住)
+    return await asyncio.to_thread(ingest_local_file, file_path, original_filename, partition)
+
 # 处理上传文件
-async def ingest_file(file: UploadFile):
+async def ingest_file(file: UploadFile, partition: Optional[str] = None):
     # 1. 保存文件到磁盘
     file_path = os.path.join(UPLOAD_DIR, file.filename)
     with open(file_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
     
     # 2. 调用通用逻辑
-    return await ingest_from_local_path(file_path, file.filename)
\ No newline at end of file
+    return await ingest_from_local_path(file_path, file.filename, partition)
\ No newline at end of file
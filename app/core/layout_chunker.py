@@ -0,0 +1,196 @@
+# app/core/layout_chunker.py
+"""
+版面感知切片 (Layout-aware chunking)
+
+输入：PyMuPDF 按阅读顺序 (页码 + Y 坐标) 排好的文字块 / 图片块
+输出：以“标题 -> 步骤”为单位的自包含片段
+
+规则：
+1. 标题 (编号标题或字号明显偏大的短行) 切分章节，并维护标题路径 (heading path)
+2. 编号步骤 (1. / 1、/ (1) / 步骤1 / ①) 开启新的片段单元，后续正文和图片都归属这一步
+3. 同一章节内相邻的小单元合并到目标长度；超长单元按段落拆分，图片始终跟随它前面的段落
+这样一个片段里就是完整的“步骤文字 + 示意图”，检索时不需要再按页码把相邻页拼回来。
+"""
+
+import re
+from statistics import median
+from typing import List, Dict, Optional
+
+# 标题编号：第X章 / 第X节 / 一、 / 1.2 / 1.2.3
+CHAPTER_PATTERN = re.compile(r"^第[一二三四五六七八九十百零\d]+[章篇部]")
+SECTION_PATTERN = re.compile(r"^第[一二三四五六七八九十百零\d]+节")
+CN_NUMBER_PATTERN = re.compile(r"^[一二三四五六七八九十]+[、.．]")
+DECIMAL_HEADING_PATTERN = re.compile(r"^(\d+(?:\.\d+)+)\s*[^\d.．、]")
+# 步骤编号：1. / 1、/ 1) / (1) / （1）/ 步骤1 / Step 1 / ①
+STEP_PATTERN = re.compile(
+    r"^(\d{1,2}[.．、)）](?!\d)|[(（]\d{1,2}[)）]|步骤\s*\d+|[Ss]tep\s*\d+|[①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳])"
+)
+SENTENCE_END = ("。", "；", ";", "：", ":", "，", ",")
+
+HEADING_MAX_CHARS = 40
+HEADING_FONT_RATIO = 1.15
+STEP_MAX_RATIO = 2  # 单个步骤最多允许超过目标长度的倍数，超过才拆分
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个，其余按空白分词约 1.3 个"""
+    cjk = len(re.findall(r"[㐀-鿿豈-﫿]", text))
+    others = re.sub(r"[㐀-鿿豈-﫿]", " ", text)
+    return cjk + int(len(others.split()) * 1.3)
+
+# -----------------------------------------------------------
+# 1. 标题 / 步骤识别
+# -----------------------------------------------------------
+def _body_font_size(items: List[Dict]) -> float:
+    sizes = [item["size"] for item in items if item["type"] == "text" and item.get("size")]
+    return median(sizes) if sizes else 0.0
+
+def heading_level(item: Dict, body_size: float, heading_sizes: List[float]) -> Optional[int]:
+    """返回标题层级 (1 最高)，不是标题返回 None"""
+    text = item["content"].strip()
+    if not text or "\n" in text or len(text) > HEADING_MAX_CHARS or text.endswith(SENTENCE_END):
+        return None
+
+    if CHAPTER_PATTERN.match(text):
+        return 1
+    if SECTION_PATTERN.match(text) or CN_NUMBER_PATTERN.match(text):
+        return 2
+    decimal = DECIMAL_HEADING_PATTERN.match(text)
+    if decimal:
+        return decimal.group(1).count(".") + 1
+
+    size = item.get("size") or 0
+    if body_size and size >= body_size * HEADING_FONT_RATIO and not STEP_PATTERN.match(text):
+        # 字号越大层级越高
+        return heading_sizes.index(round(size, 1)) + 1 if round(size, 1) in heading_sizes else len(heading_sizes)
+    if item.get("bold") and len(text) <= HEADING_MAX_CHARS // 2 and not STEP_PATTERN.match(text):
+        return len(heading_sizes) + 1
+    return None
+
+def is_step(item: Dict) -> bool:
+    return item["type"] == "text" and bool(STEP_PATTERN.match(item["content"].strip()))
+
+# -----------------------------------------------------------
+# 2. 按标题 / 步骤切分为单元
+# -----------------------------------------------------------
+def _new_unit(kind: str, heading_path: List[str], page: int) -> Dict:
+    return {"kind": kind, "heading_path": list(heading_path), "parts": [], "page_start": page, "page_end": page}
+
+def _has_content(unit: Optional[Dict]) -> bool:
+    return bool(unit and unit["parts"])
+
+def split_into_units(items: List[Dict]) -> List[Dict]:
+    """
+    items: [{"page": int, "y": float, "type": "text"|"image", "content": str, "size": float, "bold": bool, "image": str}]
+    需已按 (page, y) 排好序。
+    """
+    body_size = _body_font_size(items)
+    heading_sizes = sorted(
+        {round(i["size"], 1) for i in items if i["type"] == "text" and i.get("size") and body_size and i["size"] >= body_size * HEADING_FONT_RATIO},
+        reverse=True,
+    )
+
+    units: List[Dict] = []
+    stack: List[tuple] = []  # [(level, 标题文字)]
+    current: Optional[Dict] = None
+
+    def path() -> List[str]:
+        return [title for _, title in stack]
+
+    for item in items:
+        page = item["page"]
+        level = heading_level(item, body_size, heading_sizes) if item["type"] == "text" else None
+
+        if level is not None:
+            if _has_content(current):
+                units.append(current)
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, item["content"].strip()))
+            current = _new_unit("intro", path(), page)
+            continue
+
+        if is_step(item):
+            if _has_content(current):
+                units.append(current)
+            current = _new_unit("step", path(), page)
+        elif current is None:
+            current = _new_unit("intro", path(), page)
+
+        # 图片归属它前面最近的一段文字 (同一步骤)
+        current["parts"].append(item)
+        current["page_end"] = page
+
+    if _has_content(current):
+        units.append(current)
+    return units
+
+# -----------------------------------------------------------
+# 3. 合并小单元 / 拆分大单元
+# -----------------------------------------------------------
+def _render(parts: List[Dict]) -> str:
+    return "\n".join(part["content"].strip("\n") if part["type"] == "image" else part["content"] for part in parts).strip() + "\n"
+
+def _unit_tokens(unit: Dict) -> int:
+    return estimate_tokens(_render(unit["parts"]))
+
+def _split_oversized(unit: Dict, max_tokens: int) -> List[Dict]:
+    """按段落拆分超长单元，图片不与前一段分离"""
+    pieces, current, tokens = [], [], 0
+    for part in unit["parts"]:
+        part_tokens = estimate_tokens(part["content"])
+        if current and part["type"] == "text" and tokens + part_tokens > max_tokens:
+            pieces.append(current)
+            current, tokens = [], 0
+        current.append(part)
+        tokens += part_tokens
+    if current:
+        pieces.append(current)
+
+    result = []
+    for parts in pieces:
+        piece = dict(unit, parts=parts)
+        piece["page_start"] = parts[0]["page"]
+        piece["page_end"] = parts[-1]["page"]
+        result.append(piece)
+    return result
+
+def pack_units(units: List[Dict], target_tokens: int) -> List[Dict]:
+    """同一标题路径下的相邻单元合并到 target_tokens 以内；单个步骤超过 STEP_MAX_RATIO 倍才拆分"""
+    packed: List[Dict] = []
+    for unit in units:
+        if _unit_tokens(unit) > target_tokens * STEP_MAX_RATIO:
+            packed.extend(_split_oversized(unit, target_tokens))
+            continue
+
+        last = packed[-1] if packed else None
+        if (
+            last is not None
+            and last["heading_path"] == unit["heading_path"]
+            and _unit_tokens(last) + _unit_tokens(unit) <= target_tokens
+        ):
+            last["parts"].extend(unit["parts"])
+            last["page_end"] = unit["page_end"]
+            if unit["kind"] == "step":
+                last["kind"] = "step"
+            continue
+        packed.append(dict(unit, parts=list(unit["parts"])))
+    return packed
+
+# -----------------------------------------------------------
+# 4. 对外入口
+# -----------------------------------------------------------
+def chunk_layout_items(items: List[Dict], target_tokens: int = 512) -> List[Dict]:
+    """
+    :return: [{"text", "page_start", "page_end", "heading_path": [..], "images": [..], "kind"}]
+    """
+    chunks = []
+    for unit in pack_units(split_into_units(items), target_tokens):
+        chunks.append({
+            "text": _render(unit["parts"]),
+            "page_start": unit["page_start"],
+            "page_end": unit["page_end"],
+            "heading_path": unit["heading_path"],
+            "images": [part["image"] for part in unit["parts"] if part["type"] == "image"],
+            "kind": unit["kind"],
+        })
+    return chunks
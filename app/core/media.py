@@ -0,0 +1,217 @@
+# app/core/media.py
+"""
+图片 / 原件分发
+
+车间平板走 Wi-Fi，每条回答都会带几张整页分辨率的示意图，原来 StaticFiles 每次都整张重新下载。
+这里负责：
+1. 入库时为每张图片生成压缩版本 (WebP 原尺寸、限定边长的缩略图)，存放在 factory_images/.variants/
+2. 分发时按 Accept 头协商格式 (支持 WebP 就给 WebP)，?size=thumb 给缩略图，原图保留用于点击放大
+3. 强 ETag (内容 SHA-256) + If-None-Match 304；图片链接带内容版本号 (?v=)，可以放心设置 immutable 长缓存
+"""
+
+import os
+import hashlib
+from functools import lru_cache
+from typing import Optional, List, Tuple
+
+from fastapi import Request, HTTPException
+from fastapi.responses import Response, FileResponse
+
+IMAGES_DIR = "./factory_images"
+VARIANTS_DIRNAME = ".variants"
+THUMB_MAX_SIDE = int(os.getenv("IMAGE_THUMB_MAX_SIDE", "640"))
+WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+
+# 带版本号的图片链接内容永不变化；其余响应每次用 ETag 校验 (命中时只返回 304)
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "public, no-cache"
+
+# -----------------------------------------------------------
+# 1. 入库时生成压缩版本
+# -----------------------------------------------------------
+def content_version(data: bytes) -> str:
+    """图片链接上的版本号：同名文件重新入库、内容变化后链接随之变化，旧缓存自然失效"""
+    return hashlib.sha256(data).hexdigest()[:12]
+
+def _variants_dir(images_dir: str) -> str:
+    return os.path.join(images_dir, VARIANTS_DIRNAME)
+
+def _thumb_fallback_ext(name: str) -> str:
+    ext = os.path.splitext(name)[1].lower().lstrip(".")
+    return "png" if ext == "png" else "jpg"
+
+def variant_names(name: str) -> dict:
+    """原图 a_p1_0.png 对应的压缩版本文件名"""
+    return {
+        "webp": f"{name}.webp",
+        "thumb_webp": f"{name}.thumb.webp",
+        "thumb": f"{name}.thumb.{_thumb_fallback_ext(name)}",
+    }
+
+def generate_variants(image_path: str, images_dir: str = IMAGES_DIR) -> List[str]:
+    """
+    生成 WebP 和缩略图。任何失败 (如 PIL 不支持的 JBIG2) 只打印警告，不影响入库，分发时回退到原图。
+    :return: 生成的文件名列表
+    """
+    from PIL import Image
+
+    name = os.path.basename(image_path)
+    out_dir = _variants_dir(images_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    # 同名旧图 (例如重新上传的同名文件) 留下的版本要先删掉：这次可能不生成某个版本，
+    # 旧文件若留着会以 immutable 缓存头继续分发
+    remove_variants(name, images_dir)
+    names = variant_names(name)
+    created = []
+    try:
+        with Image.open(image_path) as img:
+            img.load()
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            base = img.convert("RGBA" if has_alpha else "RGB")
+
+        # WebP 原尺寸：比原图小才保留 (部分 JPEG 本身已经压得很小)
+        webp_path = os.path.join(out_dir, names["webp"])
+        base.save(webp_path, "WEBP", quality=WEBP_QUALITY, method=4)
+        if os.path.getsize(webp_path) < os.path.getsize(image_path):
+            created.append(names["webp"])
+        else:
+            os.remove(webp_path)
+
+        # 缩略图：原图本来就不大时不生成，直接用原图
+        if max(base.size) > THUMB_MAX_SIDE:
+            thumb = base.copy()
+            thumb.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE), Image.LANCZOS)
+            thumb.save(os.path.join(out_dir, names["thumb_webp"]), "WEBP", quality=WEBP_QUALITY, method=4)
+            if names["thumb"].endswith(".png"):
+                thumb.save(os.path.join(out_dir, names["thumb"]), "PNG", optimize=True)
+            else:
+                thumb.convert("RGB").save(os.path.join(out_dir, names["thumb"]), "JPEG", quality=85, optimize=True)
+            created += [names["thumb_webp"], names["thumb"]]
+    except Exception as e:
+        print(f"⚠️ 图片压缩版本生成失败 {name}: {e}")
+    return created
+
+def _original_of(variant: str) -> str:
+    """压缩版本文件名 -> 原图文件名 (variant_names 的逆操作)"""
+    if ".thumb." in variant:
+        return variant.rsplit(".thumb.", 1)[0]
+    return variant[: -len(".webp")] if variant.endswith(".webp") else variant
+
+def remove_variants(name: str, images_dir: str = IMAGES_DIR) -> int:
+    """删除某张原图的全部压缩版本，返回删除的文件数"""
+    removed = 0
+    for variant in variant_names(name).values():
+        try:
+            os.remove(os.path.join(_variants_dir(images_dir), variant))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def orphan_variants(images_dir: str = IMAGES_DIR) -> List[str]:
+    """原图已不存在的压缩版本 (GC 使用)，返回相对 images_dir 的路径"""
+    out_dir = _variants_dir(images_dir)
+    if not os.path.isdir(out_dir):
+        return []
+    orphans = []
+    for variant in os.listdir(out_dir):
+        if not os.path.exists(os.path.join(images_dir, _original_of(variant))):
+            orphans.append(os.path.join(VARIANTS_DIRNAME, variant))
+    return orphans
+
+# -----------------------------------------------------------
+# 2. 分发
+# -----------------------------------------------------------
+@lru_cache(maxsize=4096)
+def _file_hash(path: str, mtime_ns: int, size: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def strong_etag(path: str) -> str:
+    """内容哈希作为强 ETag；按 (路径, 修改时间, 大小) 缓存，文件不变时不重复计算"""
+    stat = os.stat(path)
+    return f'"{_file_hash(path, stat.st_mtime_ns, stat.st_size)}"'
+
+def file_version(path: str) -> str:
+    """磁盘上文件的当前版本号，与入库时 content_version 的算法一致"""
+    stat = os.stat(path)
+    return _file_hash(path, stat.st_mtime_ns, stat.st_size)[:12]
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # 弱比较：W/"x" 与 "x" 视为相同
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def _safe_path(directory: str, name: str) -> str:
+    if not name or os.path.basename(name) != name or name.startswith("."):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    path = os.path.join(directory, name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return path
+
+def serve_file(request: Request, path: str, cache_control: str, media_type: str = None, vary: str = None) -> Response:
+    etag = strong_etag(path)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if vary:
+        headers["Vary"] = vary
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+def select_image(name: str, accept: str, size: Optional[str], images_dir: str = IMAGES_DIR) -> Tuple[str, Optional[str]]:
+    """按 Accept 头和尺寸选出要返回的文件，返回 (路径, media_type)；没有合适的压缩版本时返回原图"""
+    original = _safe_path(images_dir, name)
+    names = variant_names(name)
+    accepts_webp = "image/webp" in (accept or "")
+
+    candidates = []
+    if size == "thumb":
+        if accepts_webp:
+            candidates.append((names["thumb_webp"], "image/webp"))
+        candidates.append((names["thumb"], None))
+    if accepts_webp:
+        candidates.append((names["webp"], "image/webp"))
+
+    for variant, media_type in candidates:
+        path = os.path.join(_variants_dir(images_dir), variant)
+        if os.path.isfile(path):
+            return path, media_type
+    return original, None
+
+def image_response(request: Request, name: str, size: Optional[str] = None, images_dir: str = IMAGES_DIR) -> Response:
+    path, media_type = select_image(name, request.headers.get("accept", ""), size, images_dir)
+    # 链接上的版本号 (?v=) 与原图当前内容一致时才能长期缓存；
+    # 旧数据的链接没有版本号、或图片已被重新入库覆盖 (版本号过期)，只能每次校验
+    version = request.query_params.get("v")
+    fresh = bool(version) and version == file_version(_safe_path(images_dir, name))
+    cache_control = IMMUTABLE_CACHE if fresh else REVALIDATE_CACHE
+    return serve_file(request, path, cache_control, media_type=media_type, vary="Accept")
+
+def source_file_response(request: Request, name: str, upload_dir: str) -> Response:
+    # 同名文件可以重新上传覆盖，原件每次校验 ETag
+    return serve_file(request, _safe_path(upload_dir, name), REVALIDATE_CACHE)
+
+# -----------------------------------------------------------
+# 3. 旧数据补齐
+# -----------------------------------------------------------
+def backfill_variants(images_dir: str = IMAGES_DIR) -> int:
+    """为升级前已入库的图片补生成压缩版本 (python -m app.core.media)"""
+    count = 0
+    for name in sorted(os.listdir(images_dir)):
+        path = os.path.join(images_dir, name)
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        if not os.path.exists(os.path.join(_variants_dir(images_dir), variant_names(name)["webp"])):
+            generate_variants(path, images_dir)
+            count += 1
+    print(f"✅ 已为 {count} 张图片生成压缩版本")
+    return count
+
+if __name__ == "__main__":
+    backfill_variants()
@@ -0,0 +1,788 @@
+# app/core/mmap_store.py
+"""
+进程内向量检索后端 (内存映射 NumPy)
+
+小型站点 / 边缘盒子上，为了几十万个片段的 kNN 单独跑一个 JVM Elasticsearch，内存开销比模型本身还大。
+VECTOR_BACKEND=mmap 时检索与入库改走这里：
+- 向量：归一化后的 float32 逐行追加到 vectors.f32，检索时用 np.memmap 映射，由操作系统页缓存按需加载
+- 元数据：同目录下的 SQLite 表 (meta.sqlite)，保存节点 ID、文件名、分区、正文和 LlamaIndex 元数据
+- 检索：分块矩阵乘法做精确检索；片段较多时可训练 IVF (球面 k-means)，只扫描最近的 nprobe 个簇
+- 增量追加；按文件删除只打删除标记，compact 时再物理回收
+- 返回与 ES 路径相同的 NodeWithScore (分数与 ES cosine 一致：(1 + cos) / 2)，精排、打包逻辑不变
+
+写入 (入库进程、批量导入进程) 之间用文件锁互斥；检索进程每次查询前检查 state.json，
+发现新增片段时只增量加载新行，删除 / compact / 重建 IVF 后整体重新加载。
+compact 把重新编号后的向量、簇分配和元数据库写成新一代文件 (vectors.{n}.f32 / lists.{n}.i32 / meta.{n}.sqlite)，
+写完后随 state.json 中的 segment 一起切换；检索进程始终打开自己已加载的 state 所指的那一代文件，
+上一代文件保留到下一次 compact，正在进行的检索不会读到新旧混合的数据。
+
+文件目录 (file_catalog) 也保存在 meta.sqlite 的 files 表里，列表、删除、定期 GC 都不再需要 ES。
+
+限制：只支持纯向量检索 (没有 BM25，RAG_HYBRID_SEARCH 不生效)。
+compact 会重新编号全部片段，请在停止入库时执行。
+
+用法：
+    python -m app.core.mmap_store import-es        # 从现有 ES 知识库导入 (切换后端前执行一次)
+    python -m app.core.mmap_store build-ivf        # 训练 IVF 聚类
+    python -m app.core.mmap_store benchmark        # 与 ES kNN 对比延迟、召回率和内存
+    python -m app.core.mmap_store compact          # 回收已删除片段占用的空间
+    python -m app.core.mmap_store stats
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.schema import MetadataMode, NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+from app.core.es_client import es_request, ESError, INDEX_NAME
+from app.core import partitions
+
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "es").lower()  # es | mmap
+MMAP_STORE_DIR = os.getenv("MMAP_STORE_DIR", "./vector_store")
+MMAP_SEARCH_MODE = os.getenv("MMAP_SEARCH_MODE", "auto")  # exact | ivf | auto
+# auto 模式下有效片段数达到该值且已训练 IVF 时使用 IVF，否则精确检索
+IVF_MIN_ROWS = int(os.getenv("MMAP_IVF_MIN_ROWS", "100000"))
+IVF_NPROBE = int(os.getenv("MMAP_IVF_NPROBE", "16"))  # 每次检索扫描的簇数，召回与延迟之间的主要调节旋钮
+BLOCK_ROWS = 65536  # 精确检索每次参与矩阵乘法的行数，限制临时内存
+KMEANS_ITERATIONS = 12
+KMEANS_POINTS_PER_LIST = 64  # 训练 IVF 时每个簇的采样点数
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    row INTEGER PRIMARY KEY,
+    node_id TEXT NOT NULL,
+    file_name TEXT,
+    partition TEXT NOT NULL,
+    content TEXT,
+    metadata TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_file ON chunks(file_name);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    chunks INTEGER,
+    pages INTEGER,
+    size INTEGER,
+    ingested_at TEXT,
+    content_hash TEXT,
+    partition TEXT
+);
+"""
+FILE_FIELDS = ("name", "chunks", "pages", "size", "ingested_at", "content_hash", "partition")
+EMPTY_STATE = {"rows": 0, "dims": 0, "generation": 0, "ivf_lists": 0, "segment": 0}
+VECTORS_FILE, LISTS_FILE, META_FILE = "vectors.f32", "lists.i32", "meta.sqlite"
+
+def enabled() -> bool:
+    return VECTOR_BACKEND == "mmap"
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """每个向量最近的簇 (分块计算，避免 N x nlist 的大矩阵)"""
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), 8192):
+        lists[start:start + 8192] = np.argmax(np.asarray(vectors[start:start + 8192]) @ centroids.T, axis=1)
+    return lists
+
+def _to_node(node_id: str, content: str, metadata_json: str):
+    metadata = json.loads(metadata_json) if metadata_json else {}
+    try:
+        node = metadata_dict_to_node(metadata)
+        node.set_content(content or "")
+    except Exception:
+        # 从 ES 导入的非 LlamaIndex 数据没有 _node_content
+        node = TextNode(text=content or "", metadata=metadata, id_=node_id)
+    return node
+
+# -----------------------------------------------------------
+# 1. 存储
+# -----------------------------------------------------------
+class MmapVectorStore:
+    """一个集合 (对应一个 ES 索引) 的向量文件 + 元数据表"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.centroids_path = os.path.join(path, "centroids.npy")
+        self.state_path = os.path.join(path, "state.json")
+        self._lock = threading.Lock()
+        self._state = dict(EMPTY_STATE)
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._partition_codes = np.zeros(0, dtype=np.int16)
+        self._partition_names: List[str] = []
+        self._centroids = None
+        self._inverted = None  # ([每个簇的行号数组], 未分配簇的行号)
+        with self._db() as db:
+            db.executescript(SCHEMA)
+
+    def _file(self, name: str, state: Dict) -> str:
+        """state 所指那一代的文件 (segment 0 沿用不带编号的文件名)"""
+        segment = state.get("segment", 0)
+        if segment:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}.{segment}{ext}"
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _db(self, state: Dict = None):
+        db = sqlite3.connect(self._file(META_FILE, state or self._read_state()), timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")  # 写入时不阻塞检索进程读取
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    @contextmanager
+    def _write_lock(self):
+        """跨进程写锁 (在线入库与批量导入可能同时写)"""
+        with open(os.path.join(self.path, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_state(self) -> Dict:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict(EMPTY_STATE)
+
+    def _write_state(self, state: Dict):
+        # 向量和元数据都写完后才更新 state，检索进程不会读到写了一半的数据
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # --- 加载 ---
+    def _refresh(self):
+        state = self._read_state()
+        with self._lock:
+            if state == self._state:
+                return
+            full = state["generation"] != self._state["generation"] or state["rows"] < self._state["rows"]
+            self._load(state, full)
+            self._state = state
+
+    def _partition_code(self, name: str) -> int:
+        if name not in self._partition_names:
+            self._partition_names.append(name)
+        return self._partition_names.index(name)
+
+    def _load(self, state: Dict, full: bool):
+        rows, dims = state["rows"], state["dims"]
+        if rows:
+            self._vectors = np.memmap(self._file(VECTORS_FILE, state), dtype=np.float32, mode="r", shape=(rows, dims))
+        else:
+            self._vectors = np.zeros((0, dims), dtype=np.float32)
+
+        # 追加写入时只加载新行的删除标记和分区
+        start = 0 if full else len(self._alive)
+        if full:
+            self._partition_names = []
+        alive = np.zeros(rows - start, dtype=bool)
+        codes = np.zeros(rows - start, dtype=np.int16)
+        with self._db(state) as db:
+            records = db.execute(
+                "SELECT row, partition, deleted FROM chunks WHERE row >= ? AND row < ?", (start, rows)
+            ).fetchall()
+        for row, partition, deleted in records:
+            alive[row - start] = not deleted
+            codes[row - start] = self._partition_code(partition)
+        if full:
+            self._alive, self._partition_codes = alive, codes
+        else:
+            self._alive = np.concatenate([self._alive, alive])
+            self._partition_codes = np.concatenate([self._partition_codes, codes])
+
+        if state.get("ivf_lists") and os.path.exists(self.centroids_path):
+            if full or self._centroids is None:
+                self._centroids = np.load(self.centroids_path)
+            lists = np.memmap(self._file(LISTS_FILE, state), dtype=np.int32, mode="r", shape=(rows,)) if rows else np.zeros(0, np.int32)
+            self._inverted = self._build_inverted(np.asarray(lists), len(self._centroids))
+        else:
+            self._centroids = self._inverted = None
+        print(f"📂 [mmap 向量库] 已加载 {self.path}: {rows} 行, 有效 {int(self._alive.sum())}, IVF {state.get('ivf_lists', 0)} 簇")
+
+    @staticmethod
+    def _build_inverted(lists: np.ndarray, nlist: int):
+        order = np.argsort(lists, kind="stable")
+        bounds = np.searchsorted(lists[order], np.arange(-1, nlist + 1))
+        inverted = [order[bounds[i + 1]:bounds[i + 2]] for i in range(nlist)]
+        return inverted, order[bounds[0]:bounds[1]]
+
+    # --- 写入 ---
+    def add(self, nodes: list, partition: str = None) -> int:
+        """
+        写入已经带 embedding 的节点 (与 ElasticsearchStore.add 同名，BulkWriter 可直接替换)
+        :param partition: 节点 metadata 里没有分区时使用的分区
+        """
+        records = []
+        for node in nodes:
+            records.append((
+                node.node_id,
+                node.get_content(metadata_mode=MetadataMode.NONE),
+                node_to_metadata_dict(node, remove_text=True, flat_metadata=False),
+                node.get_embedding(),
+            ))
+        return self.add_records(records, partition)
+
+    def add_records(self, records: List[tuple], partition: str = None) -> int:
+        """:param records: [(node_id, 正文, LlamaIndex 元数据, 向量)]"""
+        if not records:
+            return 0
+        vectors = _normalize(np.asarray([r[3] for r in records], dtype=np.float32))
+        with self._write_lock():
+            state = self._read_state()
+            rows, dims = state["rows"], state["dims"] or vectors.shape[1]
+            if vectors.shape[1] != dims:
+                raise ValueError(f"向量维度不一致: 库内 {dims}，写入 {vectors.shape[1]}")
+            self._truncate(state, dims)
+
+            with open(self._file(VECTORS_FILE, state), "ab") as f:
+                f.write(vectors.tobytes())
+            if state.get("ivf_lists"):
+                # 新片段直接分到最近的簇；分布变化较大时重新 build-ivf
+                with open(self._file(LISTS_FILE, state), "ab") as f:
+                    f.write(_assign(vectors, np.load(self.centroids_path)).tobytes())
+            with self._db(state) as db:
+                db.execute("DELETE FROM chunks WHERE row >= ?", (rows,))
+                db.executemany(
+                    "INSERT INTO chunks (row, node_id, file_name, partition, content, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            rows + i,
+                            node_id,
+                            metadata.get("file_name"),
+                            metadata.get("partition") or partition or partitions.GENERAL,
+                            content,
+                            json.dumps(metadata, ensure_ascii=False),
+                        )
+                        for i, (node_id, content, metadata, _) in enumerate(records)
+                    ],
+                )
+            state.update(rows=rows + len(records), dims=dims)
+            self._write_state(state)
+        return len(records)
+
+    def _truncate(self, state: Dict, dims: int):
+        """清掉上次写入中断留下的半截数据 (state 之后的部分)"""
+        rows = state["rows"]
+        for path, row_bytes in ((self._file(VECTORS_FILE, state), dims * 4), (self._file(LISTS_FILE, state), 4)):
+            if os.path.exists(path) and os.path.getsize(path) > rows * row_bytes:
+                os.truncate(path, rows * row_bytes)
+
+    def delete_files(self, names: List[str]) -> int:
+        """按文件名删除 (只打删除标记)，返回删除的片段数"""
+        if not names:
+            return 0
+        with self._write_lock():
+            state = self._read_state()
+            with self._db(state) as db:
+                cursor = db.execute(
+                    f"UPDATE chunks SET deleted = 1 WHERE deleted = 0 AND file_name IN ({','.join('?' * len(names))})",
+                    list(names),
+                )
+                removed = cursor.rowcount
+            if removed:
+                state["generation"] += 1
+                self._write_state(state)
+        return removed
+
+    # --- 检索 ---
+    def _snapshot(self):
+        """同一代数据的一致视图，最后一项是对应的 state (fetch 按它打开同一代的元数据库)"""
+        self._refresh()
+        with self._lock:
+            return (
+                self._vectors, self._alive, self._partition_codes, list(self._partition_names),
+                self._centroids, self._inverted, self._state,
+            )
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        partition_filter: Optional[set] = None,
+        mode: str = None,
+        nprobe: int = None,
+        snapshot: tuple = None,
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        :param snapshot: _snapshot() 的结果；需要随后 fetch 时传入同一个快照
+        :return: 每个查询的 [(行号, 余弦相似度)]，按相似度降序
+        """
+        vectors, alive, codes, names, centroids, inverted, _ = snapshot or self._snapshot()
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if not len(alive):
+            return [[] for _ in queries]
+
+        mask = alive
+        if partition_filter is not None:
+            wanted = [code for code, name in enumerate(names) if name in partition_filter]
+            mask = alive & np.isin(codes, wanted)
+
+        mode = mode or MMAP_SEARCH_MODE
+        if centroids is None or (mode == "auto" and int(alive.sum()) < IVF_MIN_ROWS):
+            mode = "exact"
+        if mode == "exact":
+            return self._search_exact(vectors, queries, top_k, mask)
+
+        results = [self._search_ivf(vectors, q, top_k, mask, centroids, inverted, nprobe or IVF_NPROBE) for q in queries]
+        # 分区很小时探测的簇里可能凑不够 top_k，这些查询改用精确检索
+        short = [i for i, hits in enumerate(results) if len(hits) < top_k]
+        if short and int(mask.sum()) > min(len(results[i]) for i in short):
+            for i, hits in zip(short, self._search_exact(vectors, queries[short], top_k, mask)):
+                results[i] = hits
+        return results
+
+    @staticmethod
+    def _ranked(rows: np.ndarray, scores: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        order = np.argsort(-scores)[:top_k]
+        return [(int(rows[i]), float(scores[i])) for i in order if np.isfinite(scores[i])]
+
+    def _search_exact(self, vectors, queries: np.ndarray, top_k: int, mask: np.ndarray) -> List[List[Tuple[int, float]]]:
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(mask), BLOCK_ROWS):
+            block_mask = mask[start:start + BLOCK_ROWS]
+            if not block_mask.any():
+                continue
+            scores = queries @ np.asarray(vectors[start:start + len(block_mask)]).T
+            scores[:, ~block_mask] = -np.inf
+            rows = np.broadcast_to(np.arange(start, start + len(block_mask)), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            if best_scores.shape[1] > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1, axis=1)[:, :top_k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        return [self._ranked(rows, scores, top_k) for rows, scores in zip(best_rows, best_scores)]
+
+    def _search_ivf(self, vectors, query: np.ndarray, top_k: int, mask: np.ndarray, centroids, inverted, nprobe: int):
+        lists, unassigned = inverted
+        probes = np.argsort(-(centroids @ query))[:nprobe]
+        candidates = np.concatenate([lists[p] for p in probes] + [unassigned])
+        # 按行号顺序读取，对 memmap 的页缓存更友好
+        candidates = np.sort(candidates[mask[candidates]])
+        if not len(candidates):
+            return []
+        return self._ranked(candidates, np.asarray(vectors[candidates]) @ query, top_k)
+
+    def fetch(self, hits: List[Tuple[int, float]], state: Dict = None) -> List[NodeWithScore]:
+        """
+        行号 -> NodeWithScore (分数换算成 ES cosine 的 (1 + cos) / 2，与 ES 路径一致)
+        :param state: 检索时快照的 state；行号只在同一代数据内有效
+        """
+        if not hits:
+            return []
+        rows = [row for row, _ in hits]
+        with self._db(state) as db:
+            records = {
+                record[0]: record[1:]
+                for record in db.execute(
+                    f"SELECT row, node_id, content, metadata FROM chunks WHERE deleted = 0 AND row IN ({','.join('?' * len(rows))})",
+                    rows,
+                )
+            }
+        return [
+            NodeWithScore(node=_to_node(*records[row]), score=(1.0 + score) / 2)
+            for row, score in hits
+            if row in records
+        ]
+
+    # --- 存储回收使用 ---
+    def count_file(self, file_name: str) -> int:
+        with self._db() as db:
+            return db.execute("SELECT COUNT(*) FROM chunks WHERE deleted = 0 AND file_name = ?", (file_name,)).fetchone()[0]
+
+    def contents_with_prefix(self, prefix: str) -> List[str]:
+        """文件名以 prefix 开头的片段正文 (检查图片是否仍被同名文件引用)"""
+        with self._db() as db:
+            return [row[0] or "" for row in db.execute(
+                "SELECT content FROM chunks WHERE deleted = 0 AND substr(file_name, 1, ?) = ?", (len(prefix), prefix)
+            )]
+
+    def iter_contents(self):
+        """全部有效片段的正文 (深度 GC 检查图片引用)"""
+        with self._db() as db:
+            for (content,) in db.execute("SELECT content FROM chunks WHERE deleted = 0"):
+                yield content or ""
+
+    def exists(self) -> bool:
+        """是否写入过数据 (刚切换后端、还没 import-es 时为 False，GC 不能把全部原件当成孤立文件)"""
+        return os.path.exists(self.state_path)
+
+    def partitions(self) -> set:
+        """已加载的分区名 (内存中，不查 SQLite，供每次对话选择检索范围)"""
+        return set(self._snapshot()[3])
+
+    def partition_counts(self) -> Dict[str, int]:
+        with self._db() as db:
+            return dict(db.execute("SELECT partition, COUNT(*) FROM chunks WHERE deleted = 0 GROUP BY partition"))
+
+    # --- 文件目录 (代替 ES 的 factory_file_catalog) ---
+    def upsert_file_record(self, record: Dict):
+        # 与 compact 互斥，避免写进即将被替换的旧元数据库
+        with self._write_lock():
+            with self._db() as db:
+                db.execute(
+                    f"INSERT OR REPLACE INTO files ({', '.join(FILE_FIELDS)}) VALUES ({', '.join('?' * len(FILE_FIELDS))})",
+                    [record.get(field) for field in FILE_FIELDS],
+                )
+
+    def remove_file_record(self, name: str):
+        with self._write_lock():
+            with self._db() as db:
+                db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def get_file_record(self, name: str) -> Optional[Dict]:
+        with self._db() as db:
+            row = db.execute(f"SELECT {', '.join(FILE_FIELDS)} FROM files WHERE name = ?", (name,)).fetchone()
+        return dict(zip(FILE_FIELDS, row)) if row else None
+
+    def list_file_records(self, limit: int, after: str = None) -> Tuple[List[Dict], int]:
+        """按文件名排序分页，:return: (本页记录, 总数)"""
+        with self._db() as db:
+            rows = db.execute(
+                f"SELECT {', '.join(FILE_FIELDS)} FROM files WHERE name > ? ORDER BY name LIMIT ?",
+                (after or "", limit),
+            ).fetchall()
+            total = db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return [dict(zip(FILE_FIELDS, row)) for row in rows], total
+
+    def indexed_files(self) -> List[Dict]:
+        """按片段实际数据统计每个文件 (与 file_catalog.iter_indexed_files 的 ES 聚合结果相同结构)"""
+        with self._db() as db:
+            rows = db.execute(
+                "SELECT file_name, MIN(partition), COUNT(*), COUNT(DISTINCT json_extract(metadata, '$.page_label')) "
+                "FROM chunks WHERE deleted = 0 AND file_name IS NOT NULL GROUP BY file_name ORDER BY file_name"
+            ).fetchall()
+        return [{"name": name, "partition": partition, "chunks": chunks, "pages": pages} for name, partition, chunks, pages in rows]
+
+    # --- 维护 ---
+    def build_ivf(self, nlist: int = None, iterations: int = KMEANS_ITERATIONS) -> Dict:
+        """在有效片段上训练球面 k-means，并把全部行分配到最近的簇"""
+        with self._write_lock():
+            state = self._read_state()
+            rows, dims = state["rows"], state["dims"]
+            with self._db(state) as db:
+                alive_rows = np.array(
+                    [r[0] for r in db.execute("SELECT row FROM chunks WHERE deleted = 0 AND row < ? ORDER BY row", (rows,))],
+                    dtype=np.int64,
+                )
+            nlist = nlist or int(np.clip(np.sqrt(len(alive_rows)), 16, 4096))
+            if len(alive_rows) < nlist * 4:
+                raise ValueError(f"有效片段只有 {len(alive_rows)} 个，不足以训练 {nlist} 个簇 (精确检索已经足够快)")
+
+            started = time.perf_counter()
+            vectors = np.memmap(self._file(VECTORS_FILE, state), dtype=np.float32, mode="r", shape=(rows, dims))
+            rng = np.random.default_rng(42)
+            sample = np.sort(rng.choice(alive_rows, size=min(len(alive_rows), nlist * KMEANS_POINTS_PER_LIST), replace=False))
+            data = np.asarray(vectors[sample])
+            centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assign = _assign(data, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assign, data)
+                empty = np.bincount(assign, minlength=nlist) == 0
+                # 空簇重新随机取点，避免簇数实际变少
+                sums[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+                centroids = _normalize(sums)
+
+            lists = _assign(vectors, centroids)
+            with open(self.centroids_path + ".tmp", "wb") as f:
+                np.save(f, centroids)
+            lists_path = self._file(LISTS_FILE, state)
+            with open(lists_path + ".tmp", "wb") as f:
+                f.write(lists.tobytes())
+            os.replace(self.centroids_path + ".tmp", self.centroids_path)
+            os.replace(lists_path + ".tmp", lists_path)
+            state.update(ivf_lists=nlist, generation=state["generation"] + 1)
+            self._write_state(state)
+
+        sizes = np.bincount(lists[alive_rows], minlength=nlist)
+        summary = {
+            "lists": nlist,
+            "trained_on": len(sample),
+            "mean_list": round(float(sizes.mean()), 1),
+            "max_list": int(sizes.max()),
+            "seconds": round(time.perf_counter() - started, 1),
+        }
+        print(f"✅ [mmap 向量库] IVF 训练完成: {summary}")
+        return summary
+
+    def compact(self) -> Dict:
+        """
+        物理删除已打删除标记的片段。
+        重新编号后的数据全部写成新一代文件，最后随 state.json 一起切换；更早一代的文件在此时删除。
+        """
+        with self._write_lock():
+            state = self._read_state()
+            rows, dims = state["rows"], state["dims"]
+            with self._db(state) as db:
+                alive_rows = np.array(
+                    [r[0] for r in db.execute("SELECT row FROM chunks WHERE deleted = 0 AND row < ? ORDER BY row", (rows,))],
+                    dtype=np.int64,
+                )
+            if len(alive_rows) == rows:
+                return {"removed": 0, "rows": rows}
+
+            new_state = dict(state, rows=len(alive_rows), generation=state["generation"] + 1, segment=state.get("segment", 0) + 1)
+            self._remove_segment(new_state)  # 上次 compact 中断留下的同名文件
+
+            vectors = np.memmap(self._file(VECTORS_FILE, state), dtype=np.float32, mode="r", shape=(rows, dims))
+            with open(self._file(VECTORS_FILE, new_state), "wb") as f:
+                for start in range(0, len(alive_rows), BLOCK_ROWS):
+                    f.write(np.asarray(vectors[alive_rows[start:start + BLOCK_ROWS]]).tobytes())
+            if state.get("ivf_lists"):
+                lists = np.memmap(self._file(LISTS_FILE, state), dtype=np.int32, mode="r", shape=(rows,))
+                with open(self._file(LISTS_FILE, new_state), "wb") as f:
+                    f.write(np.asarray(lists[alive_rows]).tobytes())
+
+            # 元数据库先完整复制到新文件再重新编号，当前这一代的文件保持不变
+            with self._db(state) as source, self._db(new_state) as target:
+                source.backup(target)
+            with self._db(new_state) as db:
+                db.execute("DELETE FROM chunks WHERE deleted = 1 OR row >= ?", (rows,))
+                # 按行号升序改小，新行号不会与尚未处理的行冲突
+                db.executemany(
+                    "UPDATE chunks SET row = ? WHERE row = ?",
+                    [(new, int(old)) for new, old in enumerate(alive_rows) if new != old],
+                )
+            with self._db(new_state) as db:
+                db.execute("VACUUM")
+
+            self._write_state(new_state)
+            # 上一代保留给正在进行的检索 (检索与取正文之间)，再早的已无人使用
+            if new_state["segment"] >= 2:
+                self._remove_segment(dict(new_state, segment=new_state["segment"] - 2))
+        return {"removed": rows - len(alive_rows), "rows": len(alive_rows)}
+
+    def _remove_segment(self, state: Dict):
+        for name in (VECTORS_FILE, LISTS_FILE, META_FILE):
+            for suffix in ("", "-wal", "-shm") if name == META_FILE else ("",):
+                path = self._file(name, state) + suffix
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def stats(self) -> Dict:
+        state = self._read_state()
+        with self._db(state) as db:
+            alive = db.execute("SELECT COUNT(*) FROM chunks WHERE deleted = 0 AND row < ?", (state["rows"],)).fetchone()[0]
+        size = lambda path: os.path.getsize(path) if os.path.exists(path) else 0
+        return {
+            "path": self.path,
+            "rows": state["rows"],
+            "alive": alive,
+            "deleted": state["rows"] - alive,
+            "dims": state["dims"],
+            "ivf_lists": state.get("ivf_lists", 0),
+            "vectors_mb": round(size(self._file(VECTORS_FILE, state)) / 1e6, 1),
+            "meta_mb": round(size(self._file(META_FILE, state)) / 1e6, 1),
+            "partitions": self.partition_counts(),
+        }
+
+# -----------------------------------------------------------
+# 2. 检索 / 入库入口 (参数沿用 ES 的索引名)
+# -----------------------------------------------------------
+_stores: Dict[str, MmapVectorStore] = {}
+_stores_lock = threading.Lock()
+
+def get_store(collection: str = INDEX_NAME) -> MmapVectorStore:
+    with _stores_lock:
+        if collection not in _stores:
+            _stores[collection] = MmapVectorStore(os.path.join(MMAP_STORE_DIR, collection))
+        return _stores[collection]
+
+def resolve_target(index_name: str) -> Tuple[str, Optional[set]]:
+    """
+    ES 的索引表达式 -> (集合, 分区过滤)。
+    分区别名 (见 partitions.search_target / write_target) 都落在同一个集合里，按分区列过滤。
+    """
+    names = [name.strip() for name in index_name.split(",") if name.strip()]
+    prefix = partitions.ALIAS_PREFIX
+    if names and all(name.startswith(prefix) for name in names):
+        return INDEX_NAME, {name[len(prefix):] for name in names}
+    if len(names) != 1:
+        raise ValueError(f"mmap 后端不支持同时检索多个索引: {index_name}")
+    return names[0], None
+
+def add_nodes(index_name: str, nodes: list) -> int:
+    collection, partition_filter = resolve_target(index_name)
+    partition = next(iter(partition_filter)) if partition_filter and len(partition_filter) == 1 else None
+    return get_store(collection).add(nodes, partition)
+
+def search_nodes(index_name: str, vectors: list, top_k: int) -> List[List[NodeWithScore]]:
+    """与 ES kNN 相同的结果约定：每个查询向量一组按分数降序的 NodeWithScore"""
+    collection, partition_filter = resolve_target(index_name)
+    store = get_store(collection)
+    snapshot = store._snapshot()
+    hits = store.search(np.asarray(vectors, dtype=np.float32), top_k, partition_filter, snapshot=snapshot)
+    return [store.fetch(row_hits, snapshot[-1]) for row_hits in hits]
+
+def delete_files(names: List[str], index_name: str = INDEX_NAME) -> int:
+    return get_store(resolve_target(index_name)[0]).delete_files(names)
+
+def drop_store(collection: str):
+    """删除整个集合 (重新导入、评测索引重建时使用)"""
+    with _stores_lock:
+        _stores.pop(collection, None)
+    path = os.path.join(MMAP_STORE_DIR, collection)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+# -----------------------------------------------------------
+# 3. 从 ES 导入 / 基准测试
+# -----------------------------------------------------------
+def import_from_es(index_name: str = INDEX_NAME, replace: bool = False, batch_size: int = 1000) -> int:
+    """把 ES 知识库 (含全部分区) 的片段、向量原样复制到 mmap 集合，节点 ID 保持不变"""
+    path = os.path.join(MMAP_STORE_DIR, index_name)
+    if get_store(index_name).stats()["rows"]:
+        if not replace:
+            raise ValueError(f"{path} 已有数据，如需重新导入请加 --replace")
+        drop_store(index_name)
+    store = get_store(index_name)
+
+    pit = es_request("POST", f"/{index_name}/_pit", params={"keep_alive": "5m"})
+    pit_id, after, total = pit["id"], None, 0
+    started = time.perf_counter()
+    try:
+        while True:
+            body = {
+                "size": batch_size,
+                "_source": ["content", "metadata", "embedding"],
+                "pit": {"id": pit_id, "keep_alive": "5m"},
+                "sort": [{"_shard_doc": "asc"}],
+            }
+            if after:
+                body["search_after"] = after
+            result = es_request("POST", "/_search", body, timeout=120)
+            pit_id = result.get("pit_id", pit_id)
+            hits = result.get("hits", {}).get("hits", [])
+            records = [
+                (hit["_id"], hit["_source"].get("content", ""), hit["_source"].get("metadata", {}), hit["_source"]["embedding"])
+                for hit in hits
+                if hit["_source"].get("embedding")
+            ]
+            total += store.add_records(records)
+            print(f"📥 已导入 {total} 个片段 ({total / max(time.perf_counter() - started, 1e-6):.0f} 个/s)")
+            if len(hits) < batch_size:
+                break
+            after = hits[-1]["sort"]
+    finally:
+        es_request("DELETE", "/_pit", {"id": pit_id}, ignore=(404,))
+    return total
+
+def _es_memory(index_name: str) -> Dict:
+    from app.core.index_schema import index_stats
+    stats = index_stats(index_name)
+    jvm = es_request("GET", "/_nodes/stats/jvm")["nodes"]
+    heap = sum(node["jvm"]["mem"]["heap_used_in_bytes"] for node in jvm.values())
+    return {"docs": stats["docs"], "ram_mb": round(stats["vector_ram_mb"] + heap / 1e6, 1)}
+
+def benchmark(index_name: str = INDEX_NAME, samples: int = 50, k: int = 10, nprobe: int = IVF_NPROBE) -> List[Dict]:
+    """
+    同一组查询分别跑 ES kNN、mmap 精确检索、mmap IVF：延迟 p50/p95 + 相对精确检索的 recall@k + 常驻内存估算。
+    查询向量取自库内片段；两边节点 ID 一致 (import-es 导入)，用 mmap 精确检索结果作为共同基准。
+    只计检索本身 (ES 请求同样不返回 _source)，不含取正文和精排。
+    """
+    from app.core.index_schema import _knn_ids, _percentile, NUM_CANDIDATES
+
+    store = get_store(index_name)
+    _, alive, *_ = store._snapshot()
+    alive_rows = np.flatnonzero(alive)
+    if not len(alive_rows):
+        print("mmap 集合为空，请先执行 import-es")
+        return []
+    rng = np.random.default_rng(42)
+    sample = np.sort(rng.choice(alive_rows, size=min(samples, len(alive_rows)), replace=False))
+    queries = np.asarray(store._vectors[sample])
+    truth_rows = [{row for row, _ in hits} for hits in store.search(queries, k, mode="exact")]
+    with store._db() as db:
+        row_ids = dict(db.execute("SELECT row, node_id FROM chunks WHERE deleted = 0"))
+    truth_ids = [{row_ids[row] for row in rows} for rows in truth_rows]
+
+    def measure(backend: str, run, truth, memory: Dict) -> Dict:
+        for q in queries[:5]:  # 预热 (页缓存 / ES 向量文件)
+            run(q)
+        latencies, recalls = [], []
+        for q, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = run(q)
+            latencies.append(time.perf_counter() - started)
+            recalls.append(len(expected & set(found)) / max(1, len(expected)))
+        row = {"backend": backend, **memory}
+        row.update({
+            "p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+            f"recall@{k}": round(sum(recalls) / len(recalls), 3),
+        })
+        return row
+
+    stats = store.stats()
+    mmap_memory = {"docs": stats["alive"], "ram_mb": round(stats["vectors_mb"] + stats["meta_mb"], 1)}
+    exact = lambda q: [row for row, _ in store.search(q, k, mode="exact")[0]]
+    rows = [measure("mmap exact", exact, truth_rows, mmap_memory)]
+    if stats["ivf_lists"]:
+        ivf = lambda q: [row for row, _ in store.search(q, k, mode="ivf", nprobe=nprobe)[0]]
+        rows.append(measure(f"mmap ivf/{nprobe}", ivf, truth_rows, mmap_memory))
+    try:
+        es_knn = lambda q: _knn_ids(index_name, q.tolist(), k, NUM_CANDIDATES)[0]
+        rows.append(measure(f"es knn/{NUM_CANDIDATES}", es_knn, truth_ids, _es_memory(index_name)))
+    except ESError as e:
+        print(f"⚠️ ES 不可用，跳过 ES 对比: {e}")
+    return rows
+
+def main(argv=None):
+    from app.core.index_schema import print_comparison
+
+    parser = argparse.ArgumentParser(description="mmap 向量库管理 (VECTOR_BACKEND=mmap)")
+    parser.add_argument("--index", default=INDEX_NAME, help="集合名 (与 ES 索引同名)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import-es", help="从 ES 知识库导入片段和向量")
+    p_import.add_argument("--replace", action="store_true", help="清空已有数据后重新导入")
+    p_ivf = sub.add_parser("build-ivf", help="训练 IVF 聚类")
+    p_ivf.add_argument("--lists", type=int, default=None, help="簇数，默认 sqrt(片段数)")
+    p_bench = sub.add_parser("benchmark", help="与 ES kNN 对比延迟、召回率和内存")
+    p_bench.add_argument("--samples", type=int, default=50)
+    p_bench.add_argument("--k", type=int, default=10)
+    p_bench.add_argument("--nprobe", type=int, default=IVF_NPROBE)
+    sub.add_parser("compact", help="回收已删除片段占用的空间")
+    sub.add_parser("stats", help="查看集合状态")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "import-es":
+            import_from_es(args.index, replace=args.replace)
+        elif args.command == "build-ivf":
+            get_store(args.index).build_ivf(args.lists)
+        elif args.command == "benchmark":
+            print_comparison(benchmark(args.index, samples=args.samples, k=args.k, nprobe=args.nprobe))
+        elif args.command == "compact":
+            print(f"🧹 compact 完成: {get_store(args.index).compact()}")
+        print(json.dumps(get_store(args.index).stats(), ensure_ascii=False, indent=2))
+    except (ESError, ValueError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# app/core/model_server.py
+"""
+本地模型服务进程 (可选)
+
+默认情况下 bge-m3、bge-reranker、Whisper 都在 API 进程里加载；用 `uvicorn --workers N` 横向扩展时
+每个 worker 都会各自加载一份权重。开启模型服务后，模型只在这个进程里加载一次，API worker 通过
+Unix Socket 调用，自身保持无状态、可以按 CPU 核数扩展。
+
+启动：
+    python -m app.core.model_server --socket /tmp/factory_models.sock
+    MODEL_SERVER_SOCKET=/tmp/factory_models.sock uvicorn app.main:app --workers 4
+
+协议：4 字节大端长度 + JSON，请求 {"op": ..., "payload": ...}，响应 {"ok": bool, "result"/"error": ...}。
+embed / rerank 请求在服务端做微批 (micro-batching)：等待 MODEL_BATCH_WAIT_MS 或凑满 MODEL_MAX_BATCH
+后一次前向计算，多个 worker 的并发请求合并成一个 batch。
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+MODEL_SERVER_SOCKET = os.getenv("MODEL_SERVER_SOCKET", "")  # 为空表示在本进程内加载模型
+MODEL_MAX_BATCH = int(os.getenv("MODEL_MAX_BATCH", "32"))
+MODEL_BATCH_WAIT_MS = float(os.getenv("MODEL_BATCH_WAIT_MS", "5"))
+MODEL_CLIENT_TIMEOUT = float(os.getenv("MODEL_CLIENT_TIMEOUT", "300"))
+
+EMBED_MODEL_PATH = "models/hub/models--BAAI--bge-m3"
+RERANK_MODEL_PATH = "models/hub/models--BAAI--bge-reranker-v2-m3"
+WHISPER_MODEL_SIZE = "small"
+WHISPER_DOWNLOAD_ROOT = "./models/whisper"
+
+# ==============================================================================
+# 1. 模型加载 (本进程模式与模型服务共用)
+# ==============================================================================
+def load_embed_model():
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name=EMBED_MODEL_PATH)
+
+def load_reranker(top_n: int):
+    from llama_index.postprocessor.flag_embedding_reranker import FlagEmbeddingReranker
+    return FlagEmbeddingReranker(
+        model=RERANK_MODEL_PATH,
+        top_n=top_n,
+        use_fp16=True  # 必须开启半精度，进一步省显存
+    )
+
+def load_flag_reranker():
+    """模型服务直接使用底层 FlagReranker，便于把多个请求的 (query, passage) 对合并打分"""
+    from FlagEmbedding import FlagReranker
+    return FlagReranker(RERANK_MODEL_PATH, use_fp16=True)
+
+def load_whisper(cpu_threads: int = 0):
+    from faster_whisper import WhisperModel
+    # 为了防止显存(VRAM)溢出，强制使用 "cpu" 和 "int8" 量化；cpu_threads=0 表示由 CTranslate2 自行决定
+    return WhisperModel(
+        WHISPER_MODEL_SIZE, device="cpu", compute_type="int8",
+        cpu_threads=cpu_threads, download_root=WHISPER_DOWNLOAD_ROOT,
+    )
+
+# ==============================================================================
+# 2. 通信协议
+# ==============================================================================
+def _encode(message: dict) -> bytes:
+    data = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return len(data).to_bytes(4, "big") + data
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("模型服务连接已断开")
+        buf.extend(chunk)
+    return bytes(buf)
+
+class ModelServerError(RuntimeError):
+    """模型服务返回错误或不可达"""
+
+class ModelClient:
+    """
+    模型服务客户端。每个线程持有一条长连接 (Unix Socket)，断线自动重连一次 (见 call)。
+    """
+
+    def __init__(self, socket_path: str = None, timeout: float = MODEL_CLIENT_TIMEOUT):
+        self.socket_path = socket_path or MODEL_SERVER_SOCKET
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+            self._local.sock = None
+
+    def call(self, op: str, payload: Any = None) -> Any:
+        """
+        连接/发送失败，或复用的长连接已被服务端关闭 (服务重启) 时重连重发一次。
+        等待响应超时不重发：服务端可能仍在计算，重发会让同一个任务 (如长语音识别) 再算一遍。
+        """
+        request = _encode({"op": op, "payload": payload})
+        for attempt in range(2):
+            reused = getattr(self._local, "sock", None) is not None
+            try:
+                sock = self._local.sock if reused else self._connect()
+                sock.sendall(request)
+            except OSError as e:
+                self._close()
+                if attempt == 1:
+                    raise ModelServerError(f"模型服务不可用 ({self.socket_path}): {e}") from e
+                continue
+            try:
+                size = int.from_bytes(_recv_exact(sock, 4), "big")
+                response = json.loads(_recv_exact(sock, size).decode("utf-8"))
+                break
+            except socket.timeout as e:
+                self._close()
+                raise ModelServerError(f"模型服务 {self.timeout:.0f}s 内未返回 ({op})") from e
+            except OSError as e:
+                self._close()
+                if attempt == 1 or not reused:
+                    raise ModelServerError(f"模型服务连接中断 ({self.socket_path}): {e}") from e
+        if not response.get("ok"):
+            raise ModelServerError(response.get("error", "未知错误"))
+        return response["result"]
+
+_client: Optional[ModelClient] = None
+
+def get_client() -> ModelClient:
+    global _client
+    if _client is None:
+        _client = ModelClient()
+    return _client
+
+# ==============================================================================
+# 3. 远程模型适配器 (与本地模型同接口，agent/kb_manager 无需感知)
+# ==============================================================================
+class RemoteEmbedding(BaseEmbedding):
+    """通过模型服务计算向量，接口与 HuggingFaceEmbedding 一致"""
+
+    model_name: str = Field(default=EMBED_MODEL_PATH)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RemoteEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return get_client().call("embed", {"mode": "query", "texts": [query]})[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return get_client().call("embed", {"mode": "text", "texts": [text]})[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return get_client().call("embed", {"mode": "text", "texts": texts})
+
+    def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """一次请求计算多条查询向量"""
+        return get_client().call("embed", {"mode": "query", "texts": queries})
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self._get_text_embedding, text)
+
+class RemoteReranker(BaseNodePostprocessor):
+    """通过模型服务打分的精排器，行为与 FlagEmbeddingReranker 一致 (按分数降序取 top_n)"""
+
+    top_n: int = Field(default=5)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RemoteReranker"
+
+    def compute_scores(self, pairs: List[List[str]]) -> List[float]:
+        return get_client().call("rerank", {"pairs": pairs})
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if not nodes:
+            return []
+        pairs = [[query_bundle.query_str, node.node.get_content(metadata_mode=MetadataMode.EMBED)] for node in nodes]
+        for node, score in zip(nodes, self.compute_scores(pairs)):
+            node.score = score
+        return sorted(nodes, key=lambda x: -float(x.score or 0.0))[: self.top_n]
+
+def transcribe_remote(audio_path: str, **options) -> dict:
+    """远程语音识别：模型服务与 API 在同一台机器上，直接传绝对路径"""
+    return get_client().call("transcribe", {"path": os.path.abspath(audio_path), "options": options})
+
+# ==============================================================================
+# 4. 服务端
+# ==============================================================================
+class MicroBatcher:
+    """把并发请求合并成一个 batch 调用 fn(flat_items) -> flat_results"""
+
+    def __init__(self, name: str, fn, max_batch: int = MODEL_MAX_BATCH, max_wait_ms: float = MODEL_BATCH_WAIT_MS):
+        self.name = name
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.stats = {"requests": 0, "items": 0, "batches": 0, "busy_seconds": 0.0}
+
+    async def submit(self, items: list) -> list:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            count = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    nxt = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(nxt)
+                count += len(nxt[0])
+
+            flat = [item for items, _ in batch for item in items]
+            started = time.perf_counter()
+            try:
+                results = await asyncio.to_thread(self.fn, flat)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.stats["busy_seconds"] += time.perf_counter() - started
+
+            self.stats["requests"] += len(batch)
+            self.stats["items"] += len(flat)
+            self.stats["batches"] += 1
+            offset = 0
+            for items, future in batch:
+                if not future.done():
+                    future.set_result(results[offset: offset + len(items)])
+                offset += len(items)
+
+class ModelServer:
+    def __init__(self, load_voice: bool = True):
+        print("🚀 [模型服务] 正在加载模型...")
+        self.embed_model = load_embed_model()
+        self.reranker = load_flag_reranker()
+        # Whisper 实例池 (长语音按 VAD 切段后在池内并行识别，见 app/core/transcription.py)
+        from app.core.transcription import WhisperPool
+        self.voice_pool = None
+        if load_voice:
+            try:
+                self.voice_pool = WhisperPool()
+                self.voice_pool.warm_up()
+            except Exception as e:
+                self.voice_pool = None
+                print(f"语音模型加载失败: {e}")
+        self.batchers = {
+            "query": MicroBatcher("embed_query", self._embed_queries),
+            "text": MicroBatcher("embed_text", self._embed_texts),
+            "rerank": MicroBatcher("rerank", self._rerank),
+        }
+        print("✅ [模型服务] 模型加载完成")
+
+    # --- 实际计算 (在线程中执行) ---
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_model.get_text_embedding_batch(texts)
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        # bge-m3 查询不加指令，与文本向量一致，可以直接批量计算
+        if not getattr(self.embed_model, "query_instruction", None):
+            return self.embed_model.get_text_embedding_batch(queries)
+        return [self.embed_model.get_query_embedding(q) for q in queries]
+
+    def _rerank(self, pairs: List[List[str]]) -> List[float]:
+        scores = self.reranker.compute_score(pairs)
+        if not isinstance(scores, list):
+            scores = [scores]
+        return [float(s) for s in scores]
+
+    def _transcribe(self, path: str, options: dict) -> dict:
+        from app.core.transcription import transcribe_audio
+        if self.voice_pool is None:
+            raise RuntimeError("语音模型未加载")
+        return transcribe_audio(self.voice_pool, path, **options)
+
+    # --- 请求分发 ---
+    async def dispatch(self, op: str, payload: Any) -> Any:
+        if op == "embed":
+            return await self.batchers[payload["mode"]].submit(payload["texts"])
+        if op == "rerank":
+            return await self.batchers["rerank"].submit(payload["pairs"])
+        if op == "transcribe":
+            return await asyncio.to_thread(self._transcribe, payload["path"], payload.get("options") or {})
+        if op == "stats":
+            return {name: b.stats for name, b in self.batchers.items()}
+        if op == "ping":
+            return "pong"
+        raise ValueError(f"未知操作: {op}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    break
+                request = json.loads((await reader.readexactly(int.from_bytes(header, "big"))).decode("utf-8"))
+                try:
+                    response = {"ok": True, "result": await self.dispatch(request.get("op"), request.get("payload"))}
+                except Exception as e:
+                    response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                writer.write(_encode(response))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        for batcher in self.batchers.values():
+            asyncio.create_task(batcher.run())
+        server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        os.chmod(socket_path, 0o660)
+        print(f"🔌 [模型服务] 监听 {socket_path}")
+        async with server:
+            await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="工厂智能助手 - 共享模型服务")
+    parser.add_argument("--socket", default=MODEL_SERVER_SOCKET or "/tmp/factory_models.sock")
+    parser.add_argument("--no-voice", action="store_true", help="不加载 Whisper 语音模型")
+    args = parser.parse_args(argv)
+
+    server = ModelServer(load_voice=not args.no_voice)
+    try:
+        asyncio.run(server.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
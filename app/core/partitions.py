@@ -0,0 +1,189 @@
+# app/core/partitions.py
+"""
+按产线 / 设备族分区的知识库
+
+所有文档原来都写进同一个 factory_knowledge 索引，每次检索都要在全部工厂的资料里做 kNN，
+接入的工厂越多越慢、误召回也越多。现在：
+- 入库时给文档打上分区键 (partition)，例如 line3_conveyor；没有分区的文档属于 general
+- 每个分区一个独立的实际索引，写入别名 factory_knowledge_p_{分区}；同时挂在 factory_knowledge 别名下，
+  文件目录、删除、GC 等全库操作照旧通过 factory_knowledge 进行
+- general 分区就是原来的索引 (factory_knowledge 的写入索引)，另有只读别名 factory_knowledge_p_general
+- 检索时按对话请求的 scope 或从问题中识别出的分区只查该分区 (+ general 通用资料)，
+  单次检索的 kNN 规模只取决于分区大小，不随总库增长
+
+分区定义文件 (PARTITIONS_FILE，默认 partitions.json)，关键词用于从问题/文件名中识别分区：
+    {
+      "line3_conveyor": {"name": "三号线输送机", "keywords": ["三号线", "3号线", "输送机"]},
+      "line5_robot": {"name": "五号线焊接机器人", "keywords": ["五号线", "焊接机器人"]}
+    }
+"""
+
+import os
+import re
+import json
+import time
+from typing import Dict, Optional
+
+from app.core.es_client import es_request, index_exists, ESError, INDEX_NAME
+from app.core.index_schema import ensure_knowledge_index, resolve_index, create_index, versioned_name
+
+PARTITIONS_FILE = os.getenv("PARTITIONS_FILE", "partitions.json")
+# 分区检索时是否同时检索 general (通用资料，如安全规程)
+PARTITION_INCLUDE_GENERAL = os.getenv("PARTITION_INCLUDE_GENERAL", "true").lower() == "true"
+GENERAL = "general"
+ALL = "all"
+ALIAS_PREFIX = f"{INDEX_NAME}_p_"
+KEY_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_\-]{0,47}$")  # ES 索引名只允许小写
+ALIAS_CACHE_SECONDS = 30
+
+# -----------------------------------------------------------
+# 1. 分区定义
+# -----------------------------------------------------------
+_config_cache = {"mtime": None, "partitions": {}}
+
+def load_partitions() -> Dict[str, Dict]:
+    """读取分区定义 (文件修改后自动重新加载)"""
+    try:
+        mtime = os.path.getmtime(PARTITIONS_FILE)
+    except OSError:
+        return {}
+    if mtime != _config_cache["mtime"]:
+        with open(PARTITIONS_FILE, "r", encoding="utf-8") as f:
+            partitions = json.load(f)
+        _config_cache.update(mtime=mtime, partitions={normalize_key(k): v for k, v in partitions.items()})
+    return _config_cache["partitions"]
+
+def normalize_key(key: str) -> str:
+    key = key.strip().lower()
+    if not KEY_PATTERN.match(key):
+        raise ValueError(f"无效的分区键: {key} (只允许小写字母、数字、下划线、短横线)")
+    return key
+
+def infer_partition(text: str) -> Optional[str]:
+    """按关键词识别分区：命中关键词最多且唯一的分区胜出，不确定时返回 None (检索全库)"""
+    scores = {}
+    for key, info in load_partitions().items():
+        hits = sum(1 for keyword in info.get("keywords", []) if keyword and keyword in text)
+        if hits:
+            scores[key] = hits
+    if not scores:
+        return None
+    best = max(scores.values())
+    winners = [key for key, score in scores.items() if score == best]
+    return winners[0] if len(winners) == 1 else None
+
+def resolve_scope(scope: Optional[str], query: str) -> Optional[str]:
+    """
+    对话请求的 scope -> 检索分区；None 表示检索全库。
+    scope 为空时从问题中识别；scope="all" 表示明确要求全库检索。
+    """
+    if scope:
+        key = normalize_key(scope)
+        if key == ALL:
+            return None
+        if key != GENERAL and key not in load_partitions() and key not in existing_partitions():
+            raise ValueError(f"未知的分区: {scope}")
+        return key
+    return infer_partition(query)
+
+def ingest_partition(scope: Optional[str], text: str) -> str:
+    """入库时的分区：指定的 scope > 从文件名/内容中识别 > general"""
+    if scope:
+        key = normalize_key(scope)
+        if key == ALL:
+            raise ValueError("入库时必须指定具体分区，不能使用 all")
+        return key
+    return infer_partition(text) or GENERAL
+
+# -----------------------------------------------------------
+# 2. 分区索引
+# -----------------------------------------------------------
+def partition_alias(key: str) -> str:
+    return f"{ALIAS_PREFIX}{key}"
+
+def write_target(key: Optional[str]) -> str:
+    """入库写入的别名：general 写原来的 factory_knowledge，其余写各自的分区别名"""
+    return INDEX_NAME if not key or key == GENERAL else partition_alias(key)
+
+_ensured = set()
+_alias_cache = {"at": 0.0, "keys": set()}
+
+def ensure_partition_index(key: Optional[str]):
+    """写入前调用：按需创建分区索引，并挂到 factory_knowledge 别名下"""
+    key = key or GENERAL
+    if key in _ensured or _mmap_backend():
+        return
+    ensure_knowledge_index(INDEX_NAME)
+    general = partition_alias(GENERAL)
+    if not index_exists(general):
+        # 原来的索引 (迁移前是普通索引，迁移后是别名背后的实际索引) 作为 general 分区
+        es_request("POST", "/_aliases", {"actions": [{"add": {"index": resolve_index(INDEX_NAME), "alias": general}}]})
+
+    alias = partition_alias(key)
+    if key != GENERAL and not index_exists(alias):
+        if resolve_index(INDEX_NAME) == INDEX_NAME:
+            raise ESError(f"{INDEX_NAME} 仍是普通索引，无法挂载分区索引，请先执行: python -m app.core.index_schema migrate")
+        physical = versioned_name(alias)
+        create_index(physical, alias, read_aliases=(INDEX_NAME,))
+        print(f"🗂️ 已创建分区索引 {physical} (别名 {alias})")
+    _ensured.add(key)
+    _alias_cache["at"] = 0.0
+
+def _mmap_backend() -> bool:
+    # mmap 后端 (见 mmap_store.py) 所有分区在同一个集合里按分区列过滤，不需要 ES 别名
+    from app.core import mmap_store
+    return mmap_store.enabled()
+
+def existing_partitions() -> set:
+    """已有数据的分区 (短时间缓存，避免每次检索都请求 ES)"""
+    if _mmap_backend():
+        from app.core import mmap_store
+        return mmap_store.get_store(INDEX_NAME).partitions()
+    if time.time() - _alias_cache["at"] > ALIAS_CACHE_SECONDS:
+        try:
+            result = es_request("GET", f"/_alias/{ALIAS_PREFIX}*", ignore=(404,))
+        except ESError:
+            return _alias_cache["keys"]
+        keys = set()
+        for info in result.values():
+            if isinstance(info, dict):
+                keys.update(name[len(ALIAS_PREFIX):] for name in info.get("aliases", {}) if name.startswith(ALIAS_PREFIX))
+        _alias_cache.update(at=time.time(), keys=keys)
+    return _alias_cache["keys"]
+
+def search_keys(key: Optional[str]) -> Optional[set]:
+    """
+    检索范围内的分区键：None -> 全库；分区 -> 该分区 (+ general)。
+    分区还没有任何数据时退回全库检索，避免检索不存在的索引报错。
+    """
+    if not key:
+        return None
+    existing = existing_partitions()
+    if key not in existing:
+        return None
+    keys = {key}
+    if PARTITION_INCLUDE_GENERAL and key != GENERAL and GENERAL in existing:
+        keys.add(GENERAL)
+    return keys
+
+def search_target(key: Optional[str]) -> str:
+    """检索的索引表达式：全库 -> factory_knowledge；分区 -> 分区别名 (+ general 别名)，范围见 search_keys"""
+    keys = search_keys(key)
+    if keys is None:
+        return INDEX_NAME
+    return ",".join(partition_alias(k) for k in [key] + sorted(keys - {key}))
+
+def partition_stats() -> Dict:
+    """各分区片段数，供 /admin/partitions 查看"""
+    stats = {}
+    counts = None
+    if _mmap_backend():
+        from app.core import mmap_store
+        counts = mmap_store.get_store(INDEX_NAME).partition_counts()
+    for key in sorted(existing_partitions()):
+        if counts is not None:
+            count = counts.get(key, 0)
+        else:
+            count = es_request("GET", f"/{partition_alias(key)}/_count", ignore=(404,)).get("count", 0)
+        stats[key] = {"chunks": count, "name": load_partitions().get(key, {}).get("name", key)}
+    return stats
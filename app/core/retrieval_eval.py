@@ -0,0 +1,271 @@
+# app/core/retrieval_eval.py
+"""
+检索效果 / 耗时评测工具
+
+用一份标注好的黄金集 (问题 -> 期望命中的文件/页码)，在一组参数网格上跑
+search_factory_knowledge 所用的同一条检索管线 (retrieve_nodes)，输出每组参数的
+recall@k、MRR 以及平均耗时、CPU 时间，方便挑出“质量不掉、成本最低”的配置。
+CPU 时间是整个进程的 (time.process_time)，包含模型推理线程池等后台线程，不只是检索调用所在的线程。
+
+黄金集格式 (JSON 数组或 JSONL，每条一个问题)：
+    {"question": "分拣系统急停后如何复位？", "file_name": "分拣系统手册.pdf", "page": 12}
+    {"question": "...", "expected": [{"file_name": "a.pdf", "page": 3}, {"file_name": "b.docx"}]}
+page 可省略，省略时只要命中文件即算命中。
+
+用法：
+    python -m app.core.retrieval_eval golden.jsonl \\
+        --top-k 5,10,20 --top-n 3,5 --chunk-sizes 256,512 --hybrid both --rerank both
+
+chunk_size 与线上不同时，会把 --docs-dir 下的文档按该 chunk_size 重新入库到独立的
+评测索引 (factory_knowledge_eval_cs{N})，不会影响线上索引。
+VECTOR_BACKEND=mmap 时评测 mmap 向量库 (评测索引是独立的 mmap 集合)，只能评测纯向量检索 (--hybrid off)。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from typing import List, Dict
+
+from app.core.es_client import index_exists, INDEX_NAME
+from app.core.index_schema import drop_index
+from app.core.doc_parser import load_documents, CHUNK_SIZE
+from app.core.storage_gc import UPLOAD_DIR
+from app.core import mmap_store
+# retrieve_nodes / index_documents 所在模块导入时会加载向量和精排模型，用到时才导入
+
+EVAL_INDEX_PREFIX = f"{INDEX_NAME}_eval_cs"
+
+# -----------------------------------------------------------
+# 1. 黄金集读取
+# -----------------------------------------------------------
+def load_golden_set(path: str) -> List[Dict]:
+    """读取黄金集，统一成 {"question": str, "expected": [{"file_name", "page"}]} 的结构"""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = f.read().strip()
+
+    if raw.startswith("["):
+        items = json.loads(raw)
+    else:
+        items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    golden = []
+    for item in items:
+        expected = item.get("expected")
+        if not expected:
+            expected = [{"file_name": item["file_name"], "page": item.get("page")}]
+        golden.append({
+            "question": item["question"],
+            "expected": [
+                {"file_name": e["file_name"], "page": str(e["page"]) if e.get("page") is not None else None}
+                for e in expected
+            ],
+        })
+    return golden
+
+# -----------------------------------------------------------
+# 2. 指标计算
+# -----------------------------------------------------------
+def _is_hit(node, expected: Dict) -> bool:
+    if node.metadata.get("file_name") != expected["file_name"]:
+        return False
+    if expected["page"] is None:
+        return True
+    # 版面切片的片段可能跨页 (page_label ~ page_end)
+    try:
+        start = int(node.metadata.get("page_label", 0))
+        end = int(node.metadata.get("page_end", start))
+        return start <= int(expected["page"]) <= end
+    except (TypeError, ValueError):
+        return str(node.metadata.get("page_label")) == expected["page"]
+
+def score_result(nodes: list, expected: List[Dict]) -> Dict:
+    """
+    recall@k：期望位置中被结果覆盖的比例 (k = 返回结果条数)。
+    reciprocal_rank：第一个命中结果排名的倒数，未命中为 0。
+    """
+    found = [any(_is_hit(node, e) for node in nodes) for e in expected]
+    recall = sum(found) / len(expected) if expected else 0.0
+
+    reciprocal_rank = 0.0
+    for rank, node in enumerate(nodes, start=1):
+        if any(_is_hit(node, e) for e in expected):
+            reciprocal_rank = 1.0 / rank
+            break
+    return {"recall": recall, "reciprocal_rank": reciprocal_rank}
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+# -----------------------------------------------------------
+# 3. 评测索引准备 (不同 chunk_size)
+# -----------------------------------------------------------
+def _eval_index_exists(index_name: str) -> bool:
+    if mmap_store.enabled():
+        return mmap_store.get_store(index_name).exists()
+    return index_exists(index_name)
+
+def _drop_eval_index(index_name: str):
+    if mmap_store.enabled():
+        mmap_store.drop_store(index_name)
+    else:
+        drop_index(index_name)
+
+def prepare_index(chunk_size: int, docs_dir: str, rebuild: bool = False) -> str:
+    """返回该 chunk_size 对应的索引名；与线上一致时直接使用线上索引"""
+    if chunk_size == CHUNK_SIZE:
+        return INDEX_NAME
+
+    index_name = f"{EVAL_INDEX_PREFIX}{chunk_size}"
+    if _eval_index_exists(index_name):
+        if not rebuild:
+            print(f"♻️ 复用已有评测索引: {index_name}")
+            return index_name
+        _drop_eval_index(index_name)
+
+    from app.core.kb_manager import index_documents
+    print(f"🏗️ 构建评测索引 {index_name} (chunk_size={chunk_size})")
+    for file_name in sorted(os.listdir(docs_dir)):
+        file_path = os.path.join(docs_dir, file_name)
+        if not os.path.isfile(file_path):
+            continue
+        try:
+            documents = load_documents(file_path, file_name, chunk_size=chunk_size)
+            index_documents(documents, index_name=index_name, chunk_size=chunk_size)
+        except Exception as e:
+            print(f"⚠️ 跳过无法解析的文件 {file_name}: {e}")
+    return index_name
+
+# -----------------------------------------------------------
+# 4. 网格评测
+# -----------------------------------------------------------
+def evaluate_setting(golden: List[Dict], index_name: str, top_k: int, top_n: int, hybrid: bool, rerank: bool) -> Dict:
+    from app.core.agent import retrieve_nodes
+    recalls, rrs, latencies, cpu_times, rerank_times, errors = [], [], [], [], [], 0
+
+    for item in golden:
+        timings = {}
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            nodes = retrieve_nodes(
+                item["question"],
+                similarity_top_k=top_k,
+                rerank_top_n=top_n,
+                use_rerank=rerank,
+                hybrid=hybrid,
+                index_name=index_name,
+                timings=timings,
+            )
+        except Exception as e:
+            print(f"❌ 检索失败 ({item['question']}): {e}")
+            errors += 1
+            nodes = []
+        latencies.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+        rerank_times.append(timings.get("rerank", 0.0))
+
+        scores = score_result(nodes, item["expected"])
+        recalls.append(scores["recall"])
+        rrs.append(scores["reciprocal_rank"])
+
+    n = len(golden) or 1
+    return {
+        "index": index_name,
+        "top_k": top_k,
+        "top_n": top_n,
+        "hybrid": hybrid,
+        "rerank": rerank,
+        "recall": sum(recalls) / n,
+        "mrr": sum(rrs) / n,
+        "latency_avg_ms": sum(latencies) / n * 1000,
+        "latency_p95_ms": _percentile(latencies, 95) * 1000,
+        "rerank_avg_ms": sum(rerank_times) / n * 1000,
+        # 整个进程的 CPU 时间 (含后台线程)，见模块说明
+        "process_cpu_avg_ms": sum(cpu_times) / n * 1000,
+        "errors": errors,
+    }
+
+def _parse_bool_option(value: str) -> List[bool]:
+    return {"on": [True], "off": [False], "both": [False, True]}[value]
+
+def _parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+def pick_cheapest(results: List[Dict], tolerance: float) -> Dict:
+    """在 recall 不低于最佳值 - tolerance 的配置中，选平均耗时最低的"""
+    if not results:
+        return {}
+    best_recall = max(r["recall"] for r in results)
+    candidates = [r for r in results if r["recall"] >= best_recall - tolerance]
+    return min(candidates, key=lambda r: (r["latency_avg_ms"], -r["mrr"]))
+
+def print_report(results: List[Dict]):
+    header = f"{'chunk/index':<32}{'top_k':>6}{'top_n':>6}{'hybrid':>8}{'rerank':>8}{'recall':>9}{'MRR':>8}{'avg ms':>10}{'p95 ms':>10}{'proc cpu':>10}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['index']:<32}{r['top_k']:>6}{r['top_n']:>6}{str(r['hybrid']):>8}{str(r['rerank']):>8}"
+            f"{r['recall']:>9.3f}{r['mrr']:>8.3f}{r['latency_avg_ms']:>10.1f}{r['latency_p95_ms']:>10.1f}{r['process_cpu_avg_ms']:>10.1f}"
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="知识库检索 recall / 耗时评测")
+    parser.add_argument("golden", help="黄金集文件 (JSON 或 JSONL)")
+    parser.add_argument("--top-k", default="10", help="粗排召回数量，逗号分隔，例如 5,10,20")
+    parser.add_argument("--top-n", default="5", help="精排保留数量，逗号分隔，例如 3,5")
+    parser.add_argument("--chunk-sizes", default=str(CHUNK_SIZE), help="切片大小，逗号分隔")
+    parser.add_argument("--hybrid", choices=["on", "off", "both"], default="off")
+    parser.add_argument("--rerank", choices=["on", "off", "both"], default="on")
+    parser.add_argument("--docs-dir", default=UPLOAD_DIR, help="构建评测索引时使用的原始文档目录")
+    parser.add_argument("--rebuild", action="store_true", help="强制重建评测索引")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="挑选推荐配置时允许的 recall 下降幅度")
+    parser.add_argument("--output", help="把完整结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+    if mmap_store.enabled() and args.hybrid != "off":
+        parser.error("VECTOR_BACKEND=mmap 只支持纯向量检索，--hybrid 只能为 off")
+
+    golden = load_golden_set(args.golden)
+    print(f"📋 黄金集共 {len(golden)} 条问题")
+
+    results = []
+    for chunk_size in _parse_int_list(args.chunk_sizes):
+        index_name = prepare_index(chunk_size, args.docs_dir, rebuild=args.rebuild)
+        grid = itertools.product(
+            _parse_int_list(args.top_k),
+            _parse_int_list(args.top_n),
+            _parse_bool_option(args.hybrid),
+            _parse_bool_option(args.rerank),
+        )
+        for top_k, top_n, hybrid, rerank in grid:
+            if top_n > top_k:
+                continue
+            print(f"⏱️ 评测 chunk_size={chunk_size} top_k={top_k} top_n={top_n} hybrid={hybrid} rerank={rerank}")
+            result = evaluate_setting(golden, index_name, top_k, top_n, hybrid, rerank)
+            result["chunk_size"] = chunk_size
+            results.append(result)
+
+    print_report(results)
+
+    best = pick_cheapest(results, args.tolerance)
+    if best:
+        print(
+            f"\n✅ 推荐配置 (recall 容差 {args.tolerance}): chunk_size={best['chunk_size']} "
+            f"top_k={best['top_k']} top_n={best['top_n']} hybrid={best['hybrid']} rerank={best['rerank']} "
+            f"-> recall={best['recall']:.3f}, MRR={best['mrr']:.3f}, {best['latency_avg_ms']:.1f} ms"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "recommended": best}, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已写入 {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
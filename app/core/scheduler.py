@@ -0,0 +1,196 @@
+# app/core/scheduler.py
+"""
+准入控制与优先级调度
+
+对话、文档入库、语音识别、生命周期表格解析都在同一台机器上抢 CPU。这里给每类负载一个独立的
+并发上限和排队上限，并共享一个总并发槽位：
+- 槽位空出来时按优先级分配 (对话 > 语音 > 表格解析 > 入库)，批量入库不会把对话饿死
+- 排队已满或等待超时立即拒绝 (Overloaded)，接口层返回 429 + Retry-After，而不是无限排队
+- 记录每类负载的运行数、排队数、等待时间，供 /admin/scheduler 查看
+
+每类负载的参数可通过环境变量覆盖，例如 SCHED_INGEST_CONCURRENCY=2、SCHED_CHAT_QUEUE=64。
+"""
+
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict
+
+class Overloaded(Exception):
+    """负载已满，调用方应返回 429 并在 retry_after 秒后重试"""
+
+    def __init__(self, workload: str, retry_after: int, reason: str):
+        super().__init__(f"{workload} 负载已满: {reason}")
+        self.workload = workload
+        self.retry_after = retry_after
+        self.reason = reason
+
+class WorkloadClass:
+    def __init__(self, name: str, priority: int, max_concurrency: int, max_queue: int, max_wait: float):
+        prefix = f"SCHED_{name.upper()}_"
+        self.name = name
+        self.priority = priority  # 数值越小优先级越高
+        self.max_concurrency = int(os.getenv(prefix + "CONCURRENCY", max_concurrency))
+        self.max_queue = int(os.getenv(prefix + "QUEUE", max_queue))
+        self.max_wait = float(os.getenv(prefix + "MAX_WAIT", max_wait))
+
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.avg_service_seconds = 1.0  # 服务时长的指数滑动平均，用于估算 Retry-After
+        self.recent_waits = deque(maxlen=200)
+
+    def stats(self) -> Dict:
+        waits = sorted(self.recent_waits)
+        return {
+            "priority": self.priority,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "p95_wait_ms": round(waits[int(0.95 * (len(waits) - 1))] * 1000, 1) if waits else 0.0,
+            "avg_service_ms": round(self.avg_service_seconds * 1000, 1),
+        }
+
+class AdmissionScheduler:
+    def __init__(self, total_slots: int, classes: list):
+        self.total_slots = total_slots
+        self.classes: Dict[str, WorkloadClass] = {c.name: c for c in classes}
+        self.running_total = 0
+        self._waiters = []  # 堆: (priority, seq, future, class_name)
+        self._seq = itertools.count()
+
+    def _can_run(self, cls: WorkloadClass) -> bool:
+        return self.running_total < self.total_slots and cls.running < cls.max_concurrency
+
+    def _has_waiter_at_or_above(self, priority: int) -> bool:
+        return any(w[0] <= priority and not w[2].done() for w in self._waiters)
+
+    def _start(self, cls: WorkloadClass):
+        cls.running += 1
+        cls.admitted += 1
+        self.running_total += 1
+
+    def retry_after(self, cls: WorkloadClass) -> int:
+        """按当前排队量和平均服务时长估算多久后再试"""
+        backlog = cls.queued + cls.running
+        return max(1, math.ceil(cls.avg_service_seconds * backlog / max(1, cls.max_concurrency)))
+
+    def _dispatch(self):
+        """槽位释放后，按优先级把槽位分给排队者"""
+        skipped = []
+        while self._waiters and self.running_total < self.total_slots:
+            priority, seq, future, name = heapq.heappop(self._waiters)
+            if future.done():  # 已超时/取消
+                continue
+            cls = self.classes[name]
+            if cls.running >= cls.max_concurrency:
+                skipped.append((priority, seq, future, name))
+                continue
+            cls.queued -= 1
+            self._start(cls)
+            future.set_result(True)
+        for item in skipped:
+            heapq.heappush(self._waiters, item)
+
+    async def acquire(self, name: str) -> float:
+        """获取一个执行槽位，返回排队等待的秒数；负载已满时抛出 Overloaded"""
+        cls = self.classes[name]
+        if self._can_run(cls) and not self._has_waiter_at_or_above(cls.priority):
+            self._start(cls)
+            cls.recent_waits.append(0.0)
+            return 0.0
+
+        if cls.queued >= cls.max_queue:
+            cls.rejected += 1
+            raise Overloaded(name, self.retry_after(cls), "排队已满")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (cls.priority, next(self._seq), future, name))
+        cls.queued += 1
+        # 排在前面的高优先级请求可能只是被自己类别的并发上限卡住，此时空闲槽位可以先给本请求
+        self._dispatch()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=cls.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 恰好在超时的同时拿到了槽位，交还给下一个排队者
+                self.release(name, 0.0)
+            else:
+                future.cancel()
+                cls.queued -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            cls.rejected += 1
+            raise Overloaded(name, self.retry_after(cls), "排队超时")
+        wait = time.perf_counter() - started
+        cls.recent_waits.append(wait)
+        return wait
+
+    def release(self, name: str, service_seconds: float):
+        cls = self.classes[name]
+        cls.running -= 1
+        self.running_total -= 1
+        if service_seconds > 0:
+            cls.avg_service_seconds = 0.8 * cls.avg_service_seconds + 0.2 * service_seconds
+        self._dispatch()
+
+    async def lease(self, name: str) -> "SlotLease":
+        """获取一个需要手动释放的槽位 (用于流式响应这类跨越请求函数生命周期的场景)"""
+        await self.acquire(name)
+        return SlotLease(self, name)
+
+    @asynccontextmanager
+    async def slot(self, name: str):
+        await self.acquire(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(name, time.perf_counter() - started)
+
+    def stats(self) -> Dict:
+        return {
+            "total_slots": self.total_slots,
+            "running": self.running_total,
+            "workloads": {name: cls.stats() for name, cls in self.classes.items()},
+        }
+
+class SlotLease:
+    """
+    只会释放一次的槽位句柄：检索完成、开始输出、流结束、后台任务兜底，任意一处先到都可以释放。
+    与调度器一样只能在事件循环线程里调用，因此不需要加锁。
+    """
+
+    def __init__(self, owner: AdmissionScheduler, name: str):
+        self.owner = owner
+        self.name = name
+        self.started = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.owner.release(self.name, time.perf_counter() - self.started)
+
+# 默认配置：总槽位 = CPU 核数；对话优先级最高且不单独限流，入库最多占一个槽位
+_cpus = os.cpu_count() or 4
+scheduler = AdmissionScheduler(
+    total_slots=int(os.getenv("SCHED_TOTAL_SLOTS", _cpus)),
+    classes=[
+        WorkloadClass("chat", priority=0, max_concurrency=_cpus, max_queue=32, max_wait=30),
+        WorkloadClass("voice", priority=1, max_concurrency=2, max_queue=8, max_wait=30),
+        WorkloadClass("lifecycle", priority=2, max_concurrency=2, max_queue=4, max_wait=30),
+        WorkloadClass("ingest", priority=3, max_concurrency=1, max_queue=4, max_wait=600),
+    ],
+)
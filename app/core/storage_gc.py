@@ -0,0 +1,374 @@
+# app/core/storage_gc.py
+"""
+文件删除与磁盘回收
+
+- 删除文件时以 ES 后台任务 (wait_for_completion=false) 执行 _delete_by_query，接口立即返回任务 ID，
+  前端/运维可轮询进度；任务完成后自动回收该文件的原件 (factory_docs) 与不再被引用的图片 (factory_images)。
+- 定期 GC：以知识库实际数据为准，清理磁盘上已无对应索引数据的原件和图片。
+- VECTOR_BACKEND=mmap 时删除同步完成，GC 以 mmap 向量库中的文件为准 (见 mmap_store.py)。
+"""
+
+import os
+import re
+import time
+import uuid
+import asyncio
+import datetime
+from typing import Dict, List, Optional, Set
+
+from app.core.es_client import es_request, index_exists, ESError, INDEX_NAME
+from app.core import file_catalog, media, mmap_store
+
+UPLOAD_DIR = "./factory_docs"
+IMAGES_DIR = "./factory_images"
+
+DELETE_POLL_INTERVAL = float(os.getenv("DELETE_POLL_INTERVAL", "1"))
+DELETE_WATCH_MAX_ERRORS = int(os.getenv("DELETE_WATCH_MAX_ERRORS", "20"))  # 连续查询失败次数上限，超过后放弃监视
+DELETE_JOBS_MAX = int(os.getenv("DELETE_JOBS_MAX", "1000"))  # 内存中保留的删除任务数，超出时先丢弃最早结束的
+GC_INTERVAL_SECONDS = int(os.getenv("GC_INTERVAL_SECONDS", str(6 * 3600)))  # 0 表示关闭定期 GC
+GC_GRACE_SECONDS = int(os.getenv("GC_GRACE_SECONDS", "3600"))  # 新文件保护期，避免误删正在入库的文件
+
+# 图片命名规则见 doc_parser.extract_page_items：{文件名去后缀}_p{页码}_{序号}.{扩展名}
+IMAGE_NAME_PATTERN = re.compile(r"^(?P<base>.+)_p\d+_\d+\.\w+$")
+# 链接可能带内容版本号 (?v=...)，只取文件名部分
+IMAGE_URL_PATTERN = re.compile(r"/images/([^)\s\"'?]+)")
+
+# 本进程发起的删除任务：task_id -> 任务信息 (按发起顺序，数量见 DELETE_JOBS_MAX)
+DELETE_JOBS: Dict[str, Dict] = {}
+FINISHED_STATUSES = ("completed", "failed")
+_watchers: Set[asyncio.Task] = set()
+
+def _now() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def _base_name(file_name: str) -> str:
+    return os.path.splitext(file_name)[0]
+
+def _file_query(filename: str) -> Dict:
+    return {"term": {"metadata.file_name.keyword": filename}}
+
+# -----------------------------------------------------------
+# 1. 异步删除
+# -----------------------------------------------------------
+MMAP_TASK_PREFIX = "mmap-"
+
+def _remember_job(job: Dict):
+    """登记删除任务；超出 DELETE_JOBS_MAX 时丢弃最早结束的任务 (进行中的任务仍由监视协程使用，保留)"""
+    DELETE_JOBS[job["task_id"]] = job
+    excess = len(DELETE_JOBS) - DELETE_JOBS_MAX
+    if excess > 0:
+        finished = [task_id for task_id, j in DELETE_JOBS.items() if j.get("status") in FINISHED_STATUSES]
+        for task_id in finished[:excess]:
+            del DELETE_JOBS[task_id]
+
+def _delete_from_mmap(filename: str) -> Dict:
+    """mmap 后端只打删除标记，同步完成；返回与 ES 任务相同结构的任务信息"""
+    removed = mmap_store.delete_files([filename])
+    return {
+        "task_id": f"{MMAP_TASK_PREFIX}{uuid.uuid4().hex[:12]}",
+        "file": filename,
+        "status": "completed",
+        "total": removed,
+        "deleted": removed,
+        "created_at": _now(),
+        "reclaimed": None,
+    }
+
+def start_file_deletion(filename: str) -> Dict:
+    """
+    提交后台删除任务并立即返回。
+    目录记录同步移除，列表接口马上不再显示该文件；索引数据由 ES 后台任务删除。
+    """
+    if mmap_store.enabled():
+        job = _delete_from_mmap(filename)
+        _remember_job(job)
+        file_catalog.remove_file(filename)
+        print(f"🗑️ [删除任务] {filename} -> 已删除 {job['deleted']} 个片段 (mmap)")
+        return job
+
+    result = es_request(
+        "POST",
+        f"/{INDEX_NAME}/_delete_by_query",
+        {"query": _file_query(filename)},
+        params={"wait_for_completion": "false", "conflicts": "proceed", "refresh": "true"},
+    )
+    task_id = result["task"]
+    job = {
+        "task_id": task_id,
+        "file": filename,
+        "status": "running",
+        "total": None,
+        "deleted": 0,
+        "created_at": _now(),
+        "reclaimed": None,
+    }
+    _remember_job(job)
+
+    try:
+        file_catalog.remove_file(filename)
+    except ESError as e:
+        print(f"⚠️ 文件目录移除失败 (可稍后对账修复): {e}")
+
+    print(f"🗑️ [删除任务] {filename} -> ES 任务 {task_id}")
+    return job
+
+def get_deletion_status(task_id: str) -> Dict:
+    """查询 ES 任务进度；本进程发起的任务会合并回收结果"""
+    known = DELETE_JOBS.get(task_id)
+    # 已结束的任务不再查询 ES (完成后 .tasks 中的记录已被清理)
+    if known and known.get("status") in FINISHED_STATUSES:
+        return known
+    if task_id.startswith(MMAP_TASK_PREFIX):
+        raise ESError(f"删除任务不存在: {task_id}", 404)
+    result = es_request("GET", f"/_tasks/{task_id}")
+    status = result.get("task", {}).get("status", {})
+    job = DELETE_JOBS.get(task_id, {"task_id": task_id, "file": None, "reclaimed": None})
+
+    job["total"] = status.get("total")
+    job["deleted"] = status.get("deleted", 0)
+    if result.get("error"):
+        job["status"] = "failed"
+        job["error"] = result["error"].get("reason")
+    elif result.get("completed"):
+        failures = result.get("response", {}).get("failures") or []
+        job["status"] = "failed" if failures else "completed"
+        if failures:
+            job["error"] = str(failures[:3])
+    return job
+
+async def watch_deletion(task_id: str):
+    """
+    轮询删除任务直到完成，然后回收磁盘文件。
+    任务在 ES 中已不存在 (如 ES 重启后丢失) 或连续 DELETE_WATCH_MAX_ERRORS 次查询失败时标记为 failed 并退出。
+    """
+    errors = 0
+    while True:
+        try:
+            job = await asyncio.to_thread(get_deletion_status, task_id)
+            errors = 0
+        except ESError as e:
+            errors += 1
+            if e.status_code == 404 or errors >= DELETE_WATCH_MAX_ERRORS:
+                job = DELETE_JOBS.get(task_id, {"task_id": task_id, "file": None})
+                job.update(status="failed", error=f"无法获取任务进度: {e}")
+                print(f"❌ [删除任务] {job['file']} 监视结束，任务状态未知: {e}")
+                return
+            print(f"⚠️ [删除任务] 查询进度失败，稍后重试 ({errors}/{DELETE_WATCH_MAX_ERRORS}): {e}")
+            await asyncio.sleep(DELETE_POLL_INTERVAL * 5)
+            continue
+
+        if job["status"] == "completed":
+            job["reclaimed"] = await asyncio.to_thread(reclaim_file_storage, job["file"])
+            # 任务结果已取回，清理 .tasks 中的记录；清理失败不影响删除结果
+            if not task_id.startswith(MMAP_TASK_PREFIX):
+                try:
+                    await asyncio.to_thread(es_request, "DELETE", f"/.tasks/_doc/{task_id}", ignore=(404,))
+                except ESError as e:
+                    print(f"⚠️ [删除任务] 清理任务记录 {task_id} 失败 (可忽略): {e}")
+            print(f"✅ [删除任务] {job['file']} 删除完成，已回收: {job['reclaimed']}")
+            return
+        if job["status"] == "failed":
+            print(f"❌ [删除任务] {job['file']} 删除失败: {job.get('error')}")
+            return
+        await asyncio.sleep(DELETE_POLL_INTERVAL)
+
+def schedule_watch(task_id: str):
+    """在当前事件循环中挂起一个删除任务监视协程 (保留引用，避免被垃圾回收)"""
+    watcher = asyncio.create_task(watch_deletion(task_id))
+    _watchers.add(watcher)
+    watcher.add_done_callback(_watchers.discard)
+
+# -----------------------------------------------------------
+# 2. 单文件回收
+# -----------------------------------------------------------
+def _remaining_chunks(filename: str) -> int:
+    if mmap_store.enabled():
+        return mmap_store.get_store().count_file(filename)
+    result = es_request("POST", f"/{INDEX_NAME}/_count", {"query": _file_query(filename)}, ignore=(404,))
+    return result.get("count", 0)
+
+def _referenced_images_for_base(base: str) -> Set[str]:
+    """同名 (去后缀) 的其它文件仍在索引中时，收集它们内容里引用的图片"""
+    referenced = set()
+    if mmap_store.enabled():
+        for content in mmap_store.get_store().contents_with_prefix(f"{base}."):
+            referenced.update(IMAGE_URL_PATTERN.findall(content))
+        return referenced
+    after = None
+    while True:
+        body = {
+            "size": 500,
+            "_source": ["content"],
+            "query": {"prefix": {"metadata.file_name.keyword": f"{base}."}},
+            "sort": [{"_doc": "asc"}],
+        }
+        if after:
+            body["search_after"] = after
+        hits = es_request("POST", f"/{INDEX_NAME}/_search", body, ignore=(404,)).get("hits", {}).get("hits", [])
+        for hit in hits:
+            referenced.update(IMAGE_URL_PATTERN.findall(hit["_source"].get("content", "")))
+        if len(hits) < 500:
+            return referenced
+        after = hits[-1]["sort"]
+
+def _images_of_base(base: str, images_dir: str) -> List[str]:
+    if not os.path.isdir(images_dir):
+        return []
+    names = []
+    for name in os.listdir(images_dir):
+        match = IMAGE_NAME_PATTERN.match(name)
+        if match and match.group("base") == base:
+            names.append(name)
+    return names
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(f"⚠️ 删除 {path} 失败: {e}")
+        return False
+
+def reclaim_file_storage(filename: str, upload_dir: str = UPLOAD_DIR, images_dir: str = IMAGES_DIR) -> Dict:
+    """
+    删除已完成后回收磁盘：原件 + 不再被剩余片段引用的图片。
+    若索引中仍有该文件的片段 (例如删除期间被重新上传)，则不做任何删除。
+    """
+    if not filename or _remaining_chunks(filename) > 0:
+        return {"source": False, "images": 0}
+
+    source_removed = _remove(os.path.join(upload_dir, filename))
+
+    base = _base_name(filename)
+    still_referenced = _referenced_images_for_base(base)
+    removed_images = 0
+    for name in _images_of_base(base, images_dir):
+        if name not in still_referenced and _remove(os.path.join(images_dir, name)):
+            media.remove_variants(name, images_dir)
+            removed_images += 1
+    return {"source": source_removed, "images": removed_images}
+
+# -----------------------------------------------------------
+# 3. 定期 GC：磁盘与索引对账
+# -----------------------------------------------------------
+def _is_old_enough(path: str, grace_seconds: int) -> bool:
+    try:
+        return time.time() - os.path.getmtime(path) > grace_seconds
+    except OSError:
+        return False
+
+def _index_ready() -> bool:
+    if mmap_store.enabled():
+        # mmap 后端刚启用、还没有导入数据时同样视为索引不存在
+        return mmap_store.get_store().exists()
+    return index_exists(INDEX_NAME)
+
+def _scan_all_referenced_images() -> Set[str]:
+    """遍历整个知识库内容，收集所有被引用的图片 (深度 GC 使用)"""
+    referenced = set()
+    if mmap_store.enabled():
+        for content in mmap_store.get_store().iter_contents():
+            referenced.update(IMAGE_URL_PATTERN.findall(content))
+        return referenced
+    pit = es_request("POST", f"/{INDEX_NAME}/_pit", params={"keep_alive": "2m"}, ignore=(404,))
+    if "id" not in pit:
+        return referenced
+    pit_id, after = pit["id"], None
+    try:
+        while True:
+            body = {
+                "size": 1000,
+                "_source": ["content"],
+                "pit": {"id": pit_id, "keep_alive": "2m"},
+                "sort": [{"_shard_doc": "asc"}],
+            }
+            if after:
+                body["search_after"] = after
+            result = es_request("POST", "/_search", body)
+            pit_id = result.get("pit_id", pit_id)
+            hits = result.get("hits", {}).get("hits", [])
+            for hit in hits:
+                referenced.update(IMAGE_URL_PATTERN.findall(hit["_source"].get("content", "")))
+            if len(hits) < 1000:
+                return referenced
+            after = hits[-1]["sort"]
+    finally:
+        es_request("DELETE", "/_pit", {"id": pit_id}, ignore=(404,))
+
+def run_gc(deep: bool = False, dry_run: bool = False, upload_dir: str = UPLOAD_DIR,
+           images_dir: str = IMAGES_DIR, grace_seconds: int = GC_GRACE_SECONDS) -> Dict:
+    """
+    以索引为准清理磁盘：
+    - 原件：索引中已没有任何片段的文件
+    - 图片：所属文件 (按命名前缀) 已不在索引中；deep=True 时进一步检查图片是否仍被任何片段引用
+    保护期内的新文件不清理，避免与正在进行的入库冲突。
+    """
+    if not _index_ready():
+        # 索引不存在多半是配置错误或 ES 数据丢失，此时按“全部孤立”清理会误删所有原件
+        print(f"⚠️ [GC] 索引 {INDEX_NAME} 不存在，跳过本轮 GC")
+        return {"skipped": True, "reason": "index_missing"}
+
+    indexed_files = {entry["name"] for entry in file_catalog.iter_indexed_files()}
+    indexed_bases = {_base_name(name) for name in indexed_files}
+    referenced = _scan_all_referenced_images() if deep else None
+
+    removed_sources, removed_images, removed_variants, freed_bytes = [], [], 0, 0
+
+    if os.path.isdir(upload_dir):
+        for name in os.listdir(upload_dir):
+            path = os.path.join(upload_dir, name)
+            if os.path.isfile(path) and name not in indexed_files and _is_old_enough(path, grace_seconds):
+                size = os.path.getsize(path)
+                if dry_run or _remove(path):
+                    removed_sources.append(name)
+                    freed_bytes += size
+
+    if os.path.isdir(images_dir):
+        for name in os.listdir(images_dir):
+            path = os.path.join(images_dir, name)
+            match = IMAGE_NAME_PATTERN.match(name)
+            if not match or not os.path.isfile(path) or not _is_old_enough(path, grace_seconds):
+                continue
+            orphan = match.group("base") not in indexed_bases
+            if not orphan and referenced is not None:
+                orphan = name not in referenced
+            if orphan:
+                size = os.path.getsize(path)
+                if dry_run or _remove(path):
+                    removed_images.append(name)
+                    freed_bytes += size
+
+        # 原图已被删除的 WebP / 缩略图
+        for relative in media.orphan_variants(images_dir):
+            path = os.path.join(images_dir, relative)
+            if not _is_old_enough(path, grace_seconds):
+                continue
+            size = os.path.getsize(path)
+            if dry_run or _remove(path):
+                removed_variants += 1
+                freed_bytes += size
+
+    summary = {
+        "deep": deep,
+        "dry_run": dry_run,
+        "sources_removed": len(removed_sources),
+        "images_removed": len(removed_images),
+        "variants_removed": removed_variants,
+        "freed_bytes": freed_bytes,
+        "finished_at": _now(),
+    }
+    print(f"🧹 [GC] {summary}")
+    return summary
+
+async def gc_loop(interval_seconds: int = GC_INTERVAL_SECONDS):
+    """后台定期 GC (在 FastAPI 启动时挂起)"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(run_gc)
+        except ESError as e:
+            print(f"⚠️ [GC] 本轮跳过，ES 不可用: {e}")
+        except Exception as e:
+            print(f"❌ [GC] 执行出错: {e}")
@@ -0,0 +1,201 @@
+# app/core/transcription.py
+"""
+语音转文字 (Faster-Whisper)
+
+配置了 MODEL_SERVER_SOCKET 时交给共享模型服务识别，否则在本进程内懒加载 Whisper 模型。
+
+长语音模式：操作员口述的故障报告常有几分钟，单个模型串行解码太慢。超过 LONG_AUDIO_SECONDS 的录音
+先用 VAD (Silero) 按静音切成不超过 SEGMENT_MAX_SECONDS 的片段，再由一个小型 Whisper 实例池
+并行识别，最后按时间顺序拼回文本。每次识别都会返回实时率 (RTF = 耗时 / 音频时长)。
+"""
+
+import os
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
+
+from app.core.model_server import MODEL_SERVER_SOCKET, load_whisper, transcribe_remote
+
+SAMPLE_RATE = 16000
+WHISPER_POOL_SIZE = int(os.getenv("WHISPER_POOL_SIZE", "2"))         # 并行识别的 Whisper 实例数
+LONG_AUDIO_SECONDS = float(os.getenv("LONG_AUDIO_SECONDS", "30"))    # 超过这个时长走长语音模式
+SEGMENT_MAX_SECONDS = float(os.getenv("SEGMENT_MAX_SECONDS", "30"))  # 单个片段上限 (Whisper 窗口为 30 秒)
+
+# 识别档位：accurate 为原来的 beam_size=5；fast 为贪心解码，速度约快 2~3 倍
+PROFILES = {
+    "accurate": {"beam_size": 5},
+    "fast": {"beam_size": 1, "best_of": 1, "temperature": 0.0},
+}
+DEFAULT_PROFILE = os.getenv("WHISPER_PROFILE", "accurate")
+
+# ==============================================================================
+# 1. Whisper 实例池
+# ==============================================================================
+class WhisperPool:
+    """
+    最多 size 个 Whisper 实例，按需加载。CPU 线程在实例之间平分，并行时不会互相抢核。
+    """
+
+    def __init__(self, size: int = WHISPER_POOL_SIZE):
+        self.size = max(1, size)
+        self.cpu_threads = max(1, (os.cpu_count() or 4) // self.size)
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """预先加载第一个实例，启动时即可发现模型文件缺失等问题"""
+        with self.acquire():
+            pass
+
+    @contextmanager
+    def acquire(self):
+        model = None
+        try:
+            model = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    try:
+                        model = load_whisper(cpu_threads=self.cpu_threads)
+                    except Exception:
+                        self._created -= 1
+                        raise
+        if model is None:
+            model = self._idle.get()
+        try:
+            yield model
+        finally:
+            self._idle.put(model)
+
+# ==============================================================================
+# 2. 识别
+# ==============================================================================
+def split_on_speech(audio, max_seconds: float = SEGMENT_MAX_SECONDS) -> List[tuple]:
+    """
+    用 VAD 找出说话区间，把相邻区间合并为不超过 max_seconds 的片段。
+    :return: [(start_sample, end_sample)]，按时间顺序
+    """
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+    speech = get_speech_timestamps(
+        audio,
+        VadOptions(max_speech_duration_s=max_seconds, min_silence_duration_ms=500, speech_pad_ms=200),
+    )
+    max_samples = int(max_seconds * SAMPLE_RATE)
+    segments = []
+    for ts in speech:
+        if segments and ts["end"] - segments[-1][0] <= max_samples:
+            segments[-1] = (segments[-1][0], ts["end"])
+        else:
+            segments.append((ts["start"], ts["end"]))
+    return segments
+
+def _decode(model, audio, options: dict) -> str:
+    segments, _ = model.transcribe(audio, **options)
+    return "".join(segment.text for segment in segments).strip()
+
+def transcribe_audio(
+    pool: WhisperPool,
+    audio_path: str,
+    profile: str = DEFAULT_PROFILE,
+    language: str = "zh",
+    long_mode: Optional[bool] = None,
+) -> Dict:
+    """
+    :param long_mode: None 表示按时长自动选择；True/False 强制开启/关闭长语音模式
+    :return: {"text", "duration", "elapsed", "rtf", "mode", "profile", "segments"}
+    """
+    from faster_whisper.audio import decode_audio
+
+    if profile not in PROFILES:
+        raise ValueError(f"未知识别档位: {profile}，可选: {', '.join(PROFILES)}")
+    options = dict(PROFILES[profile], language=language)
+
+    started = time.perf_counter()
+    audio = decode_audio(audio_path, sampling_rate=SAMPLE_RATE)
+    duration = len(audio) / SAMPLE_RATE
+    if long_mode is None:
+        long_mode = duration > LONG_AUDIO_SECONDS
+
+    if not long_mode:
+        with pool.acquire() as model:
+            text = _decode(model, audio, options)
+        segment_count = 1
+    else:
+        spans = split_on_speech(audio)
+        # 片段之间互相独立，不把上一段的文字作为提示，避免并行时顺序依赖
+        options.update(vad_filter=False, condition_on_previous_text=False)
+
+        def work(span):
+            with pool.acquire() as model:
+                return _decode(model, audio[span[0]:span[1]], options)
+
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            texts = list(executor.map(work, spans))  # map 保持提交顺序
+        separator = "" if language == "zh" else " "
+        text = separator.join(t for t in texts if t)
+        segment_count = len(spans)
+
+    elapsed = time.perf_counter() - started
+    rtf = elapsed / duration if duration else 0.0
+    mode = "long" if long_mode else "single"
+    print(f"🎤 [语音识别] {duration:.1f}s 音频, {mode}/{profile}, {segment_count} 段, 耗时 {elapsed:.1f}s, RTF {rtf:.2f}")
+    return {
+        "text": text,
+        "duration": round(duration, 2),
+        "elapsed": round(elapsed, 2),
+        "rtf": round(rtf, 3),
+        "mode": mode,
+        "profile": profile,
+        "segments": segment_count,
+    }
+
+# ==============================================================================
+# 3. 本进程模式
+# ==============================================================================
+_voice_pool = WhisperPool()
+_voice_model_error: Optional[str] = None
+_voice_init_lock = threading.Lock()
+_voice_ready = False
+
+def get_local_model() -> Optional[WhisperPool]:
+    """本进程模式下的 Whisper 实例池 (首次调用时加载第一个实例，加载失败会记录原因)"""
+    global _voice_ready, _voice_model_error
+    if not _voice_ready and _voice_model_error is None:
+        with _voice_init_lock:
+            if not _voice_ready and _voice_model_error is None:
+                try:
+                    # "small" 模型对中文识别效果很好，且在 CPU 上运行速度也很快
+                    _voice_pool.warm_up()
+                    _voice_ready = True
+                except Exception as e:
+                    print(f"语音模型加载失败: {e}")
+                    _voice_model_error = str(e)
+    return _voice_pool if _voice_ready else None
+
+def is_available() -> bool:
+    return bool(MODEL_SERVER_SOCKET) or get_local_model() is not None
+
+def transcribe_file(
+    audio_path: str,
+    profile: str = DEFAULT_PROFILE,
+    language: str = "zh",
+    long_mode: Optional[bool] = None,
+) -> Dict:
+    """
+    识别一个音频文件。
+    :return: {"text": 识别文本, "duration": 音频时长(秒), "rtf": 实时率, ...}
+    """
+    options = {"profile": profile, "language": language, "long_mode": long_mode}
+    if MODEL_SERVER_SOCKET:
+        return transcribe_remote(audio_path, **options)
+
+    pool = get_local_model()
+    if pool is None:
+        raise RuntimeError(f"语音模型未加载: {_voice_model_error}")
+    return transcribe_audio(pool, audio_path, **options)
@@ -0,0 +1,178 @@
+# app/core/verified_answers.py
+"""
+工程师已验证答案的快速通道
+
+工程师通过 /admin/solve_question 解答的问题会被标记为 solved。这里把这些“问题 -> 人工答案”
+建成一个小型向量索引；新问题与某条已解答问题足够相似 (>= VERIFIED_ANSWER_THRESHOLD) 时，
+chat_stream 直接返回人工答案并注明来源，跳过 大模型 -> 检索 -> 精排 -> 大模型 的完整流程。
+每条答案记录所属分区，只在本轮检索范围内的分区中匹配 (三号线的答案不会回答五号线的同名故障)。
+答案的来源文件已从知识库删除时视为撤回，不再直接返回 (见 source_exists)。
+"""
+
+import os
+import json
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+VERIFIED_ANSWER_THRESHOLD = float(os.getenv("VERIFIED_ANSWER_THRESHOLD", "0.92"))
+VERIFIED_ANSWER_ENABLED = os.getenv("VERIFIED_ANSWER_ENABLED", "true").lower() == "true"
+
+ANSWER_MARKER = "【解决方案】"
+DEFAULT_PARTITION = "general"  # 与 partitions.GENERAL 一致；分区功能上线前解答的记录归入通用分区
+
+def read_answer_from_file(path: str) -> Optional[str]:
+    """从 人工解答_*.txt 中取出【解决方案】部分"""
+    if not path.lower().endswith(".txt") or not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if ANSWER_MARKER not in content:
+        return None
+    return content.split(ANSWER_MARKER, 1)[1].strip() or None
+
+class VerifiedAnswerIndex:
+    """
+    以待解答问题库 (unanswered_questions.json) 中 status == "solved" 的记录为数据源。
+    文件修改后在下一次查询时自动刷新 (只为新增/修改的问题计算向量)，solve_question 之后也可以主动 refresh()。
+    :param source_exists: 来源文件是否仍在知识库中；命中时检查，已删除的来源不再返回其答案
+    """
+
+    def __init__(
+        self,
+        embed_model,
+        records_file: str,
+        upload_dir: str,
+        threshold: float = VERIFIED_ANSWER_THRESHOLD,
+        source_exists: Optional[Callable[[str], bool]] = None,
+    ):
+        self.embed_model = embed_model
+        self.records_file = records_file
+        self.upload_dir = upload_dir
+        self.threshold = threshold
+        self.source_exists = source_exists
+        self._lock = threading.Lock()
+        self._mtime = None
+        # (条目, 向量矩阵) 整体替换：查询与刷新并发时只会读到同一次刷新的两部分
+        self._snapshot: Tuple[List[Dict], Optional[np.ndarray]] = ([], None)
+        self._vectors: Dict[str, np.ndarray] = {}  # 问题文本 -> 归一化向量，刷新时复用
+        self.stats = {"hits": 0, "misses": 0, "entries": 0, "last_score": None}
+
+    # -----------------------------------------------------------
+    # 1. 构建
+    # -----------------------------------------------------------
+    def _load_entries(self) -> List[Dict]:
+        if not os.path.exists(self.records_file):
+            return []
+        try:
+            with open(self.records_file, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return []
+
+        entries = []
+        for record in records:
+            if record.get("status") != "solved" or not record.get("query"):
+                continue
+            source = record.get("solution_source") or ""
+            answer = record.get("answer_text") or read_answer_from_file(os.path.join(self.upload_dir, source))
+            # 以文件 (PDF/Word) 形式解答的问题没有可直接返回的文字答案，仍走正常检索
+            if answer:
+                entries.append({
+                    "query": record["query"].strip(),
+                    "answer": answer,
+                    "source": source,
+                    "partition": record.get("partition") or DEFAULT_PARTITION,
+                })
+        return entries
+
+    def refresh(self, force: bool = False):
+        try:
+            mtime = os.path.getmtime(self.records_file)
+        except OSError:
+            mtime = None
+        if not force and mtime == self._mtime:
+            return
+
+        with self._lock:
+            entries = self._load_entries()
+            # 文件每次改动 (包括新增待解答问题) 都会触发刷新，只给还没有向量的问题调用模型
+            queries = {e["query"] for e in entries}
+            missing = sorted(queries - self._vectors.keys())
+            if missing:
+                vectors = np.asarray(self.embed_model.get_text_embedding_batch(missing), dtype=np.float32)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                self._vectors.update(zip(missing, vectors))
+            self._vectors = {q: v for q, v in self._vectors.items() if q in queries}
+            matrix = np.stack([self._vectors[e["query"]] for e in entries]) if entries else None
+            self._snapshot = (entries, matrix)
+            self._mtime = mtime
+            self.stats["entries"] = len(entries)
+        print(f"📚 [已验证答案] 索引已更新，共 {len(entries)} 条 (新计算向量 {len(missing)} 条)")
+
+    # -----------------------------------------------------------
+    # 2. 查询
+    # -----------------------------------------------------------
+    def lookup(self, query: str, partitions: Optional[set] = None) -> Optional[Dict]:
+        """
+        :param partitions: 本轮检索范围内的分区 (见 partitions.search_keys)，None 表示全库
+        :return: 命中返回 {"query", "answer", "source", "partition", "score"}，否则返回 None
+        """
+        if not VERIFIED_ANSWER_ENABLED:
+            return None
+        self.refresh()
+        entries, matrix = self._snapshot
+        if entries and partitions is not None:
+            keep = [i for i, entry in enumerate(entries) if entry["partition"] in partitions]
+            entries, matrix = [entries[i] for i in keep], matrix[keep]
+
+        best = None
+        if entries:
+            # 完全相同的问题不必计算向量
+            normalized = query.strip()
+            exact = [i for i, entry in enumerate(entries) if entry["query"] == normalized]
+            if exact:
+                scores = np.zeros(len(entries), dtype=np.float32)
+                scores[exact] = 1.0
+            else:
+                vector = np.asarray(self.embed_model.get_query_embedding(normalized), dtype=np.float32)
+                vector /= max(float(np.linalg.norm(vector)), 1e-12)
+                scores = matrix @ vector
+            # 按相似度从高到低，取第一条来源仍有效的答案
+            for idx in np.argsort(-scores):
+                best = dict(entries[idx], score=float(scores[idx]))
+                if best["score"] < self.threshold or self._source_alive(best["source"]):
+                    break
+                print(f"🗑️ [已验证答案] 来源 {best['source']} 已从知识库删除，不再使用该答案")
+                best = None
+
+        self.stats["last_score"] = best["score"] if best else None
+        if best and best["score"] >= self.threshold:
+            self.stats["hits"] += 1
+            return best
+        self.stats["misses"] += 1
+        return None
+
+    def _source_alive(self, source: str) -> bool:
+        if not source or self.source_exists is None:
+            return True
+        try:
+            return self.source_exists(source)
+        except Exception as e:
+            # 无法确认来源仍有效时不直接返回答案，走正常检索
+            print(f"⚠️ [已验证答案] 检查来源 {source} 失败: {e}")
+            return False
+
+    def get_stats(self) -> Dict:
+        total = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, threshold=self.threshold, hit_rate=round(self.stats["hits"] / total, 3) if total else 0.0)
+
+def format_answer(hit: Dict) -> str:
+    """按系统提示要求的格式输出：答案 + 【参考来源文件】"""
+    source = hit["source"] or "工程师人工解答"
+    return (
+        f"{hit['answer']}\n\n"
+        f"> 此答案来自工程师已验证的解答（匹配问题：{hit['query']}）。\n\n"
+        f"【参考来源文件】\n- {source}"
+    )
@@ -6,35 +6,66 @@ import uuid
 from typing import Optional
 import pandas as pd
 import io
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import StreamingResponse
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from faster_whisper import WhisperModel
+from starlette.background import BackgroundTask
 
 from app.models import ChatRequest
-from app.core.agent import chat_stream, UNANSWERED_FILE
-from app.core.kb_manager import list_files_in_es, delete_file_from_es, ingest_file, ingest_from_local_path, UPLOAD_DIR, IMAGES_DIR
+from app.core.agent import chat_stream, verified_index, get_speculative_stats, UNANSWERED_FILE
+from app.core.kb_manager import list_files_in_es, rebuild_file_catalog, delete_file_from_es, ingest_file, ingest_from_local_path, UPLOAD_DIR, IMAGES_DIR
+from app.core.es_client import ESError
+from app.core import storage_gc, transcription, media, index_schema, partitions, mmap_store
+from app.core.model_server import MODEL_SERVER_SOCKET
+from app.core.scheduler import scheduler, Overloaded
 
 # --------------------------------------------------------------------------
 # 1. 初始化本地语音模型 (Faster-Whisper)
 # --------------------------------------------------------------------------
-# 为了防止显存(VRAM)溢出，强制使用 "cpu" 和 "int8" 量化
-# "small" 模型对中文识别效果很好，且在 CPU 上运行速度也很快
-try:
-    # download_root 可以指定模型下载路径，避免每次都下
-    voice_model = WhisperModel("small", device="cpu", compute_type="int8", download_root="./models/whisper")
-except Exception as e:
-    print(f"语音模型加载失败: {e}")
-    voice_model = None
+# 为了防止显存(VRAM)溢出，强制使用 "cpu" 和 "int8" 量化 (见 app/core/model_server.py)
+# 使用共享模型服务 (MODEL_SERVER_SOCKET) 时由模型服务加载，这里不再占用内存
+if not MODEL_SERVER_SOCKET:
+    transcription.get_local_model()
 
 # --------------------------------------------------------------------------
 # 2. 框架配置
 # --------------------------------------------------------------------------
-app = FastAPI(title="工厂智能助手 API", version="1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 按显式 Mapping 创建知识库索引；旧索引仍是默认 Mapping 时提示迁移
+    if mmap_store.enabled():
+        stats = await asyncio.to_thread(lambda: mmap_store.get_store().stats())
+        print(f"📂 使用 mmap 向量库: {stats['alive']} 个片段, IVF {stats['ivf_lists']} 簇 ({stats['path']})")
+    else:
+        try:
+            await asyncio.to_thread(index_schema.ensure_knowledge_index)
+            await asyncio.to_thread(partitions.ensure_partition_index, partitions.GENERAL)
+        except ESError as e:
+            print(f"⚠️ 知识库索引检查失败 (ES 未就绪?): {e}")
+    # 定期 GC：清理索引中已不存在的原件与图片
+    gc_task = None
+    if storage_gc.GC_INTERVAL_SECONDS > 0:
+        gc_task = asyncio.create_task(storage_gc.gc_loop())
+    yield
+    if gc_task:
+        gc_task.cancel()
 
-app.mount("/files", StaticFiles(directory=UPLOAD_DIR), name="files")
-app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
+app = FastAPI(title="工厂智能助手 API", version="1.0", lifespan=lifespan)
+
+# /files、/images 不再使用 StaticFiles：需要强 ETag、缓存头和图片格式协商 (见 app/core/media.py)
+@app.api_route("/files/{name}", methods=["GET", "HEAD"])
+def get_source_file(name: str, request: Request):
+    return media.source_file_response(request, name, UPLOAD_DIR)
+
+@app.api_route("/images/{name}", methods=["GET", "HEAD"])
+def get_image(name: str, request: Request, size: Optional[str] = None):
+    """
+    返回知识库图片：浏览器支持 WebP 时返回 WebP 版本，size=thumb 返回缩略图
+    链接带 ?v=内容版本号 时设置 immutable 长缓存
+    """
+    return media.image_response(request, name, size=size, images_dir=IMAGES_DIR)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,29 +75,102 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc: Overloaded):
+    """负载已满时快速返回 429，而不是让请求无限排队"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": f"服务繁忙，请稍后重试 ({exc.reason})", "workload": exc.workload, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 @app.get("/")
 def read_root():
     return {"message": "Factory AI Agent Service is Running"}
 
+@app.get("/admin/scheduler")
+def get_scheduler_stats():
+    """各类负载的并发、排队深度和等待时间"""
+    return scheduler.stats()
+
+@app.get("/admin/verified_answers")
+def get_verified_answer_stats():
+    """已验证答案快速通道的条目数、命中/未命中次数和命中率"""
+    return verified_index.get_stats()
+
+@app.get("/admin/speculative_retrieval")
+def get_speculative_retrieval_stats():
+    """推测检索的发起/复用/丢弃次数，复用率低说明模型经常改写用户问题"""
+    return get_speculative_stats()
+
+@app.get("/admin/vector_store")
+def get_vector_store_stats():
+    """mmap 向量库的片段数、删除标记、IVF 簇数和文件大小 (VECTOR_BACKEND=mmap 时)"""
+    if not mmap_store.enabled():
+        return {"backend": mmap_store.VECTOR_BACKEND}
+    return {"backend": "mmap", **mmap_store.get_store().stats()}
+
+@app.get("/admin/partitions")
+def get_partitions():
+    """已配置的分区定义和各分区的片段数"""
+    try:
+        return {"configured": partitions.load_partitions(), "indexed": partitions.partition_stats()}
+    except ESError as e:
+        raise HTTPException(status_code=502, detail=f"分区查询失败: {e}")
+
 # --------------------------------------------------------------------------
 # 3. 核心接口
 # --------------------------------------------------------------------------
 
+async def _leased_stream(lease, stream):
+    """
+    槽位只覆盖 CPU 密集的部分 (已验证答案匹配、检索、精排)：开始输出内容时这些都已完成，
+    此时释放槽位，之后的远程大模型流式生成不再占用；检索轮次中的释放见 agent.run_tools。
+    """
+    try:
+        async for chunk in stream:
+            lease.release()
+            yield chunk
+    finally:
+        lease.release()
+
+async def _release_lease(lease):
+    # 必须是协程：同步函数会被放到线程池执行，而调度器只能在事件循环线程里修改
+    lease.release()
+
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     """对话接口 (流式)"""
+    # 流开始后无法再返回错误码，分区在这里先校验
+    if request.scope:
+        try:
+            await asyncio.to_thread(partitions.resolve_scope, request.scope, request.query)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    # 在返回流之前拿到槽位，负载满时直接 429
+    lease = await scheduler.lease("chat")
     return StreamingResponse(
-        chat_stream(request.query, request.thread_id),
-        media_type="text/event-stream"
+        _leased_stream(lease, chat_stream(request.query, request.thread_id, request.scope, slot_lease=lease)),
+        media_type="text/event-stream",
+        # 流还没开始客户端就断开时生成器的 finally 不会执行，由后台任务兜底释放
+        background=BackgroundTask(_release_lease, lease)
     )
 
 @app.post("/voice-to-text")
-async def voice_to_text_endpoint(file: UploadFile = File(...)):
+async def voice_to_text_endpoint(
+    file: UploadFile = File(...),
+    profile: str = Form(transcription.DEFAULT_PROFILE),
+    long_mode: Optional[bool] = Form(None),
+):
     """
     语音转文字接口 (Local Faster-Whisper)
+    profile: accurate (beam_size=5) / fast (贪心解码)
+    long_mode: 不传时按时长自动选择；长语音按静音切段后并行识别
     """
-    if not voice_model:
+    if not transcription.is_available():
         raise HTTPException(status_code=500, detail="语音模型未加载，请检查后台日志")
+    if profile not in transcription.PROFILES:
+        raise HTTPException(status_code=400, detail=f"未知识别档位: {profile}")
 
     # 1. 保存上传的临时音频文件
     temp_filename = f"temp_{file.filename}"
@@ -74,19 +178,32 @@ async def voice_to_text_endpoint(file: UploadFile = File(...)):
         with open(temp_filename, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
         
-        # 2. 调用模型进行识别
-        # beam_size=5 提升准确率
-        segments, info = voice_model.transcribe(temp_filename, beam_size=5, language="zh")
+        # 2. 调用模型进行识别 (本进程或共享模型服务)
+        # 默认 accurate 档位 (beam_size=5) 提升准确率
+        async with scheduler.slot("voice"):
+            result = await asyncio.to_thread(
+                transcription.transcribe_file, temp_filename, profile=profile, language="zh", long_mode=long_mode
+            )
         
         # 3. 拼接结果
-        full_text = "".join([segment.text for segment in segments])
+        full_text = result["text"]
         
         # 4. 删除临时文件
         os.remove(temp_filename)
         
         print(f"🎤 语音识别结果: {full_text}")
-        return {"text": full_text}
+        return {
+            "text": full_text,
+            "duration": result["duration"],
+            "rtf": result.get("rtf"),
+            "mode": result.get("mode"),
+            "profile": result.get("profile"),
+        }
 
+    except Overloaded:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
     except Exception as e:
         if os.path.exists(temp_filename):
             os.remove(temp_filename)
@@ -97,20 +214,72 @@ async def voice_to_text_endpoint(file: UploadFile = File(...)):
 # 4. 知识库接口
 # --------------------------------------------------------------------------
 @app.get("/knowledge/files")
-def get_files():
-    return list_files_in_es()
+def get_files(limit: int = 100, cursor: Optional[str] = None):
+    """
+    分页获取知识库文件目录
+    返回 next_cursor 不为空时，带上 cursor 参数继续请求下一页
+    """
+    try:
+        return list_files_in_es(limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ESError as e:
+        raise HTTPException(status_code=502, detail=f"知识库查询失败: {e}")
+
+@app.post("/knowledge/catalog/rebuild")
+def rebuild_catalog():
+    """与知识库实际数据对账，重建文件目录"""
+    try:
+        return rebuild_file_catalog()
+    except ESError as e:
+        raise HTTPException(status_code=502, detail=f"目录重建失败: {e}")
+
+@app.delete("/knowledge/files/{filename}", status_code=202)
+async def delete_file(filename: str):
+    """
+    提交后台删除任务，立即返回 task_id
+    进度通过 GET /knowledge/deletions/{task_id} 查询，完成后自动回收原件与图片
+    """
+    try:
+        job = await asyncio.to_thread(delete_file_from_es, filename)
+    except ESError as e:
+        raise HTTPException(status_code=502, detail=f"删除失败: {e}")
+    storage_gc.schedule_watch(job["task_id"])
+    return {"message": f"{filename} 删除中", **job}
+
+@app.get("/knowledge/deletions/{task_id}")
+def get_deletion(task_id: str):
+    """查询删除任务进度"""
+    try:
+        return storage_gc.get_deletion_status(task_id)
+    except ESError as e:
+        status_code = 404 if e.status_code == 404 else 502
+        raise HTTPException(status_code=status_code, detail=str(e))
 
-@app.delete("/knowledge/files/{filename}")
-def delete_file(filename: str):
-    if delete_file_from_es(filename):
-        return {"message": f"{filename} 已删除"}
-    raise HTTPException(status_code=500, detail="删除失败")
+@app.post("/admin/gc")
+async def run_storage_gc(deep: bool = False, dry_run: bool = False):
+    """
+    立即执行一次磁盘与索引对账
+    deep=true 时逐张检查图片是否仍被引用；dry_run=true 只统计不删除
+    """
+    try:
+        return await asyncio.to_thread(storage_gc.run_gc, deep, dry_run)
+    except ESError as e:
+        raise HTTPException(status_code=502, detail=f"GC 失败: {e}")
 
 @app.post("/knowledge/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), scope: Optional[str] = Form(None)):
+    """scope: 入库的分区 (产线/设备族)，不传时按文件名识别，识别不出归入 general"""
+    try:
+        partition = partitions.ingest_partition(scope, file.filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
-        num = await ingest_file(file)
+        async with scheduler.slot("ingest"):
+            num = await ingest_file(file, partition)
         return {"message": "入库成功", "chunks": num}
+    except Overloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -131,14 +300,20 @@ async def solve_question(
     query: str = Form(...),
     answer_text: Optional[str] = Form(None),
     custom_filename: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None)
+    file: Optional[UploadFile] = File(None),
+    scope: Optional[str] = Form(None)
 ):
     """
     解决问题：接收人工回答（文字或文件），生成文档入库，并更新状态
+    scope 不传时按问题内容识别分区
     """
     # A. 校验
     if not answer_text and not file:
         raise HTTPException(status_code=400, detail="必须提供文字回答或上传文件")
+    try:
+        partition = partitions.ingest_partition(scope, query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     try:
         # B. 处理回答并入库
@@ -151,7 +326,8 @@ async def solve_question(
                 shutil.copyfileobj(file.file, buffer)
             
             # 入库
-            await ingest_from_local_path(file_path, file.filename)
+            async with scheduler.slot("ingest"):
+                await ingest_from_local_path(file_path, file.filename, partition)
             ingested_filename = file.filename
 
         # 情况2：纯文字回答 (生成一个 .txt 文件)
@@ -177,7 +353,8 @@ async def solve_question(
                 f.write(content)
             
             # 入库
-            await ingest_from_local_path(txt_path, txt_filename)
+            async with scheduler.slot("ingest"):
+                await ingest_from_local_path(txt_path, txt_filename, partition)
             ingested_filename = txt_filename
 
         # C. 更新 JSON 状态
@@ -191,6 +368,9 @@ async def solve_question(
                     item["status"] = "solved"
                     item["solved_at"] = "now" # 简化处理
                     item["solution_source"] = ingested_filename
+                    item["partition"] = partition  # 已验证答案只在同一分区 (及 general) 内匹配
+                    if answer_text and not file:
+                        item["answer_text"] = answer_text
                     found = True
                     break
             
@@ -198,8 +378,13 @@ async def solve_question(
             with open(UNANSWERED_FILE, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=False, indent=2)
 
+            # 新答案立即进入快速通道
+            await asyncio.to_thread(verified_index.refresh, True)
+
         return {"message": "处理成功，知识已入库", "file": ingested_filename}
 
+    except Overloaded:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -209,6 +394,35 @@ async def solve_question(
 # 5. 零件生命周期数据可视化接口
 # --------------------------------------------------------------------------
 
+def _parse_lifecycle_table(contents: bytes, filename: str) -> list:
+    df = None
+    
+    # --- 分支 1: 处理 Excel (.xlsx) ---
+    if filename.endswith(".xlsx") or filename.endswith(".xls"):
+        # read_excel 需要二进制流 (BytesIO)，不需要 decode
+        df = pd.read_excel(io.BytesIO(contents))
+        
+    # --- 分支 2: 处理 CSV (.csv) ---
+    else:
+        # read_csv 需要文本流，尝试 utf-8 和 gbk 解码
+        try:
+            df = pd.read_csv(io.StringIO(contents.decode('utf-8')))
+        except UnicodeDecodeError:
+            df = pd.read_csv(io.StringIO(contents.decode('gbk')))
+    
+    # --- 通用数据清洗逻辑 ---
+    # 确保数值列是数字类型，如果为空则填0
+    numeric_cols = ['总耗时(分钟)', '坐标 X', '坐标 Y']
+    for col in numeric_cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    
+    # 填充空字符串，防止前端报错
+    df = df.fillna("")
+
+    # 将 DataFrame 转为字典列表返回
+    return df.to_dict(orient="records")
+
 @app.post("/api/upload_lifecycle")
 async def upload_lifecycle_data(file: UploadFile = File(...)):
     """
@@ -218,35 +432,13 @@ async def upload_lifecycle_data(file: UploadFile = File(...)):
         contents = await file.read()
         filename = file.filename.lower()
         
-        df = None
-        
-        # --- 分支 1: 处理 Excel (.xlsx) ---
-        if filename.endswith(".xlsx") or filename.endswith(".xls"):
-            # read_excel 需要二进制流 (BytesIO)，不需要 decode
-            df = pd.read_excel(io.BytesIO(contents))
-            
-        # --- 分支 2: 处理 CSV (.csv) ---
-        else:
-            # read_csv 需要文本流，尝试 utf-8 和 gbk 解码
-            try:
-                df = pd.read_csv(io.StringIO(contents.decode('utf-8')))
-            except UnicodeDecodeError:
-                df = pd.read_csv(io.StringIO(contents.decode('gbk')))
-        
-        # --- 通用数据清洗逻辑 ---
-        # 确保数值列是数字类型，如果为空则填0
-        numeric_cols = ['总耗时(分钟)', '坐标 X', '坐标 Y']
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        
-        # 填充空字符串，防止前端报错
-        df = df.fillna("")
-
-        # 将 DataFrame 转为字典列表返回
-        data = df.to_dict(orient="records")
+        # 大表格解析是 CPU 密集操作，放到线程里并受调度器限流
+        async with scheduler.slot("lifecycle"):
+            data = await asyncio.to_thread(_parse_lifecycle_table, contents, filename)
         return {"data": data, "count": len(data)}
         
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"文件解析错误: {e}")
-        return {"error": f"解析失败: {str(e)}"}
\ No newline at end of file
+        return {"error": f"解析失败: {str(e)}"}
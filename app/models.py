@@ -1,6 +1,8 @@
 # app/models.py
+from typing import Optional
 from pydantic import BaseModel
 
 class ChatRequest(BaseModel):
     query: str          # 用户的问题
-    thread_id: str      # 用于 LangGraph 记忆的会话 ID
\ No newline at end of file
+    thread_id: str      # 用于 LangGraph 记忆的会话 ID
+    scope: Optional[str] = None  # 检索分区 (产线/设备族，见 partitions.json)；不传时从问题中识别，"all" 为全库
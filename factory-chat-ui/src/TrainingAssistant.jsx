@@ -9,6 +9,12 @@ import { API_BASE_URL } from "./config";
 
 const API_URL = `${API_BASE_URL}/chat`;
 const VOICE_API_URL = `${API_BASE_URL}/voice`;
+
+// 知识库图片在对话中显示缩略图，点击后打开原图
+const thumbnailUrl = (src) => {
+    if (!src || !src.includes('/images/')) return src;
+    return src + (src.includes('?') ? '&' : '?') + 'size=thumb';
+};
 // 接收 onBack 属性用于返回主页
 export default function TrainingAssistant({ onBack }) {
     const [threads, setThreads] = useState([]);
@@ -278,7 +284,7 @@ export default function TrainingAssistant({ onBack }) {
                                     <div className={`max-w-[85%] p-4 rounded-2xl text-sm leading-7 shadow-sm ${msg.role === 'user' ? 'bg-blue-600 text-white rounded-br-none' : 'bg-white border border-gray-100 text-gray-800 rounded-bl-none'}`}>
                                         <ReactMarkdown
                                             components={{
-                                                img: ({ node, ...props }) => <img {...props} className="max-w-full h-auto rounded-lg shadow-md my-4 border border-gray-200 cursor-zoom-in" onClick={() => window.open(props.src, '_blank')} />
+                                                img: ({ node, ...props }) => <img {...props} src={thumbnailUrl(props.src)} loading="lazy" className="max-w-full h-auto rounded-lg shadow-md my-4 border border-gray-200 cursor-zoom-in" onClick={() => window.open(props.src, '_blank')} />
                                             }}
                                         >{contentToShow}</ReactMarkdown>
                                     </div>
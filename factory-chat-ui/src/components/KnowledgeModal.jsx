@@ -13,16 +13,23 @@ const handleOpenFile = (filename) => {
 
 export default function KnowledgeModal({ isOpen, onClose }) {
     const [files, setFiles] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
+    const [total, setTotal] = useState(0);
     const [loading, setLoading] = useState(false);
     const [uploading, setUploading] = useState(false);
 
-    // 加载文件列表
-    const fetchFiles = async () => {
+    // 加载文件列表 (游标分页，传入 cursor 时追加下一页)
+    const fetchFiles = async (cursor = null) => {
         setLoading(true);
         try {
-            const res = await fetch(`${API_BASE}/knowledge/files`);
+            const params = new URLSearchParams({ limit: '100' });
+            if (cursor) params.set('cursor', cursor);
+            const res = await fetch(`${API_BASE}/knowledge/files?${params}`);
+            if (!res.ok) throw new Error(`HTTP ${res.status}`);
             const data = await res.json();
-            setFiles(data);
+            setFiles(prev => cursor ? [...prev, ...data.files] : data.files);
+            setNextCursor(data.next_cursor);
+            setTotal(data.total);
         } catch (err) {
             console.error("加载失败", err);
         } finally {
@@ -93,7 +100,7 @@ export default function KnowledgeModal({ isOpen, onClose }) {
 
                 {/* 文件列表区 */}
                 <div className="flex-1 overflow-y-auto p-4 space-y-2 bg-gray-50/50 min-h-[300px]">
-                    {loading ? (
+                    {loading && files.length === 0 ? (
                         <div className="flex justify-center items-center h-full text-gray-400 gap-2">
                             <Loader2 className="animate-spin" /> 加载中...
                         </div>
@@ -146,6 +153,15 @@ export default function KnowledgeModal({ isOpen, onClose }) {
                             </div>
                         ))
                     )}
+                    {nextCursor && (
+                        <button
+                            onClick={() => fetchFiles(nextCursor)}
+                            disabled={loading}
+                            className="w-full py-2 text-sm text-blue-600 hover:bg-blue-50 rounded-lg transition"
+                        >
+                            {loading ? '加载中...' : `加载更多 (已显示 ${files.length} / ${total})`}
+                        </button>
+                    )}
                 </div>
 
                 {/* 底部操作区 */}
@@ -155,7 +171,7 @@ export default function KnowledgeModal({ isOpen, onClose }) {
                     </div>
                     <div className="flex gap-3">
                         <button
-                            onClick={fetchFiles}
+                            onClick={() => fetchFiles()}
                             className="p-2 text-gray-500 hover:bg-gray-100 rounded-lg transition"
                             title="刷新列表"
                         >
@@ -0,0 +1,122 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+for module in ("torch", "numpy", "requests", "dotenv", "nest_asyncio", "langgraph", "langchain_openai", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import model_server
+
+# 使用远程模型适配器 (不连接、不加载本地权重)；大模型客户端只在调用时才需要真实的 key
+model_server.MODEL_SERVER_SOCKET = model_server.MODEL_SERVER_SOCKET or "/tmp/unused_test_models.sock"
+os.environ.setdefault("DASHSCOPE_API_KEY", "test")
+from app.core import agent
+
+def _node(node_id, score=None, text=None):
+    inner = SimpleNamespace(node_id=node_id, get_content=lambda metadata_mode=None: text or node_id)
+    return SimpleNamespace(node=inner, score=score)
+
+def _ids(nodes):
+    return [n.node.node_id for n in nodes]
+
+def test_dedupe_keeps_node_under_highest_scoring_query():
+    results = [
+        [_node("a", 0.9), _node("shared", 0.5)],
+        [_node("shared", 0.8), _node("b", 0.4)],
+        [_node("shared", 0.2), _node("c", 0.3)],
+    ]
+    deduped, moved_to = agent.dedupe_across_queries(results)
+
+    assert [_ids(nodes) for nodes in deduped] == [["a"], ["shared", "b"], ["c"]]
+    assert moved_to == [[1], [], [1]]
+
+def test_dedupe_without_overlap_is_identity():
+    results = [[_node("a", 0.9)], [], [_node("b", 0.1)]]
+    deduped, moved_to = agent.dedupe_across_queries(results)
+    assert [_ids(nodes) for nodes in deduped] == [["a"], [], ["b"]]
+    assert moved_to == [[], [], []]
+
+@pytest.fixture
+def batch(monkeypatch):
+    """每个查询召回的候选固定；精排分数由 (问题, 片段) 决定，便于核对分数被写回正确的节点"""
+    calls = {}
+    candidates = {
+        "q1": ["q1-a", "q1-b", "q1-c"],
+        "q2": ["q2-a"],
+        "q3": [],
+    }
+    relevance = {("q1", "q1-a"): 0.1, ("q1", "q1-b"): 0.9, ("q1", "q1-c"): 0.5, ("q2", "q2-a"): 0.7}
+
+    def fake_embed(queries):
+        calls["embed"] = list(queries)
+        return [[float(i)] for i, _ in enumerate(queries)]
+
+    def fake_score(pairs):
+        calls["pairs"] = [tuple(p) for p in pairs]
+        return [relevance[tuple(p)] for p in pairs]
+
+    monkeypatch.setattr(agent, "embed_queries", fake_embed)
+    monkeypatch.setattr(agent, "score_pairs", fake_score)
+    calls["candidates"] = candidates
+    return calls
+
+def test_batch_retrieve_maps_msearch_responses_to_queries(batch, monkeypatch):
+    def fake_msearch(index_name, bodies):
+        batch["bodies"] = bodies
+        return [
+            {"hits": {"hits": [{"_id": t} for t in batch["candidates"][q]]}}
+            for q in batch["embed"]
+        ]
+
+    monkeypatch.setattr(agent.mmap_store, "enabled", lambda: False)
+    monkeypatch.setattr(agent, "es_msearch", fake_msearch)
+    monkeypatch.setattr(agent, "_hit_to_node", lambda hit: _node(hit["_id"]))
+
+    results = agent.batch_retrieve_nodes(["q1", "q2", "q3"], similarity_top_k=3, rerank_top_n=2, hybrid=False)
+
+    # 一次向量计算、一次 _msearch、一次精排
+    assert batch["embed"] == ["q1", "q2", "q3"]
+    assert [body["knn"]["query_vector"] for body in batch["bodies"]] == [[0.0], [1.0], [2.0]]
+    assert all(body["knn"]["k"] == 3 and "query" not in body for body in batch["bodies"])
+    assert len(batch["pairs"]) == 4
+    # 与 queries 一一对应，各自按精排分数降序并截断到 rerank_top_n
+    assert [_ids(nodes) for nodes in results] == [["q1-b", "q1-c"], ["q2-a"], []]
+    assert [n.score for n in results[0]] == [0.9, 0.5]
+    assert results[1][0].score == 0.7
+
+def test_batch_retrieve_hybrid_adds_text_query(batch, monkeypatch):
+    def fake_msearch(index_name, bodies):
+        batch["bodies"] = bodies
+        return [{"hits": {"hits": []}} for _ in bodies]
+
+    monkeypatch.setattr(agent.mmap_store, "enabled", lambda: False)
+    monkeypatch.setattr(agent, "es_msearch", fake_msearch)
+    agent.batch_retrieve_nodes(["q1", "q2"], hybrid=True)
+    assert [body["query"]["match"]["content"] for body in batch["bodies"]] == ["q1", "q2"]
+    assert all(body["rank"] == {"rrf": {}} for body in batch["bodies"])
+
+def test_batch_retrieve_skips_rerank_without_candidates(batch, monkeypatch):
+    monkeypatch.setattr(agent.mmap_store, "enabled", lambda: False)
+    monkeypatch.setattr(agent, "es_msearch", lambda index_name, bodies: [{"hits": {"hits": []}} for _ in bodies])
+
+    assert agent.batch_retrieve_nodes(["q3"]) == [[]]
+    assert "pairs" not in batch
+
+def test_batch_retrieve_maps_scores_back_to_each_query_mmap(batch, monkeypatch):
+    def fake_search(index_name, vectors, top_k):
+        batch["search"] = (index_name, vectors, top_k)
+        return [[_node(t) for t in batch["candidates"][q]] for q in batch["embed"]]
+
+    monkeypatch.setattr(agent.mmap_store, "enabled", lambda: True)
+    monkeypatch.setattr(agent.mmap_store, "search_nodes", fake_search)
+
+    results = agent.batch_retrieve_nodes(["q1", "q2", "q3"], similarity_top_k=3, rerank_top_n=2, index_name="kb_line3")
+
+    # 一次向量计算、一次检索、一次精排
+    assert batch["embed"] == ["q1", "q2", "q3"]
+    assert batch["search"] == ("kb_line3", [[0.0], [1.0], [2.0]], 3)
+    assert len(batch["pairs"]) == 4
+    # 与 queries 一一对应，各自按精排分数降序并截断到 rerank_top_n
+    assert [_ids(nodes) for nodes in results] == [["q1-b", "q1-c"], ["q2-a"], []]
+    assert [n.score for n in results[0]] == [0.9, 0.5]
+    assert results[1][0].score == 0.7
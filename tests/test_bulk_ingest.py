@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+for module in ("numpy", "requests", "fastapi", "fitz", "llama_index.core", "llama_index.vector_stores.elasticsearch"):
+    pytest.importorskip(module)
+from app.core import bulk_ingest
+from app.core.bulk_ingest import Manifest
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "docs" / "a.pdf"
+    path.parent.mkdir()
+    path.write_bytes(b"%PDF-1.4 first")
+    return str(path)
+
+def test_done_file_is_skipped_after_reload(tmp_path, source):
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = Manifest(manifest_path)
+    assert not manifest.is_done(source, retry_failed=False)
+    manifest.mark(source, "done", name="a.pdf", chunks=3, pages=1)
+    manifest.save()
+
+    reloaded = Manifest(manifest_path)
+    assert reloaded.is_done(source, retry_failed=False)
+    assert reloaded.entries[source]["chunks"] == 3
+    assert not os.path.exists(manifest_path + ".tmp")
+
+def test_changed_file_is_ingested_again(tmp_path, source):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    manifest.mark(source, "done", name="a.pdf")
+    with open(source, "ab") as f:
+        f.write(b" appended")
+    assert not manifest.is_done(source, retry_failed=False)
+
+def test_failed_file_only_retried_on_request(tmp_path, source):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    manifest.mark(source, "failed", name="a.pdf", error="boom")
+    assert manifest.is_done(source, retry_failed=False)
+    assert not manifest.is_done(source, retry_failed=True)
+
+def test_partial_files_are_reported_for_cleanup(tmp_path, source):
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = Manifest(manifest_path)
+    manifest.mark(source, "partial", name="a.pdf")
+    manifest.save()
+    reloaded = Manifest(manifest_path)
+    assert reloaded.partial_names() == ["a.pdf"]
+    assert not reloaded.is_done(source, retry_failed=False)
+
+class Purged(Exception):
+    pass
+
+@pytest.fixture
+def purged(monkeypatch):
+    """记录 bulk_ingest 清理的文件名，清理之后就停止 (不启动解析进程)"""
+    names = []
+
+    def fake_purge(batch, index_name):
+        names.extend(batch)
+        raise Purged
+
+    monkeypatch.setattr(bulk_ingest, "purge_files", fake_purge)
+    monkeypatch.setattr(bulk_ingest.file_catalog, "ensure_catalog_index", lambda: None)
+    monkeypatch.setattr(bulk_ingest.partitions, "ingest_partition", lambda scope, text: "general")
+    return names
+
+def test_changed_and_partial_files_are_purged_before_reingest(tmp_path, source, purged):
+    other = os.path.join(os.path.dirname(source), "b.pdf")
+    with open(other, "wb") as f:
+        f.write(b"%PDF-1.4 second")
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = Manifest(manifest_path)
+    manifest.mark(source, "done", name="a.pdf")
+    manifest.mark(other, "done", name="b.pdf")
+    manifest.entries["/gone/c.pdf"] = {"status": "partial", "name": "c.pdf"}
+    manifest.save()
+    with open(source, "ab") as f:
+        f.write(b" edited")
+
+    with pytest.raises(Purged):
+        bulk_ingest.bulk_ingest(os.path.dirname(source), manifest_path=manifest_path)
+    # 未修改的 b.pdf 不重新入库，也不清理
+    assert purged == ["a.pdf", "c.pdf"]
+
+def test_new_files_are_purged_in_case_they_were_uploaded_before(tmp_path, source, purged):
+    with pytest.raises(Purged):
+        bulk_ingest.bulk_ingest(os.path.dirname(source), manifest_path=str(tmp_path / "manifest.json"))
+    assert purged == ["a.pdf"]
+
+def test_purge_files_batches_names(monkeypatch):
+    calls = []
+    monkeypatch.setattr(bulk_ingest.mmap_store, "enabled", lambda: False)
+    monkeypatch.setattr(bulk_ingest, "index_exists", lambda name: True)
+    monkeypatch.setattr(bulk_ingest, "es_request", lambda method, path, body, **kwargs: calls.append(body))
+    monkeypatch.setattr(bulk_ingest, "PURGE_BATCH_SIZE", 2)
+
+    bulk_ingest.purge_files(["a.pdf", "b.pdf", "c.pdf"], "factory_knowledge")
+    assert [c["query"]["terms"]["metadata.file_name.keyword"] for c in calls] == [["a.pdf", "b.pdf"], ["c.pdf"]]
@@ -0,0 +1,68 @@
+from app.core.context_packer import MIN_TRUNCATE_TOKENS, pack_context, strip_overlap
+from app.core.layout_chunker import estimate_tokens
+
+def node(text, file_name="a.pdf", page=1, score=0.5, **extra):
+    return dict(text=text, file_name=file_name, page_label=str(page), score=score, **extra)
+
+def test_top_group_kept_when_it_alone_exceeds_budget():
+    # 没有换行的长段落，按行截断会得到空文本
+    packed = pack_context([node("步骤" * 2000, score=0.9), node("其它内容", "b.pdf", score=0.1)], token_budget=300)
+    groups = packed["groups"]
+    assert [g["file_name"] for g in groups] == ["a.pdf"]
+    assert 0 < groups[0]["tokens"] <= 300
+    assert packed["stats"]["truncated_groups"] == 1
+
+def test_top_group_kept_when_budget_is_tiny():
+    packed = pack_context([node("word " * 400)], token_budget=5)
+    assert len(packed["groups"]) == 1
+    assert 0 < packed["groups"][0]["tokens"] <= MIN_TRUNCATE_TOKENS
+
+def test_lower_groups_dropped_once_budget_is_used():
+    nodes = [node("甲" * 100, "a.pdf", score=0.9), node("乙" * 100, "b.pdf", score=0.8), node("丙" * 100, "c.pdf", score=0.7)]
+    packed = pack_context(nodes, token_budget=150)
+    assert [g["file_name"] for g in packed["groups"]] == ["a.pdf"]
+    assert packed["stats"]["tokens_out"] <= 150
+
+def test_everything_fits_within_budget_unchanged():
+    nodes = [node("第一段内容", "a.pdf", score=0.9), node("第二段内容", "b.pdf", score=0.8)]
+    packed = pack_context(nodes, token_budget=1000)
+    assert [g["text"] for g in packed["groups"]] == ["第一段内容", "第二段内容"]
+    assert packed["stats"]["truncated_groups"] == 0
+
+def test_image_links_are_not_cut_when_truncating():
+    image = "![示意图](http://host/images/a_p1_0.png?v=abc)"
+    packed = pack_context([node(image + "\n" + "步骤" * 500, score=0.9)], token_budget=100)
+    text = packed["groups"][0]["text"]
+    assert text.startswith(image)
+    assert estimate_tokens(text) <= 100
+
+def test_image_budget_drops_extra_images():
+    images = "\n".join(f"![示意图](http://host/images/a_p1_{i}.png)" for i in range(4))
+    packed = pack_context([node(images)], token_budget=1000, max_images=2)
+    assert packed["stats"]["images_out"] == 2
+    assert packed["stats"]["images_dropped"] == 2
+
+def test_adjacent_pages_merged_and_overlap_stripped():
+    overlap = "这是两个切片之间重叠的一段文字内容，足够长"
+    nodes = [node("第一页开头。" + overlap, page=1, score=0.9), node(overlap + "第二页后续。", page=2, score=0.6)]
+    groups = pack_context(nodes, token_budget=1000)["groups"]
+    assert len(groups) == 1
+    assert groups[0]["page_start"] == 1 and groups[0]["page_end"] == 2
+    assert groups[0]["text"].count(overlap) == 1
+
+def test_strip_overlap_ignores_short_coincidences():
+    assert strip_overlap("abc", "abcdef") == "abcdef"
+
+def test_image_budget_counts_links_not_lines():
+    row = " ".join(f"![图{i}](http://host/images/a_p1_{i}.png)" for i in range(3))
+    packed = pack_context([node("接线图如下：\n" + row + "\n" + row.replace("p1", "p2"))], token_budget=1000, max_images=4)
+    text = packed["groups"][0]["text"]
+    assert text.count("![") == 4
+    assert "a_p1_2.png" in text and "a_p2_0.png" in text and "a_p2_1.png" not in text
+    assert packed["stats"]["images_out"] == 4
+    assert packed["stats"]["images_dropped"] == 2
+
+def test_image_budget_keeps_text_around_dropped_links():
+    text = "拧紧螺栓 ![a](http://host/images/a_p1_0.png) 然后复位 ![b](http://host/images/a_p1_1.png)"
+    packed = pack_context([node(text)], token_budget=1000, max_images=1)
+    assert packed["groups"][0]["text"] == "拧紧螺栓 ![a](http://host/images/a_p1_0.png) 然后复位"
@@ -0,0 +1,90 @@
+import pytest
+
+for module in ("requests", "dotenv"):
+    pytest.importorskip(module)
+from app.core import file_catalog
+
+NAMES = ["a.pdf", "b.pdf", "三号线 手册.pdf", "c/d.docx", "e.txt"]
+
+class FakeCatalog:
+    """按 name 排序、支持 search_after 的目录索引"""
+
+    def __init__(self, names):
+        self.names = sorted(names)
+        self.bodies = []
+
+    def request(self, method, path, body=None, **kwargs):
+        assert (method, path) == ("POST", f"/{file_catalog.CATALOG_INDEX}/_search")
+        self.bodies.append(body)
+        after = body.get("search_after", [""])[0]
+        page = [name for name in self.names if name > after][:body["size"]]
+        return {"hits": {
+            "total": {"value": len(self.names)},
+            "hits": [{"_source": {"name": name}, "sort": [name]} for name in page],
+        }}
+
+@pytest.fixture
+def catalog(monkeypatch):
+    fake = FakeCatalog(NAMES)
+    monkeypatch.setattr(file_catalog, "_mmap_store", lambda index_name=None: None)
+    monkeypatch.setattr(file_catalog, "index_exists", lambda name: True)
+    monkeypatch.setattr(file_catalog, "es_request", fake.request)
+    return fake
+
+def _walk(limit):
+    pages, cursor = [], None
+    while True:
+        page = file_catalog.list_files(limit=limit, cursor=cursor)
+        pages.append(page)
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+def test_cursor_walks_every_file_once_in_name_order(catalog):
+    pages = _walk(limit=2)
+    names = [f["name"] for page in pages for f in page["files"]]
+    assert names == sorted(NAMES)
+    assert [len(page["files"]) for page in pages] == [2, 2, 1]
+    assert all(page["total"] == len(NAMES) for page in pages)
+    # 第一页不带 search_after，之后用上一页最后一个文件名续读
+    assert "search_after" not in catalog.bodies[0]
+    assert catalog.bodies[1]["search_after"] == [sorted(NAMES)[1]]
+    assert catalog.bodies[0]["sort"] == [{"name": "asc"}]
+
+def test_full_last_page_ends_with_empty_page(catalog):
+    catalog.names = catalog.names[:4]
+    pages = _walk(limit=2)
+    assert [len(page["files"]) for page in pages] == [2, 2, 0]
+
+def test_limit_is_clamped(catalog, monkeypatch):
+    monkeypatch.setattr(file_catalog, "MAX_PAGE_SIZE", 3)
+    file_catalog.list_files(limit=0)
+    file_catalog.list_files(limit=10_000)
+    assert [body["size"] for body in catalog.bodies] == [1, 3]
+
+def test_invalid_cursor_is_rejected(catalog):
+    with pytest.raises(ValueError):
+        file_catalog.list_files(cursor="not a cursor!")
+
+def test_missing_catalog_is_rebuilt_before_listing(catalog, monkeypatch):
+    rebuilt = []
+    monkeypatch.setattr(file_catalog, "index_exists", lambda name: bool(rebuilt))
+    monkeypatch.setattr(file_catalog, "rebuild_catalog", lambda: rebuilt.append(True))
+    assert file_catalog.list_files(limit=10)["total"] == len(NAMES)
+    assert rebuilt == [True]
+
+def test_mmap_cursor_pagination(tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    pytest.importorskip("llama_index.core")
+    from app.core.mmap_store import MmapVectorStore
+
+    store = MmapVectorStore(str(tmp_path / "store"))
+    for name in NAMES:
+        store.upsert_file_record({"name": name, "chunks": 1, "pages": 1})
+    monkeypatch.setattr(file_catalog, "_mmap_store", lambda index_name=None: store)
+    monkeypatch.setattr(file_catalog, "rebuild_catalog", lambda: pytest.fail("目录非空时不需要重建"))
+
+    pages = _walk(limit=2)
+    assert [f["name"] for page in pages for f in page["files"]] == sorted(NAMES)
+    assert [len(page["files"]) for page in pages] == [2, 2, 1]
+    assert all(page["total"] == len(NAMES) for page in pages)
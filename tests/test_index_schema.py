@@ -0,0 +1,160 @@
+import pytest
+
+for module in ("requests", "dotenv"):
+    pytest.importorskip(module)
+from app.core import index_schema
+from app.core.es_client import ESError
+
+ALIAS = "factory_knowledge"
+NEW = "factory_knowledge_v2"
+
+# -----------------------------------------------------------
+# num_candidates
+# -----------------------------------------------------------
+def test_tune_knn_query_raises_num_candidates(monkeypatch):
+    monkeypatch.setattr(index_schema, "NUM_CANDIDATES", 200)
+    body = {"knn": {"field": "embedding", "k": 10, "num_candidates": 10}}
+    assert index_schema.tune_knn_query(body, "皮带跑偏") is body
+    assert body["knn"]["num_candidates"] == 200
+
+def test_tune_knn_query_never_below_k_and_handles_lists(monkeypatch):
+    monkeypatch.setattr(index_schema, "NUM_CANDIDATES", 50)
+    body = {"knn": [{"k": 10}, {"k": 80}]}
+    index_schema.tune_knn_query(body)
+    assert [clause["num_candidates"] for clause in body["knn"]] == [50, 80]
+
+def test_tune_knn_query_without_knn_is_untouched():
+    body = {"query": {"match": {"content": "皮带"}}}
+    assert index_schema.tune_knn_query(body) == {"query": {"match": {"content": "皮带"}}}
+
+# -----------------------------------------------------------
+# 迁移
+# -----------------------------------------------------------
+class FakeES:
+    """内存里的索引与别名：{索引名: {"aliases": {别名: 属性}, "count": 片段数}}"""
+
+    def __init__(self, indices):
+        self.indices = indices
+        self.calls = []
+        self.reindex_count = None
+
+    def index_exists(self, name):
+        return name in self.indices or any(name in info["aliases"] for info in self.indices.values())
+
+    def request(self, method, path, body=None, params=None, timeout=None, ignore=()):
+        self.calls.append((method, path, body))
+        parts = path.strip("/").split("/")
+        if method == "GET" and parts[0] == "_alias":
+            found = {index: {"aliases": {parts[1]: info["aliases"][parts[1]]}}
+                     for index, info in self.indices.items() if parts[1] in info["aliases"]}
+            return found or {"status": 404}
+        if method == "PUT":
+            self.indices[parts[0]] = {"aliases": dict(body.get("aliases", {})), "count": 0, "body": body}
+            return {}
+        if method == "POST" and parts[0] == "_reindex":
+            source, dest = body["source"]["index"], body["dest"]["index"]
+            copied = self.indices[source]["count"] if self.reindex_count is None else self.reindex_count
+            self.indices[dest]["count"] = copied
+            return {"task": "node:7"}
+        if method == "GET" and parts[0] == "_tasks":
+            return {"completed": True, "task": {"status": {"created": 3, "total": 3}}, "response": {"failures": []}}
+        if method == "DELETE" and parts[0] == ".tasks":
+            return {}
+        if method == "GET" and parts[-1] == "_count":
+            return {"count": self.indices[parts[0]]["count"]}
+        if method == "GET" and parts[-1] == "_alias":
+            return {parts[0]: {"aliases": dict(self.indices[parts[0]]["aliases"])}}
+        if method == "POST" and parts[0] == "_aliases":
+            for action in body["actions"]:
+                (kind, args), = action.items()
+                if kind == "add":
+                    self.indices[args["index"]]["aliases"][args["alias"]] = {"is_write_index": args["is_write_index"]}
+                elif kind == "remove":
+                    del self.indices[args["index"]]["aliases"][args["alias"]]
+                elif kind == "remove_index":
+                    del self.indices[args["index"]]
+            return {"acknowledged": True}
+        if method == "DELETE":
+            self.indices.pop(parts[0], None)
+            return {}
+        raise AssertionError(f"unexpected request {method} {path}")
+
+@pytest.fixture
+def es(monkeypatch):
+    def install(indices):
+        fake = FakeES(indices)
+        monkeypatch.setattr(index_schema, "es_request", fake.request)
+        monkeypatch.setattr(index_schema, "index_exists", fake.index_exists)
+        monkeypatch.setattr(index_schema, "versioned_name", lambda alias: NEW)
+        monkeypatch.setattr(index_schema, "MIGRATE_POLL_INTERVAL", 0)
+        monkeypatch.setattr(index_schema, "_ensured", set())
+        return fake
+    return install
+
+def test_knowledge_index_body_uses_configured_vector_options(monkeypatch):
+    monkeypatch.setattr(index_schema, "VECTOR_INDEX_TYPE", "int8_hnsw")
+    monkeypatch.setattr(index_schema, "HNSW_M", 32)
+    mappings = index_schema.knowledge_index_body()["mappings"]
+    embedding = mappings["properties"]["embedding"]
+    assert embedding["index_options"]["type"] == "int8_hnsw"
+    assert embedding["index_options"]["m"] == 32
+    assert mappings["_meta"]["managed_by"] == "factory_agent"
+    assert mappings["properties"]["metadata"]["properties"]["_node_content"]["index"] is False
+
+def test_migrate_plain_index_replaces_it_with_alias(es):
+    fake = es({ALIAS: {"aliases": {}, "count": 3}})
+
+    result = index_schema.migrate(ALIAS, samples=0)
+
+    assert result == {"migrated": True, "old": ALIAS, "new": NEW, "docs": 3, "comparison": []}
+    # 旧的普通索引被删除，同名别名指向新索引并作为写入索引
+    assert list(fake.indices) == [NEW]
+    assert fake.indices[NEW]["aliases"] == {ALIAS: {"is_write_index": True}}
+    assert fake.indices[NEW]["body"]["mappings"]["_meta"]["managed_by"] == "factory_agent"
+    assert ("DELETE", "/.tasks/_doc/node:7", None) in fake.calls
+
+def test_migrate_versioned_index_moves_every_alias(es):
+    old = "factory_knowledge_v1"
+    fake = es({
+        old: {"aliases": {ALIAS: {"is_write_index": True}, "factory_knowledge_p_general": {"is_write_index": True}}, "count": 5},
+        "factory_knowledge_p_line3": {"aliases": {ALIAS: {"is_write_index": False}}, "count": 2},
+    })
+
+    index_schema.migrate(ALIAS, samples=0)
+
+    assert fake.indices[NEW]["aliases"] == {
+        ALIAS: {"is_write_index": True},
+        "factory_knowledge_p_general": {"is_write_index": True},
+    }
+    # 旧索引删除；其他分区索引上的读别名不受影响
+    assert old not in fake.indices
+    assert fake.indices["factory_knowledge_p_line3"]["aliases"] == {ALIAS: {"is_write_index": False}}
+
+def test_migrate_keep_old_leaves_old_index_without_aliases(es):
+    old = "factory_knowledge_v1"
+    fake = es({old: {"aliases": {ALIAS: {"is_write_index": True}}, "count": 1}})
+
+    index_schema.migrate(ALIAS, keep_old=True, samples=0)
+
+    assert fake.indices[old]["aliases"] == {}
+    assert fake.indices[NEW]["aliases"] == {ALIAS: {"is_write_index": True}}
+
+def test_migrate_count_mismatch_keeps_alias_on_old_index(es):
+    fake = es({ALIAS: {"aliases": {}, "count": 3}})
+    fake.reindex_count = 2
+
+    with pytest.raises(ESError):
+        index_schema.migrate(ALIAS, samples=0)
+
+    assert fake.indices[ALIAS]["count"] == 3
+    assert fake.indices[NEW]["aliases"] == {}
+    assert not any(path == "/_aliases" for _, path, _ in fake.calls)
+
+def test_migrate_missing_index_creates_managed_index(es):
+    fake = es({})
+
+    result = index_schema.migrate(ALIAS, samples=0)
+
+    assert result["migrated"] is False
+    assert fake.indices[NEW]["aliases"] == {ALIAS: {"is_write_index": True}}
+    assert not any(path == "/_reindex" for _, path, _ in fake.calls)
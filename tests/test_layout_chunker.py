@@ -0,0 +1,53 @@
+from app.core.layout_chunker import chunk_layout_items, heading_level, is_step
+
+def text(content, page=1, y=0.0, size=10.0, bold=False):
+    return {"page": page, "y": y, "type": "text", "content": content, "size": size, "bold": bold}
+
+def image(name, page=1, y=0.0):
+    return {"page": page, "y": y, "type": "image", "content": f"\n\n![示意图](http://host/images/{name})\n\n", "image": name}
+
+def test_numbered_headings_levels():
+    assert heading_level(text("第一章 设备概述"), 10, []) == 1
+    assert heading_level(text("一、日常点检"), 10, []) == 2
+    assert heading_level(text("3.2.1 更换皮带"), 10, []) == 3
+    # 以标点结尾的是正文，不是标题
+    assert heading_level(text("检查完毕后："), 10, []) is None
+
+def test_step_patterns():
+    for content in ["1. 关闭电源", "2、拆下护罩", "(3) 松开螺栓", "步骤4 复位", "Step 5 test", "① 检查"]:
+        assert is_step(text(content)), content
+    assert not is_step(text("1.5 倍额定电流"))
+
+def test_images_follow_their_step_and_heading_path_is_kept():
+    items = [
+        text("第一章 输送机", size=14),
+        text("一、更换皮带"),
+        text("1. 关闭电源并挂牌。"),
+        image("a_p1_0.png"),
+        text("2. 松开张紧螺栓。", page=2),
+        image("a_p2_0.png", page=2),
+        text("二、日常点检", page=2),
+        text("每班检查皮带跑偏情况。", page=2),
+    ]
+    chunks = chunk_layout_items(items, target_tokens=10)
+    steps = [c for c in chunks if c["kind"] == "step"]
+    assert [c["images"] for c in steps] == [["a_p1_0.png"], ["a_p2_0.png"]]
+    assert steps[0]["heading_path"] == ["第一章 输送机", "一、更换皮带"]
+    assert steps[1]["page_start"] == steps[1]["page_end"] == 2
+    assert chunks[-1]["heading_path"] == ["第一章 输送机", "二、日常点检"]
+    assert "每班检查" in chunks[-1]["text"]
+
+def test_small_steps_under_same_heading_are_merged():
+    items = [text("一、更换皮带"), text("1. 关闭电源。"), text("2. 松开螺栓。"), text("3. 取下皮带。")]
+    chunks = chunk_layout_items(items, target_tokens=512)
+    assert len(chunks) == 1
+    assert chunks[0]["kind"] == "step"
+    assert all(step in chunks[0]["text"] for step in ["1. 关闭电源", "2. 松开螺栓", "3. 取下皮带"])
+
+def test_oversized_step_is_split_without_separating_image():
+    paragraphs = [text("1. " + "拆" * 30 + "。")] + [text("甲" * 30 + "。") for _ in range(4)]
+    items = paragraphs[:2] + [image("a_p1_0.png")] + paragraphs[2:]
+    chunks = chunk_layout_items(items, target_tokens=20)
+    assert len(chunks) > 1
+    holder = [c for c in chunks if c["images"]]
+    assert len(holder) == 1 and holder[0]["text"].index("甲") < holder[0]["text"].index("a_p1_0.png")
@@ -0,0 +1,62 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi import HTTPException
+
+from app.core import media
+
+@pytest.mark.parametrize("name", ["../secret.txt", "sub/a.png", "/etc/passwd", ".variants", ".env", ""])
+def test_safe_path_rejects_traversal_and_hidden_names(tmp_path, name):
+    with pytest.raises(HTTPException) as info:
+        media._safe_path(str(tmp_path), name)
+    assert info.value.status_code == 404
+
+def test_safe_path_accepts_existing_file(tmp_path):
+    (tmp_path / "a_p1_0.png").write_bytes(b"x")
+    assert media._safe_path(str(tmp_path), "a_p1_0.png") == os.path.join(str(tmp_path), "a_p1_0.png")
+
+def test_safe_path_missing_file_is_404(tmp_path):
+    with pytest.raises(HTTPException):
+        media._safe_path(str(tmp_path), "missing.png")
+
+def test_generate_variants_removes_stale_variants(tmp_path):
+    pytest.importorskip("PIL")
+    out_dir = tmp_path / media.VARIANTS_DIRNAME
+    out_dir.mkdir()
+    for variant in media.variant_names("a_p1_0.png").values():
+        (out_dir / variant).write_bytes(b"old")
+    # 同名新图无法解码，不会生成任何版本；旧版本也不能留着继续被分发
+    image_path = tmp_path / "a_p1_0.png"
+    image_path.write_bytes(b"not an image")
+    assert media.generate_variants(str(image_path), str(tmp_path)) == []
+    assert os.listdir(out_dir) == []
+
+def test_original_of_reverses_variant_names():
+    for variant in media.variant_names("a_p1_0.jpeg").values():
+        assert media._original_of(variant) == "a_p1_0.jpeg"
+
+def _cache_control_for(monkeypatch, tmp_path, version):
+    served = {}
+    monkeypatch.setattr(media, "serve_file", lambda request, path, cache_control, **kw: served.setdefault("cc", cache_control))
+    request = SimpleNamespace(headers={}, query_params={"v": version} if version is not None else {})
+    media.image_response(request, "a_p1_0.png", images_dir=str(tmp_path))
+    return served["cc"]
+
+def test_image_response_immutable_only_for_current_version(monkeypatch, tmp_path):
+    (tmp_path / "a_p1_0.png").write_bytes(b"new image")
+    current = media.content_version(b"new image")
+    assert _cache_control_for(monkeypatch, tmp_path, current) == media.IMMUTABLE_CACHE
+    # 图片已被重新入库覆盖，旧链接的版本号不能再被长期缓存
+    assert _cache_control_for(monkeypatch, tmp_path, media.content_version(b"old image")) == media.REVALIDATE_CACHE
+    assert _cache_control_for(monkeypatch, tmp_path, "") == media.REVALIDATE_CACHE
+    assert _cache_control_for(monkeypatch, tmp_path, None) == media.REVALIDATE_CACHE
+
+def test_file_version_follows_file_content(tmp_path):
+    path = tmp_path / "a_p1_0.png"
+    path.write_bytes(b"one")
+    assert media.file_version(str(path)) == media.content_version(b"one")
+    path.write_bytes(b"two!")
+    assert media.file_version(str(path)) == media.content_version(b"two!")
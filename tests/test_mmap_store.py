@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+for module in ("requests", "dotenv", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core.mmap_store import MmapVectorStore
+
+DIMS = 8
+VECTORS = np.random.default_rng(0).normal(size=(30, DIMS)).astype(np.float32)
+
+@pytest.fixture
+def store(tmp_path):
+    store = MmapVectorStore(str(tmp_path / "store"))
+    records = []
+    for i in range(30):
+        file_name = f"doc{i % 3}.pdf"
+        partition = "line3" if i % 3 == 0 else "general"
+        metadata = {"file_name": file_name, "partition": partition, "page_label": str(i // 3)}
+        records.append((f"node-{i}", f"片段 {i}", metadata, VECTORS[i].tolist()))
+    store.add_records(records)
+    return store
+
+def _brute_force(query, rows, top_k):
+    vectors = VECTORS / np.linalg.norm(VECTORS, axis=1, keepdims=True)
+    query = query / np.linalg.norm(query)
+    scores = {row: float(vectors[row] @ query) for row in rows}
+    return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+def test_exact_search_matches_brute_force(store):
+    query = VECTORS[5] + 0.1
+    hits = store.search(query, top_k=5, mode="exact")[0]
+    assert [row for row, _ in hits] == _brute_force(query, range(30), 5)
+    assert hits[0][1] >= hits[-1][1]
+
+def test_partition_filter(store):
+    query = VECTORS[4]
+    hits = store.search(query, top_k=30, partition_filter={"line3"}, mode="exact")[0]
+    assert sorted(row for row, _ in hits) == list(range(0, 30, 3))
+
+def test_deleted_file_is_excluded(store):
+    assert store.delete_files(["doc1.pdf"]) == 10
+    hits = store.search(VECTORS[1], top_k=30, mode="exact")[0]
+    assert len(hits) == 20
+    assert all(row % 3 != 1 for row, _ in hits)
+    assert store.count_file("doc1.pdf") == 0
+    assert store.stats()["deleted"] == 10
+
+def test_compact_renumbers_rows(store):
+    store.delete_files(["doc1.pdf"])
+    old_snapshot = store._snapshot()
+    old_hits = store.search(VECTORS[2], top_k=1, mode="exact", snapshot=old_snapshot)[0]
+
+    assert store.compact() == {"removed": 10, "rows": 20}
+    assert store.stats()["rows"] == 20
+
+    # 原第 2 行 (doc2.pdf) 压缩后是第 1 行
+    hits = store.search(VECTORS[2], top_k=1, mode="exact")[0]
+    assert hits[0][0] == 1
+    assert store.fetch(hits)[0].node.text == "片段 2"
+    # 检索与取正文之间发生 compact：按检索时的快照仍能取到同一片段
+    assert old_hits[0][0] == 2
+    assert store.fetch(old_hits, state=old_snapshot[6])[0].node.text == "片段 2"
+
+def test_compact_removes_older_segments(store):
+    for name in ("doc0.pdf", "doc1.pdf"):
+        store.delete_files([name])
+        store.compact()
+    names = os.listdir(store.path)
+    assert "vectors.f32" not in names
+    assert "vectors.2.f32" in names
+    assert store.search(VECTORS[2], top_k=30, mode="exact")[0]
+
+def test_file_records(store):
+    store.upsert_file_record({"name": "doc0.pdf", "chunks": 10, "pages": 10, "partition": "line3"})
+    store.upsert_file_record({"name": "doc2.pdf", "chunks": 10, "pages": 10, "partition": "general"})
+    assert store.get_file_record("doc0.pdf")["partition"] == "line3"
+
+    records, total = store.list_file_records(limit=1)
+    assert total == 2 and [r["name"] for r in records] == ["doc0.pdf"]
+    records, _ = store.list_file_records(limit=1, after="doc0.pdf")
+    assert [r["name"] for r in records] == ["doc2.pdf"]
+
+    store.remove_file_record("doc0.pdf")
+    assert store.get_file_record("doc0.pdf") is None
+
+def test_indexed_files(store):
+    store.delete_files(["doc1.pdf"])
+    assert store.indexed_files() == [
+        {"name": "doc0.pdf", "partition": "line3", "chunks": 10, "pages": 10},
+        {"name": "doc2.pdf", "partition": "general", "chunks": 10, "pages": 10},
+    ]
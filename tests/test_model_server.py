@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+for module in ("dotenv", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import model_server
+from app.core.model_server import MicroBatcher, ModelClient, ModelServer, ModelServerError, _encode, _recv_exact
+
+# -----------------------------------------------------------
+# 协议
+# -----------------------------------------------------------
+def test_framing_round_trip():
+    left, right = socket.socketpair()
+    with left, right:
+        message = {"op": "embed", "payload": {"texts": ["三号线", "x" * 70000]}}
+        left.sendall(_encode(message))
+        size = int.from_bytes(_recv_exact(right, 4), "big")
+        assert json.loads(_recv_exact(right, size).decode("utf-8")) == message
+
+def test_recv_exact_reports_closed_connection():
+    left, right = socket.socketpair()
+    with right:
+        left.sendall(b"\x00\x00")
+        left.close()
+        with pytest.raises(ConnectionError):
+            _recv_exact(right, 4)
+
+# -----------------------------------------------------------
+# 微批
+# -----------------------------------------------------------
+def test_micro_batcher_merges_concurrent_requests():
+    batches = []
+
+    def double(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher("test", double, max_batch=32, max_wait_ms=50)
+        runner = asyncio.create_task(batcher.run())
+        results = await asyncio.gather(batcher.submit([1, 2]), batcher.submit([3]), batcher.submit([4, 5, 6]))
+        runner.cancel()
+        return results, batcher.stats
+
+    results, stats = asyncio.run(scenario())
+    assert results == [[2, 4], [6], [8, 10, 12]]
+    assert batches == [[1, 2, 3, 4, 5, 6]]
+    assert (stats["requests"], stats["items"], stats["batches"]) == (3, 6, 1)
+
+def test_micro_batcher_respects_max_batch_and_propagates_errors():
+    batches = []
+
+    def fn(items):
+        batches.append(len(items))
+        if "bad" in items:
+            raise ValueError("bad input")
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher("test", fn, max_batch=2, max_wait_ms=50)
+        runner = asyncio.create_task(batcher.run())
+        ok = await asyncio.gather(batcher.submit(["a"]), batcher.submit(["b"]), batcher.submit(["c"]))
+        with pytest.raises(ValueError):
+            await batcher.submit(["bad"])
+        runner.cancel()
+        return ok
+
+    assert asyncio.run(scenario()) == [["a"], ["b"], ["c"]]
+    assert batches == [2, 1, 1]
+
+# -----------------------------------------------------------
+# 客户端 <-> 服务端
+# -----------------------------------------------------------
+class ServerThread:
+    """在后台线程的事件循环里运行 handler (asyncio Unix Socket 服务)"""
+
+    def __init__(self, path, handler):
+        self.path = path
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(handler,), daemon=True)
+        self.thread.start()
+        self.ready.wait(5)
+
+    def _run(self, handler):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_unix_server(handler, path=self.path))
+        self.ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+@pytest.fixture
+def socket_path(tmp_path):
+    # Unix Socket 路径长度有限制，不能放在很深的临时目录里
+    path = f"/tmp/test_models_{os.getpid()}_{id(tmp_path)}.sock"
+    yield path
+    if os.path.exists(path):
+        os.remove(path)
+
+def fake_model_server():
+    """不加载模型的 ModelServer：embed 返回文本长度，rerank 返回序号"""
+    server = ModelServer.__new__(ModelServer)
+    server.voice_pool = None
+    server.batchers = {
+        "query": MicroBatcher("embed_query", lambda texts: [[float(len(t))] for t in texts]),
+        "text": MicroBatcher("embed_text", lambda texts: [[float(len(t))] for t in texts]),
+        "rerank": MicroBatcher("rerank", lambda pairs: [float(i) for i in range(len(pairs))]),
+    }
+    return server
+
+def test_client_server_round_trip(socket_path):
+    server = fake_model_server()
+
+    async def handler(reader, writer):
+        for batcher in server.batchers.values():
+            if not getattr(batcher, "started", False):
+                batcher.started = True
+                asyncio.create_task(batcher.run())
+        await server.handle(reader, writer)
+
+    thread = ServerThread(socket_path, handler)
+    try:
+        client = ModelClient(socket_path, timeout=5)
+        assert client.call("ping") == "pong"
+        assert client.call("embed", {"mode": "text", "texts": ["ab", "abcd"]}) == [[2.0], [4.0]]
+        assert client.call("rerank", {"pairs": [["q", "a"], ["q", "b"]]}) == [0.0, 1.0]
+        with pytest.raises(ModelServerError, match="未知操作"):
+            client.call("explode")
+    finally:
+        thread.stop()
+
+def test_receive_timeout_is_not_retried(socket_path):
+    received = []
+
+    async def slow_handler(reader, writer):
+        header = await reader.readexactly(4)
+        received.append(json.loads(await reader.readexactly(int.from_bytes(header, "big"))))
+        await asyncio.sleep(2)  # 模拟还在计算的长任务
+        writer.close()
+
+    thread = ServerThread(socket_path, slow_handler)
+    try:
+        client = ModelClient(socket_path, timeout=0.3)
+        with pytest.raises(ModelServerError, match="未返回"):
+            client.call("transcribe", {"path": "/data/long.wav"})
+        assert len(received) == 1
+    finally:
+        thread.stop()
+
+def test_stale_connection_is_reconnected(socket_path):
+    requests = []
+
+    async def one_shot_handler(reader, writer):
+        # 每条连接只回答一次就关闭，模拟服务重启后旧连接失效
+        header = await reader.readexactly(4)
+        requests.append(json.loads(await reader.readexactly(int.from_bytes(header, "big"))))
+        writer.write(_encode({"ok": True, "result": len(requests)}))
+        await writer.drain()
+        writer.close()
+
+    thread = ServerThread(socket_path, one_shot_handler)
+    try:
+        client = ModelClient(socket_path, timeout=5)
+        assert client.call("ping") == 1
+        assert client.call("ping") == 2
+        assert len(requests) == 2
+    finally:
+        thread.stop()
+
+def test_unreachable_server(socket_path):
+    with pytest.raises(ModelServerError, match="不可用"):
+        ModelClient(socket_path, timeout=1).call("ping")
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("dotenv")
+from app.core import partitions
+
+@pytest.fixture
+def definitions(tmp_path, monkeypatch):
+    path = tmp_path / "partitions.json"
+    path.write_text(json.dumps({
+        "line3_conveyor": {"name": "三号线输送机", "keywords": ["三号线", "输送机"]},
+        "line5_robot": {"name": "五号线焊接机器人", "keywords": ["五号线", "焊接机器人"]},
+    }, ensure_ascii=False), encoding="utf-8")
+    monkeypatch.setattr(partitions, "PARTITIONS_FILE", str(path))
+    monkeypatch.setattr(partitions, "_config_cache", {"mtime": None, "partitions": {}})
+    # 不访问 ES：只有 line9_press 已经有数据
+    monkeypatch.setattr(partitions, "existing_partitions", lambda: {"line9_press", partitions.GENERAL})
+
+def test_all_means_whole_library(definitions):
+    assert partitions.resolve_scope("all", "三号线输送机跑偏") is None
+    assert partitions.resolve_scope(" ALL ", "") is None
+
+def test_explicit_scope_wins_over_keywords(definitions):
+    assert partitions.resolve_scope("line5_robot", "三号线输送机跑偏") == "line5_robot"
+    assert partitions.resolve_scope("general", "三号线") == "general"
+    # 分区定义文件里没有、但 ES 中已有数据的分区也可以指定
+    assert partitions.resolve_scope("line9_press", "") == "line9_press"
+
+def test_unknown_or_invalid_scope_raises(definitions):
+    with pytest.raises(ValueError):
+        partitions.resolve_scope("line7_unknown", "")
+    with pytest.raises(ValueError):
+        partitions.resolve_scope("../etc", "")
+
+def test_scope_inferred_from_query(definitions):
+    assert partitions.resolve_scope(None, "三号线输送机皮带跑偏怎么办") == "line3_conveyor"
+    assert partitions.resolve_scope("", "焊接机器人报警") == "line5_robot"
+    assert partitions.resolve_scope(None, "安全帽佩戴规范") is None
+
+def test_ambiguous_query_searches_whole_library(definitions):
+    assert partitions.resolve_scope(None, "三号线和五号线都停了") is None
+
+def test_ingest_partition_falls_back_to_general(definitions):
+    assert partitions.ingest_partition(None, "三号线输送机手册.pdf") == "line3_conveyor"
+    assert partitions.ingest_partition(None, "安全规程.pdf") == partitions.GENERAL
+    with pytest.raises(ValueError):
+        partitions.ingest_partition("all", "")
+
+def test_search_keys_include_general_only_for_existing_partition(definitions, monkeypatch):
+    monkeypatch.setattr(partitions, "PARTITION_INCLUDE_GENERAL", True)
+    assert partitions.search_keys(None) is None
+    assert partitions.search_keys("line9_press") == {"line9_press", partitions.GENERAL}
+    # 还没有数据的分区退回全库
+    assert partitions.search_keys("line3_conveyor") is None
+    assert partitions.search_target("line9_press") == f"{partitions.partition_alias('line9_press')},{partitions.partition_alias('general')}"
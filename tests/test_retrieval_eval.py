@@ -0,0 +1,102 @@
+import json
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+for module in ("numpy", "requests", "dotenv", "fastapi", "fitz", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import retrieval_eval
+from app.core.retrieval_eval import load_golden_set, pick_cheapest, score_result
+
+def node(file_name, page=None, page_end=None):
+    metadata = {"file_name": file_name}
+    if page is not None:
+        metadata["page_label"] = str(page)
+    if page_end is not None:
+        metadata["page_end"] = str(page_end)
+    return SimpleNamespace(metadata=metadata)
+
+def expected(file_name, page=None):
+    return {"file_name": file_name, "page": str(page) if page is not None else None}
+
+# -----------------------------------------------------------
+# 黄金集
+# -----------------------------------------------------------
+def test_load_jsonl_and_single_expected(tmp_path):
+    path = tmp_path / "golden.jsonl"
+    path.write_text(
+        json.dumps({"question": "急停后如何复位？", "file_name": "a.pdf", "page": 12}, ensure_ascii=False) + "\n\n"
+        + json.dumps({"question": "换刀步骤", "file_name": "b.docx"}, ensure_ascii=False) + "\n",
+        encoding="utf-8",
+    )
+    assert load_golden_set(str(path)) == [
+        {"question": "急停后如何复位？", "expected": [expected("a.pdf", 12)]},
+        {"question": "换刀步骤", "expected": [expected("b.docx")]},
+    ]
+
+def test_load_json_array_with_multiple_expected(tmp_path):
+    path = tmp_path / "golden.json"
+    items = [{"question": "q", "expected": [{"file_name": "a.pdf", "page": 3}, {"file_name": "b.pdf", "page": None}]}]
+    path.write_text(json.dumps(items), encoding="utf-8")
+    assert load_golden_set(str(path))[0]["expected"] == [expected("a.pdf", 3), expected("b.pdf")]
+
+# -----------------------------------------------------------
+# 指标
+# -----------------------------------------------------------
+def test_score_first_hit_rank_and_recall():
+    nodes = [node("x.pdf", 1), node("a.pdf", 5), node("b.pdf", 2)]
+    scores = score_result(nodes, [expected("a.pdf", 5), expected("c.pdf")])
+    assert scores == {"recall": 0.5, "reciprocal_rank": 0.5}
+
+def test_score_page_range_and_file_only_expectation():
+    # 版面切片跨 3~6 页
+    assert score_result([node("a.pdf", 3, 6)], [expected("a.pdf", 5)])["recall"] == 1.0
+    assert score_result([node("a.pdf", 3, 6)], [expected("a.pdf", 7)])["recall"] == 0.0
+    assert score_result([node("a.pdf", 9)], [expected("a.pdf")])["reciprocal_rank"] == 1.0
+
+def test_score_non_numeric_page_labels():
+    assert score_result([node("a.pdf", "iv")], [expected("a.pdf", "iv")])["recall"] == 1.0
+    assert score_result([node("a.pdf", "iv")], [expected("a.pdf", "v")])["recall"] == 0.0
+
+def test_score_no_results():
+    assert score_result([], [expected("a.pdf")]) == {"recall": 0.0, "reciprocal_rank": 0.0}
+
+# -----------------------------------------------------------
+# 推荐配置
+# -----------------------------------------------------------
+def result(recall, latency, mrr=0.5, top_k=10):
+    return {"recall": recall, "latency_avg_ms": latency, "mrr": mrr, "top_k": top_k}
+
+def test_pick_cheapest_within_tolerance():
+    results = [result(0.95, 300, top_k=20), result(0.94, 120, top_k=10), result(0.80, 50, top_k=5)]
+    assert pick_cheapest(results, tolerance=0.02)["top_k"] == 10
+    assert pick_cheapest(results, tolerance=0.0)["top_k"] == 20
+    assert pick_cheapest(results, tolerance=0.2)["top_k"] == 5
+
+def test_pick_cheapest_breaks_latency_ties_by_mrr():
+    results = [result(0.9, 100, mrr=0.4, top_k=5), result(0.9, 100, mrr=0.7, top_k=10)]
+    assert pick_cheapest(results, tolerance=0.0)["top_k"] == 10
+
+def test_pick_cheapest_empty():
+    assert pick_cheapest([], tolerance=0.02) == {}
+
+# -----------------------------------------------------------
+# 评测索引 (mmap 后端)
+# -----------------------------------------------------------
+def test_prepare_index_uses_mmap_collections(tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval_eval.mmap_store, "enabled", lambda: True)
+    monkeypatch.setattr(retrieval_eval.mmap_store, "MMAP_STORE_DIR", str(tmp_path))
+    monkeypatch.setattr(retrieval_eval, "index_exists", lambda name: pytest.fail("不应访问 ES"))
+    name = f"{retrieval_eval.EVAL_INDEX_PREFIX}256"
+    (tmp_path / name).mkdir()
+    (tmp_path / name / "state.json").write_text("{}")
+
+    assert retrieval_eval.prepare_index(256, str(tmp_path / "docs")) == name
+    assert (tmp_path / name / "state.json").exists()
+
+    (tmp_path / "docs").mkdir()
+    # kb_manager 导入时会加载模型；目录为空，不会真正入库
+    monkeypatch.setitem(sys.modules, "app.core.kb_manager", SimpleNamespace(index_documents=None))
+    retrieval_eval.prepare_index(256, str(tmp_path / "docs"), rebuild=True)
+    assert not (tmp_path / name / "state.json").exists()
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from app.core.scheduler import AdmissionScheduler, Overloaded, WorkloadClass
+
+def make_scheduler(total_slots=1, chat_wait=5.0, ingest_queue=4, ingest_wait=5.0):
+    return AdmissionScheduler(
+        total_slots=total_slots,
+        classes=[
+            WorkloadClass("chat", priority=0, max_concurrency=total_slots, max_queue=4, max_wait=chat_wait),
+            WorkloadClass("ingest", priority=3, max_concurrency=1, max_queue=ingest_queue, max_wait=ingest_wait),
+        ],
+    )
+
+def test_freed_slot_goes_to_higher_priority_waiter():
+    async def scenario():
+        sched = make_scheduler()
+        await sched.acquire("ingest")
+        order = []
+
+        async def wait_for(name):
+            await sched.acquire(name)
+            order.append(name)
+            sched.release(name, 0.0)
+
+        # 入库先排队，对话后到，但槽位空出来时应先给对话
+        ingest = asyncio.create_task(wait_for("ingest"))
+        await asyncio.sleep(0)
+        chat = asyncio.create_task(wait_for("chat"))
+        await asyncio.sleep(0)
+        sched.release("ingest", 0.0)
+        await asyncio.gather(ingest, chat)
+        return order, sched
+
+    order, sched = asyncio.run(scenario())
+    assert order == ["chat", "ingest"]
+    assert sched.running_total == 0
+    assert all(cls.running == 0 and cls.queued == 0 for cls in sched.classes.values())
+
+def test_per_class_limit_lets_lower_priority_use_idle_slot():
+    async def scenario():
+        sched = make_scheduler(total_slots=2)
+        sched.classes["chat"].max_concurrency = 1
+        await sched.acquire("chat")
+        # 第二个对话请求被对话自身的并发上限卡住，空闲槽位可以先给入库
+        blocked_chat = asyncio.create_task(sched.acquire("chat"))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(sched.acquire("ingest"), timeout=1)
+        running = {name: cls.running for name, cls in sched.classes.items()}
+        blocked_chat.cancel()
+        return running
+
+    assert asyncio.run(scenario()) == {"chat": 1, "ingest": 1}
+
+def test_wait_timeout_raises_overloaded_and_cleans_queue():
+    async def scenario():
+        sched = make_scheduler(ingest_wait=0.05)
+        await sched.acquire("ingest")
+        with pytest.raises(Overloaded) as info:
+            await sched.acquire("ingest")
+        return sched, info.value
+
+    sched, error = asyncio.run(scenario())
+    assert error.workload == "ingest"
+    assert error.reason == "排队超时"
+    assert error.retry_after >= 1
+    assert sched.classes["ingest"].queued == 0
+    assert sched.classes["ingest"].rejected == 1
+
+def test_full_queue_rejects_immediately():
+    async def scenario():
+        sched = make_scheduler(ingest_queue=1)
+        await sched.acquire("ingest")
+        queued = asyncio.create_task(sched.acquire("ingest"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as info:
+            await sched.acquire("ingest")
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        return sched, info.value
+
+    sched, error = asyncio.run(scenario())
+    assert error.reason == "排队已满"
+    assert sched.classes["ingest"].queued == 0
+
+def test_lease_releases_only_once():
+    async def scenario():
+        sched = make_scheduler()
+        lease = await sched.lease("chat")
+        lease.release()
+        lease.release()
+        return sched
+
+    sched = asyncio.run(scenario())
+    assert sched.running_total == 0
+    assert sched.classes["chat"].running == 0
@@ -0,0 +1,90 @@
+import os
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+for module in ("torch", "numpy", "requests", "dotenv", "nest_asyncio", "langgraph", "langchain_openai", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import model_server
+
+# 使用远程模型适配器 (不连接、不加载本地权重)；大模型客户端只在调用时才需要真实的 key
+model_server.MODEL_SERVER_SOCKET = model_server.MODEL_SERVER_SOCKET or "/tmp/unused_test_models.sock"
+os.environ.setdefault("DASHSCOPE_API_KEY", "test")
+from app.core import agent
+
+INDEX = "factory_knowledge"
+QUESTION = "三号线输送机跑偏怎么调整"
+
+@pytest.fixture
+def retrieval(monkeypatch):
+    """记录后台粗排与取用时精排的调用"""
+    calls = {"retrieve": [], "rerank": []}
+    gate = threading.Event()
+
+    def fake_retrieve(query, **kwargs):
+        gate.wait(5)
+        calls["retrieve"].append((query, kwargs))
+        return [f"candidate-{i}" for i in range(3)]
+
+    def fake_rerank(query, nodes, top_n=None):
+        calls["rerank"].append(query)
+        return list(reversed(nodes))[:2]
+
+    monkeypatch.setattr(agent, "retrieve_nodes", fake_retrieve)
+    monkeypatch.setattr(agent, "rerank_nodes", fake_rerank)
+    monkeypatch.setattr(agent, "SPECULATIVE_RETRIEVAL", True)
+    monkeypatch.setattr(agent, "_speculative_retrievals", {})
+    monkeypatch.setattr(agent, "_speculative_stats", {"started": 0, "reused": 0, "discarded": 0})
+    calls["gate"] = gate
+    return calls
+
+def test_take_reranks_coarse_candidates(retrieval):
+    future = agent.start_speculative_retrieval(QUESTION, INDEX)
+    retrieval["gate"].set()
+    # 模型照抄用户问题时常补一个问号
+    nodes = agent.take_speculative_retrieval(QUESTION + "？", INDEX)
+
+    assert nodes == ["candidate-2", "candidate-1"]
+    query, kwargs = retrieval["retrieve"][0]
+    assert query == QUESTION and kwargs["use_rerank"] is False
+    assert retrieval["rerank"] == [QUESTION + "？"]
+    assert future.done()
+    assert agent.get_speculative_stats() == {"started": 1, "reused": 1, "discarded": 0}
+    # 只能取用一次
+    assert agent.take_speculative_retrieval(QUESTION, INDEX) is None
+
+def test_rewritten_query_or_other_partition_misses(retrieval):
+    agent.start_speculative_retrieval(QUESTION, INDEX)
+    retrieval["gate"].set()
+    assert agent.take_speculative_retrieval("输送机皮带跑偏调整方法", INDEX) is None
+    assert agent.take_speculative_retrieval(QUESTION, "factory_knowledge_p_line3") is None
+    assert retrieval["rerank"] == []
+
+def test_discard_drops_untaken_result_without_rerank(retrieval):
+    future = agent.start_speculative_retrieval(QUESTION, INDEX)
+    agent.discard_speculative_retrieval(QUESTION, future, INDEX)
+    retrieval["gate"].set()
+
+    assert agent.take_speculative_retrieval(QUESTION, INDEX) is None
+    assert retrieval["rerank"] == []
+    assert agent.get_speculative_stats()["discarded"] == 1
+
+def test_discard_only_removes_own_future(retrieval):
+    agent._speculative_retrievals[(INDEX, agent._normalize_query(QUESTION))] = other = Future()
+    agent.discard_speculative_retrieval(QUESTION, Future(), INDEX)
+    assert agent._speculative_retrievals[(INDEX, agent._normalize_query(QUESTION))] is other
+
+def test_duplicate_and_short_messages_are_not_started(retrieval):
+    retrieval["gate"].set()
+    assert agent.start_speculative_retrieval("你好", INDEX) is None
+    assert agent.start_speculative_retrieval(QUESTION, INDEX) is not None
+    assert agent.start_speculative_retrieval(QUESTION + "?", INDEX) is None
+    assert agent.get_speculative_stats()["started"] == 1
+
+def test_failed_background_retrieval_falls_back(retrieval, monkeypatch):
+    def broken(query, **kwargs):
+        raise ConnectionError("es down")
+    monkeypatch.setattr(agent, "retrieve_nodes", broken)
+    agent.start_speculative_retrieval(QUESTION, INDEX)
+    assert agent.take_speculative_retrieval(QUESTION, INDEX) is None
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+for module in ("numpy", "requests", "dotenv", "fastapi", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import storage_gc
+from app.core.es_client import ESError
+
+OLD = time.time() - 7 * 24 * 3600
+
+@pytest.fixture(autouse=True)
+def clean_jobs(monkeypatch):
+    monkeypatch.setattr(storage_gc, "DELETE_JOBS", {})
+    monkeypatch.setattr(storage_gc, "DELETE_POLL_INTERVAL", 0)
+    monkeypatch.setattr(storage_gc.mmap_store, "enabled", lambda: False)
+
+def es_stub(monkeypatch, responses):
+    """按顺序返回 responses 中的结果；元素是异常时抛出"""
+    calls = []
+
+    def fake(method, path, body=None, **kwargs):
+        calls.append((method, path))
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(storage_gc, "es_request", fake)
+    return calls
+
+def running_job(task_id="node:1", file="a.pdf"):
+    job = {"task_id": task_id, "file": file, "status": "running", "total": None, "deleted": 0, "reclaimed": None}
+    storage_gc.DELETE_JOBS[task_id] = job
+    return job
+
+def touch(path, mtime=OLD):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * 10)
+    os.utime(path, (mtime, mtime))
+
+# -----------------------------------------------------------
+# 删除任务进度
+# -----------------------------------------------------------
+def test_deletion_status_running_and_completed(monkeypatch):
+    running_job()
+    es_stub(monkeypatch, [{"completed": False, "task": {"status": {"total": 10, "deleted": 4}}}])
+    job = storage_gc.get_deletion_status("node:1")
+    assert (job["status"], job["total"], job["deleted"]) == ("running", 10, 4)
+
+    es_stub(monkeypatch, [{"completed": True, "task": {"status": {"total": 10, "deleted": 10}}, "response": {"failures": []}}])
+    assert storage_gc.get_deletion_status("node:1")["status"] == "completed"
+
+def test_deletion_status_failures_and_error(monkeypatch):
+    running_job()
+    es_stub(monkeypatch, [{"completed": True, "task": {"status": {}}, "response": {"failures": [{"cause": "x"}]}}])
+    assert storage_gc.get_deletion_status("node:1")["status"] == "failed"
+
+    running_job("node:2")
+    es_stub(monkeypatch, [{"error": {"reason": "boom"}, "task": {"status": {}}}])
+    job = storage_gc.get_deletion_status("node:2")
+    assert job["status"] == "failed" and job["error"] == "boom"
+
+def test_finished_job_is_answered_without_es(monkeypatch):
+    running_job()["status"] = "completed"
+    calls = es_stub(monkeypatch, [ESError("gone", 404)])
+    assert storage_gc.get_deletion_status("node:1")["status"] == "completed"
+    assert calls == []
+
+def test_unknown_mmap_task_is_404():
+    with pytest.raises(ESError) as info:
+        storage_gc.get_deletion_status("mmap-unknown")
+    assert info.value.status_code == 404
+
+def test_finished_jobs_are_evicted_first(monkeypatch):
+    monkeypatch.setattr(storage_gc, "DELETE_JOBS_MAX", 3)
+    for i in range(3):
+        storage_gc._remember_job({"task_id": f"t{i}", "status": "completed" if i else "running"})
+    storage_gc._remember_job({"task_id": "t3", "status": "running"})
+    assert list(storage_gc.DELETE_JOBS) == ["t0", "t2", "t3"]
+
+# -----------------------------------------------------------
+# 监视协程
+# -----------------------------------------------------------
+def test_watch_stops_when_task_is_lost(monkeypatch):
+    job = running_job()
+    es_stub(monkeypatch, [ESError("task not found", 404)])
+    asyncio.run(storage_gc.watch_deletion("node:1"))
+    assert job["status"] == "failed"
+
+def test_watch_gives_up_after_repeated_errors(monkeypatch):
+    monkeypatch.setattr(storage_gc, "DELETE_WATCH_MAX_ERRORS", 3)
+    job = running_job()
+    calls = es_stub(monkeypatch, [ESError("connection refused")])
+    asyncio.run(storage_gc.watch_deletion("node:1"))
+    assert job["status"] == "failed"
+    assert len(calls) == 3
+
+def test_watch_reclaims_and_cleans_task_record(monkeypatch):
+    job = running_job()
+    calls = es_stub(monkeypatch, [
+        ESError("timeout"),
+        {"completed": True, "task": {"status": {"total": 1, "deleted": 1}}, "response": {}},
+        ESError("delete failed"),
+    ])
+    monkeypatch.setattr(storage_gc, "reclaim_file_storage", lambda name: {"source": True, "images": 0, "file": name})
+    asyncio.run(storage_gc.watch_deletion("node:1"))
+    assert job["status"] == "completed"
+    assert job["reclaimed"]["file"] == "a.pdf"
+    assert calls[-1] == ("DELETE", "/.tasks/_doc/node:1")
+
+# -----------------------------------------------------------
+# 单文件回收
+# -----------------------------------------------------------
+def test_reclaim_removes_source_and_unreferenced_images(tmp_path, monkeypatch):
+    uploads, images = str(tmp_path / "docs"), str(tmp_path / "images")
+    touch(os.path.join(uploads, "a.pdf"))
+    for name in ("a_p1_0.png", "a_p2_0.png", "ab_p1_0.png"):
+        touch(os.path.join(images, name))
+    touch(os.path.join(images, ".variants", "a_p1_0.png.webp"))
+    monkeypatch.setattr(storage_gc, "_remaining_chunks", lambda name: 0)
+    # a.docx 与 a.pdf 同名，仍引用 a_p2_0.png
+    monkeypatch.setattr(storage_gc, "_referenced_images_for_base", lambda base: {"a_p2_0.png"})
+
+    assert storage_gc.reclaim_file_storage("a.pdf", uploads, images) == {"source": True, "images": 1}
+    assert sorted(os.listdir(images)) == [".variants", "a_p2_0.png", "ab_p1_0.png"]
+    assert os.listdir(os.path.join(images, ".variants")) == []
+
+def test_reclaim_keeps_everything_while_chunks_remain(tmp_path, monkeypatch):
+    uploads, images = str(tmp_path / "docs"), str(tmp_path / "images")
+    touch(os.path.join(uploads, "a.pdf"))
+    touch(os.path.join(images, "a_p1_0.png"))
+    monkeypatch.setattr(storage_gc, "_remaining_chunks", lambda name: 3)
+
+    assert storage_gc.reclaim_file_storage("a.pdf", uploads, images) == {"source": False, "images": 0}
+    assert os.listdir(uploads) == ["a.pdf"] and os.listdir(images) == ["a_p1_0.png"]
+
+# -----------------------------------------------------------
+# 定期 GC
+# -----------------------------------------------------------
+@pytest.fixture
+def disk(tmp_path, monkeypatch):
+    uploads, images = str(tmp_path / "docs"), str(tmp_path / "images")
+    touch(os.path.join(uploads, "kept.pdf"))
+    touch(os.path.join(uploads, "orphan.pdf"))
+    touch(os.path.join(uploads, "new.pdf"), mtime=time.time())
+    touch(os.path.join(images, "kept_p1_0.png"))
+    touch(os.path.join(images, "kept_p1_1.png"))
+    touch(os.path.join(images, "orphan_p1_0.png"))
+    touch(os.path.join(images, "logo.png"))  # 不符合命名规则，不是入库生成的图片
+    touch(os.path.join(images, ".variants", "gone_p1_0.png.webp"))
+    monkeypatch.setattr(storage_gc, "_index_ready", lambda: True)
+    monkeypatch.setattr(storage_gc.file_catalog, "iter_indexed_files", lambda: iter([{"name": "kept.pdf"}]))
+    return uploads, images
+
+def test_gc_removes_orphans_outside_grace_period(disk):
+    uploads, images = disk
+    summary = storage_gc.run_gc(upload_dir=uploads, images_dir=images)
+    assert (summary["sources_removed"], summary["images_removed"], summary["variants_removed"]) == (1, 1, 1)
+    assert sorted(os.listdir(uploads)) == ["kept.pdf", "new.pdf"]
+    assert sorted(os.listdir(images)) == [".variants", "kept_p1_0.png", "kept_p1_1.png", "logo.png"]
+
+def test_gc_dry_run_deletes_nothing(disk):
+    uploads, images = disk
+    summary = storage_gc.run_gc(dry_run=True, upload_dir=uploads, images_dir=images)
+    assert summary["sources_removed"] == 1 and summary["freed_bytes"] > 0
+    assert len(os.listdir(uploads)) == 3 and len(os.listdir(images)) == 5
+
+def test_deep_gc_removes_unreferenced_images_of_indexed_files(disk, monkeypatch):
+    uploads, images = disk
+    monkeypatch.setattr(storage_gc, "_scan_all_referenced_images", lambda: {"kept_p1_0.png"})
+    storage_gc.run_gc(deep=True, upload_dir=uploads, images_dir=images)
+    assert "kept_p1_1.png" not in os.listdir(images)
+    assert "kept_p1_0.png" in os.listdir(images)
+
+def test_gc_skipped_when_index_is_missing(disk, monkeypatch):
+    uploads, images = disk
+    monkeypatch.setattr(storage_gc, "_index_ready", lambda: False)
+    assert storage_gc.run_gc(upload_dir=uploads, images_dir=images)["skipped"] is True
+    assert len(os.listdir(uploads)) == 3
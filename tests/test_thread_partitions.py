@@ -0,0 +1,48 @@
+import os
+from collections import OrderedDict
+
+import pytest
+
+for module in ("torch", "numpy", "requests", "dotenv", "nest_asyncio", "langgraph", "langchain_openai", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import model_server
+
+# 使用远程模型适配器 (不连接、不加载本地权重)；大模型客户端只在调用时才需要真实的 key
+model_server.MODEL_SERVER_SOCKET = model_server.MODEL_SERVER_SOCKET or "/tmp/unused_test_models.sock"
+os.environ.setdefault("DASHSCOPE_API_KEY", "test")
+from app.core import agent
+
+@pytest.fixture
+def threads(monkeypatch):
+    """问题里带「三号线」时识别为 line3_conveyor，否则识别不出分区"""
+    def fake_resolve(scope, message):
+        if scope:
+            return scope
+        return "line3_conveyor" if "三号线" in message else None
+
+    monkeypatch.setattr(agent.partitions, "resolve_scope", fake_resolve)
+    monkeypatch.setattr(agent, "_thread_partitions", OrderedDict())
+    monkeypatch.setattr(agent, "THREAD_PARTITIONS_MAX", 3)
+    return agent._thread_partitions
+
+def test_follow_up_reuses_previous_partition(threads):
+    assert agent.resolve_partition("三号线输送机跑偏", "t1") == "line3_conveyor"
+    assert agent.resolve_partition("那怎么拆下来？", "t1") == "line3_conveyor"
+    # 其他会话不受影响
+    assert agent.resolve_partition("那怎么拆下来？", "t2") is None
+
+def test_explicit_scope_overrides_previous_partition(threads):
+    agent.resolve_partition("三号线输送机跑偏", "t1")
+    assert agent.resolve_partition("焊枪怎么换", "t1", scope="line5_robot") == "line5_robot"
+    assert agent.resolve_partition("还有别的办法吗", "t1") == "line5_robot"
+
+def test_registry_is_bounded_and_evicts_least_recently_active(threads):
+    for thread_id in ("t1", "t2", "t3"):
+        agent.resolve_partition("三号线输送机跑偏", thread_id)
+    # t1 再次活跃，最久未活跃的变成 t2
+    agent.resolve_partition("那怎么拆下来？", "t1")
+    agent.resolve_partition("安全帽佩戴规范", "t4")
+
+    assert list(threads) == ["t3", "t1", "t4"]
+    assert agent.resolve_partition("那怎么拆下来？", "t2") is None
+    assert len(threads) == 3
@@ -0,0 +1,123 @@
+import sys
+import threading
+import time
+from types import ModuleType, SimpleNamespace
+
+import pytest
+
+for module in ("dotenv", "llama_index.core"):
+    pytest.importorskip(module)
+from app.core import transcription
+from app.core.transcription import SAMPLE_RATE, WhisperPool
+
+class FakeWhisper:
+    """把片段的第一个采样值当作「识别结果」；越靠前的片段识别得越慢，让并行结果乱序完成"""
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def transcribe(self, audio, **options):
+        self.calls.append((len(audio), options))
+        marker = audio[0] if len(audio) else -1
+        time.sleep(max(0.0, 0.05 - marker * 0.01))
+        return [SimpleNamespace(text=f" seg{marker} ")], None
+
+@pytest.fixture
+def whisper(monkeypatch):
+    calls = []
+    state = {"audio": [], "speech": []}
+    monkeypatch.setattr(transcription, "load_whisper", lambda cpu_threads: FakeWhisper(calls))
+
+    audio_module = ModuleType("faster_whisper.audio")
+    audio_module.decode_audio = lambda path, sampling_rate: state["audio"]
+    vad_module = ModuleType("faster_whisper.vad")
+    vad_module.VadOptions = lambda **kwargs: kwargs
+    vad_module.get_speech_timestamps = lambda audio, options: state["speech"]
+    package = ModuleType("faster_whisper")
+    package.audio, package.vad = audio_module, vad_module
+    monkeypatch.setitem(sys.modules, "faster_whisper", package)
+    monkeypatch.setitem(sys.modules, "faster_whisper.audio", audio_module)
+    monkeypatch.setitem(sys.modules, "faster_whisper.vad", vad_module)
+    state["calls"] = calls
+    return state
+
+def _speech(*spans_seconds):
+    return [{"start": int(s * SAMPLE_RATE), "end": int(e * SAMPLE_RATE)} for s, e in spans_seconds]
+
+def _audio_with_markers(seconds, spans):
+    """每个说话区间的第一个采样值是它的序号"""
+    audio = [0] * int(seconds * SAMPLE_RATE)
+    for i, (start, _) in enumerate(spans):
+        audio[start] = i
+    return audio
+
+def test_split_on_speech_merges_adjacent_spans_up_to_limit(whisper):
+    whisper["speech"] = _speech((0, 4), (5, 9), (10, 14), (20, 26), (40, 45))
+    spans = transcription.split_on_speech([], max_seconds=10)
+    assert spans == [
+        (0, 9 * SAMPLE_RATE),
+        (10 * SAMPLE_RATE, 14 * SAMPLE_RATE),
+        (20 * SAMPLE_RATE, 26 * SAMPLE_RATE),
+        (40 * SAMPLE_RATE, 45 * SAMPLE_RATE),
+    ]
+
+def test_short_audio_uses_single_pass(whisper, monkeypatch):
+    monkeypatch.setattr(transcription, "LONG_AUDIO_SECONDS", 30)
+    whisper["audio"] = [0] * (10 * SAMPLE_RATE)
+
+    result = transcription.transcribe_audio(WhisperPool(size=2), "short.wav", profile="fast")
+
+    assert result["mode"] == "single"
+    assert result["segments"] == 1
+    assert result["text"] == "seg0"
+    assert result["duration"] == 10
+    (length, options), = whisper["calls"]
+    assert length == 10 * SAMPLE_RATE
+    assert options == {"beam_size": 1, "best_of": 1, "temperature": 0.0, "language": "zh"}
+
+def test_long_audio_segments_are_joined_in_time_order(whisper, monkeypatch):
+    monkeypatch.setattr(transcription, "LONG_AUDIO_SECONDS", 30)
+    monkeypatch.setattr(transcription, "SEGMENT_MAX_SECONDS", 30)
+    spans = [(0, 20), (40, 60), (80, 100), (120, 140)]
+    whisper["speech"] = _speech(*spans)
+    whisper["audio"] = _audio_with_markers(150, [(s * SAMPLE_RATE, e) for s, e in spans])
+
+    result = transcription.transcribe_audio(WhisperPool(size=3), "long.wav")
+
+    assert result["mode"] == "long"
+    assert result["segments"] == 4
+    # 后面的片段先识别完，拼接时仍按时间顺序
+    assert result["text"] == "seg0seg1seg2seg3"
+    assert all(not options["condition_on_previous_text"] and not options["vad_filter"] for _, options in whisper["calls"])
+
+def test_long_mode_can_be_forced_either_way(whisper, monkeypatch):
+    monkeypatch.setattr(transcription, "LONG_AUDIO_SECONDS", 30)
+    whisper["speech"] = _speech((0, 5), (60, 65))
+    whisper["audio"] = _audio_with_markers(70, [(0, 5), (60 * SAMPLE_RATE, 65)])
+
+    assert transcription.transcribe_audio(WhisperPool(), "a.wav", long_mode=False)["mode"] == "single"
+    forced = transcription.transcribe_audio(WhisperPool(), "a.wav", long_mode=True, language="en")
+    assert forced["mode"] == "long"
+    assert forced["text"] == "seg0 seg1"
+
+def test_unknown_profile_is_rejected(whisper):
+    with pytest.raises(ValueError):
+        transcription.transcribe_audio(WhisperPool(), "a.wav", profile="turbo")
+
+def test_pool_never_loads_more_than_size_models(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(transcription, "load_whisper", lambda cpu_threads: loaded.append(cpu_threads) or object())
+    pool = WhisperPool(size=2)
+    barrier = threading.Barrier(4)
+
+    def use():
+        barrier.wait()
+        with pool.acquire():
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert len(loaded) == 2
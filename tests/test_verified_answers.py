@@ -0,0 +1,117 @@
+import json
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+from app.core.verified_answers import VerifiedAnswerIndex
+
+class FakeEmbedding:
+    """每个问题一个固定方向的向量 (忽略末尾问号)；未登记的文本落在第一个方向上"""
+
+    def __init__(self, texts):
+        self.axes = {text: i for i, text in enumerate(texts)}
+        self.on_query = None
+
+    def _vector(self, text):
+        vector = np.zeros(len(self.axes), dtype=np.float32)
+        vector[self.axes.get(text.rstrip("?"), 0)] = 1.0
+        return vector
+
+    def get_text_embedding_batch(self, texts):
+        return [self._vector(t) for t in texts]
+
+    def get_query_embedding(self, text):
+        if self.on_query:
+            self.on_query()
+        return self._vector(text)
+
+QUESTIONS = ["三号线输送机跑偏", "五号线机器人报警", "空压机压力不足"]
+
+def record(query, answer, source="", partition=None):
+    item = {"query": query, "status": "solved", "answer_text": answer, "solution_source": source}
+    if partition:
+        item["partition"] = partition
+    return item
+
+def write_records(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False)
+
+@pytest.fixture
+def records_file(tmp_path):
+    path = str(tmp_path / "unanswered.json")
+    write_records(path, [record(q, f"答案{i}", f"人工解答_{i}.txt") for i, q in enumerate(QUESTIONS)])
+    return path
+
+def make_index(records_file, tmp_path, **kwargs):
+    return VerifiedAnswerIndex(FakeEmbedding(QUESTIONS + ["未收录的问题"]), records_file, str(tmp_path), **kwargs)
+
+def test_similar_question_returns_engineer_answer(records_file, tmp_path):
+    index = make_index(records_file, tmp_path)
+    hit = index.lookup("五号线机器人报警 ")
+    assert hit["answer"] == "答案1" and hit["score"] == 1.0
+    assert index.lookup("未收录的问题") is None
+
+def test_partition_filter(tmp_path):
+    path = str(tmp_path / "unanswered.json")
+    write_records(path, [record(QUESTIONS[0], "三号线的答案", partition="line3")])
+    index = make_index(path, tmp_path)
+    assert index.lookup(QUESTIONS[0], partitions={"line5", "general"}) is None
+    assert index.lookup(QUESTIONS[0], partitions={"line3"})["answer"] == "三号线的答案"
+
+def test_deleted_source_is_not_served(records_file, tmp_path):
+    deleted = {"人工解答_1.txt"}
+    index = make_index(records_file, tmp_path, source_exists=lambda name: name not in deleted)
+    assert index.lookup(QUESTIONS[1]) is None
+    assert index.lookup(QUESTIONS[0])["answer"] == "答案0"
+    deleted.clear()
+    assert index.lookup(QUESTIONS[1])["answer"] == "答案1"
+
+def test_source_check_failure_falls_back_to_normal_flow(records_file, tmp_path):
+    def unavailable(name):
+        raise ConnectionError("es down")
+    index = make_index(records_file, tmp_path, source_exists=unavailable)
+    assert index.lookup(QUESTIONS[0]) is None
+
+def test_refresh_during_lookup_keeps_answers_consistent(records_file, tmp_path):
+    index = make_index(records_file, tmp_path)
+    index.refresh()
+
+    def reorder():
+        # 查询计算向量期间，另一个请求解答了新问题并刷新了索引 (条目顺序随之变化)
+        write_records(records_file, [record(q, f"答案{QUESTIONS.index(q)}") for q in reversed(QUESTIONS[1:])])
+        index.refresh(True)
+    index.embed_model.on_query = reorder
+
+    hit = index.lookup("三号线输送机跑偏?")
+    assert hit is None or hit["query"] == QUESTIONS[0]
+
+def test_concurrent_refresh_and_lookup(records_file, tmp_path):
+    index = make_index(records_file, tmp_path)
+    layouts = [[record(q, f"答案{QUESTIONS.index(q)}") for q in order] for order in (QUESTIONS, QUESTIONS[::-1], QUESTIONS[1:])]
+    errors, stop = [], threading.Event()
+
+    def refresher():
+        i = 0
+        while not stop.is_set():
+            write_records(records_file, layouts[i % len(layouts)])
+            index.refresh(True)
+            i += 1
+
+    thread = threading.Thread(target=refresher)
+    thread.start()
+    try:
+        for _ in range(300):
+            for i, question in enumerate(QUESTIONS):
+                try:
+                    hit = index.lookup(question + "?")
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if hit is not None and hit["answer"] != f"答案{i}":
+                    errors.append(hit)
+    finally:
+        stop.set()
+        thread.join()
+    assert not errors